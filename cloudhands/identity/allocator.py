@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from bisect import bisect_right
+import datetime
+import logging
+import threading
+import weakref
+
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import desc
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import select
+from sqlalchemy import Table
+
+from cloudhands.common.discovery import providers
+from cloudhands.common.schema import PosixUIdNumber
+
+from cloudhands.identity.database import has_table
+from cloudhands.identity.ldap_account import discover_uids
+
+__doc__ = """
+Allocation of uidNumbers for new accounts.
+
+The numbers not yet in use are held in the `uidnumber_free` table as a
+list of half-open intervals [lo, hi). A provider's range starts as one
+interval, and stays a handful of intervals however many numbers are
+taken from it.
+
+:py:func:`create` only makes the tables, so the server starts without
+provider settings or LDAP. The free list is filled by :py:func:`seed`
+the first time a number is wanted. Seeding takes out every number held
+in LDAP, so it fails while LDAP cannot be reached, and no number is
+given out until it succeeds.
+
+:py:func:`next_uidnumber` reserves the lowest free number. Finding it
+is a lookup on the primary key, and taking it is a single conditional
+UPDATE or DELETE of that row. If another process got there first, the
+write matches nothing and the next interval is tried. The reservation
+belongs to the caller's transaction, and is committed along with the
+account which uses the number.
+
+Numbers taken outside this service are found in LDAP by a
+:py:class:`Reconciler`, which asks only for the accounts changed since
+its previous scan.
+"""
+
+DFLT_ATTEMPTS = 8
+DFLT_INTERVAL = 300.0
+
+metadata = MetaData()
+
+free = Table(
+    "uidnumber_free", metadata,
+    Column("lo", Integer, primary_key=True, autoincrement=False),
+    Column("hi", Integer, nullable=False),
+)
+
+# Holds a row once the free list has been filled.
+seeded = Table(
+    "uidnumber_seeded", metadata,
+    Column("at", DateTime, primary_key=True),
+)
+
+_present = weakref.WeakKeyDictionary()
+
+
+class FreeList:
+    """
+    An in-memory list of free intervals, kept in order by their lower
+    bounds so that the interval holding a number is found by bisection.
+    """
+
+    def __init__(self, intervals=()):
+        self.intervals = sorted((lo, hi) for lo, hi in intervals if lo < hi)
+        self.keys = [lo for lo, hi in self.intervals]
+
+    def __iter__(self):
+        return iter(self.intervals)
+
+    def __len__(self):
+        return sum(hi - lo for lo, hi in self.intervals)
+
+    def __contains__(self, n):
+        i = bisect_right(self.keys, n) - 1
+        return i >= 0 and n < self.intervals[i][1]
+
+    def discard(self, n):
+        i = bisect_right(self.keys, n) - 1
+        if i < 0 or n >= self.intervals[i][1]:
+            return False
+        lo, hi = self.intervals[i]
+        parts = [(a, b) for a, b in ((lo, n), (n + 1, hi)) if a < b]
+        self.intervals[i:i + 1] = parts
+        self.keys[i:i + 1] = [a for a, b in parts]
+        return True
+
+
+def uid_range(provider=None):
+    provider = provider or next(reversed(providers["vcloud"]))
+    return (
+        int(provider["uidnumbers"]["start"]),
+        int(provider["uidnumbers"]["stop"]))
+
+
+def available(session):
+    """
+    Returns `True` if the allocation table exists in the database
+    behind `session`.
+    """
+    return has_table(session, free, _present)
+
+
+def tables(connection):
+    """
+    Creates the allocation tables if need be. A free list filled before
+    the `seeded` table existed is marked as seeded.
+    """
+    metadata.create_all(connection)
+    if (connection.execute(select([free.c.lo]).limit(1)).first() and
+            not is_seeded(connection)):
+        connection.execute(seeded.insert().values(
+            at=datetime.datetime.utcnow()))
+
+
+def is_seeded(connection):
+    return connection.execute(
+        select([seeded.c.at]).limit(1)).first() is not None
+
+
+def create(session):
+    """
+    Creates the allocation tables if need be. This needs neither the
+    provider settings nor LDAP.
+
+    :param object session:  A SQLALchemy database session.
+    :returns: The session.
+    """
+    tables(session.connection())
+    _present[session.get_bind()] = True
+    session.commit()
+    return session
+
+
+def seed(
+    session, start=None, stop=None, taken=None, discover=discover_uids
+):
+    """
+    Fills the free list, unless that is done already, with the range
+    from `start` to `stop`. The numbers already recorded in the
+    database, in `taken`, or in LDAP as found by `discover` are left
+    out. The caller commits.
+
+    :param object session:  A SQLALchemy database session.
+    :param discover: A callable which returns the uidNumbers in LDAP.
+                     `None` skips LDAP, and is meant for tests.
+    :returns: `True` if the free list is filled.
+    """
+    log = logging.getLogger("cloudhands.identity.allocator.seed")
+    connection = session.connection()
+    if is_seeded(connection):
+        return True
+
+    if start is None or stop is None:
+        try:
+            start, stop = uid_range()
+        except (KeyError, StopIteration, TypeError, ValueError) as e:
+            log.warning("No uidNumber range configured: {}".format(e))
+            return False
+    taken = set(taken or ())
+    taken.update(i for (i,) in session.query(PosixUIdNumber.value))
+    if discover is not None:
+        try:
+            taken.update(discover())
+        except Exception as e:
+            log.warning("LDAP not consulted: {}".format(e))
+            return False
+
+    intervals = FreeList([(start, stop)])
+    for n in taken:
+        intervals.discard(n)
+    for lo, hi in intervals:
+        connection.execute(free.insert().values(lo=lo, hi=hi))
+    connection.execute(seeded.insert().values(at=datetime.datetime.utcnow()))
+    log.info("{} uidNumbers free in {} intervals".format(
+        len(intervals), len(intervals.intervals)))
+    return True
+
+
+def next_uidnumber(session, attempts=DFLT_ATTEMPTS, discover=discover_uids):
+    """
+    Reserves the lowest free uidNumber. The reservation is part of the
+    transaction of `session`, which the caller commits. Until then the
+    database lock keeps other writers from taking the same number.
+
+    :param object session:  A SQLALchemy database session.
+    :returns: The number, or `None` if none is free or the free list
+              could not be seeded.
+    """
+    log = logging.getLogger("cloudhands.identity.allocator.next_uidnumber")
+    connection = session.connection()
+    if not available(session):
+        tables(connection)
+    if not seed(session, discover=discover):
+        log.warning("No uidNumbers until LDAP has been consulted")
+        return None
+
+    for n in range(attempts):
+        row = connection.execute(
+            select([free]).order_by(free.c.lo).limit(1)).first()
+        if row is None:
+            return None
+
+        lo, hi = row["lo"], row["hi"]
+        match = (free.c.lo == lo) & (free.c.hi == hi)
+        if hi - lo > 1:
+            rv = connection.execute(
+                free.update().where(match).values(lo=lo + 1))
+        else:
+            rv = connection.execute(free.delete().where(match))
+
+        if rv.rowcount == 1:
+            return lo
+    return None
+
+
+def discard(session, n):
+    """
+    Removes the number `n` from the free list.
+
+    :returns: `True` if `n` was free.
+    """
+    connection = session.connection()
+    row = connection.execute(
+        select([free]).where(free.c.lo <= n).order_by(
+        desc(free.c.lo)).limit(1)).first()
+    if row is None or n >= row["hi"]:
+        return False
+
+    lo, hi = row["lo"], row["hi"]
+    match = (free.c.lo == lo) & (free.c.hi == hi)
+    if lo == n and hi == n + 1:
+        connection.execute(free.delete().where(match))
+    elif lo == n:
+        connection.execute(free.update().where(match).values(lo=n + 1))
+    else:
+        connection.execute(free.update().where(match).values(hi=n))
+        if n + 1 < hi:
+            connection.execute(free.insert().values(lo=n + 1, hi=hi))
+    return True
+
+
+def reconcile(session, uids):
+    """
+    Removes from the free list every number in `uids`.
+
+    :returns: The number of free numbers removed.
+    """
+    rv = sum(1 for n in sorted(uids) if discard(session, n))
+    session.commit()
+    return rv
+
+
+class Reconciler:
+    """
+    Keeps the free list in step with LDAP.
+
+    Each scan asks only for the accounts modified since the one before.
+
+    :param sessions: A SQLAlchemy session factory.
+    :param float interval: Seconds between scans.
+    """
+
+    def __init__(self, sessions, interval=DFLT_INTERVAL, discover=None):
+        self.sessions = sessions
+        self.interval = interval
+        self.discover = discover or discover_uids
+        self.since = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="cloudhands.identity.allocator",
+                daemon=True)
+            self.thread.start()
+        return self
+
+    def scan(self):
+        now = datetime.datetime.utcnow()
+        session = self.sessions()
+        try:
+            if not available(session):
+                return 0
+            elif not is_seeded(session.connection()):
+                # Seeding consults LDAP in full.
+                if seed(session, discover=self.discover):
+                    session.commit()
+                    self.since = now
+                return 0
+            rv = reconcile(session, self.discover(since=self.since))
+        finally:
+            session.close()
+        self.since = now
+        return rv
+
+    def run(self):
+        log = logging.getLogger("cloudhands.identity.allocator.reconciler")
+        while not self.stopped.wait(self.interval):
+            try:
+                n = self.scan()
+            except Exception as e:
+                log.warning(e)
+            else:
+                if n:
+                    log.info("{} uidNumbers taken in LDAP".format(n))
+
+    def stop(self):
+        self.stopped.set()
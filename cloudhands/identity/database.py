@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import OrderedDict
+import logging
+import weakref
+
+from sqlalchemy import desc
+from sqlalchemy import event
+from sqlalchemy import Index
+from sqlalchemy import inspect
+
+from cloudhands.common.schema import Resource
+from cloudhands.common.schema import Touch
+
+__doc__ = """
+Database helpers shared by the identity processes and the web server.
+
+Each process which opens the database tunes it with :py:func:`bootstrap`.
+This puts SQLite into WAL mode so that readers do not block on a writer.
+The pragma values may be overridden in the `db.sqlite` section of the
+configuration, eg::
+
+    [db.sqlite]
+    journal_mode = WAL
+    synchronous = NORMAL
+    mmap_size = 268435456
+    cache_size = -16000
+    busy_timeout = 5000
+
+The latest resource of a type on an artifact is found by
+:py:func:`latest_resource` in a single query. The indexes declared here
+let it read only the newest Touches of the artifact, and only their
+resources. Indexes which the schema of `cloudhands.common` lacks are
+added to existing databases by :py:func:`create_indexes`.
+"""
+
+DFLT_PRAGMAS = OrderedDict([
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("mmap_size", "268435456"),
+    ("cache_size", "-16000"),
+    ("busy_timeout", "5000"),
+])
+
+ix_touch_artifact_at = Index(
+    "ix_touch_artifact_at",
+    Touch.__table__.c.artifact_id, Touch.__table__.c.at)
+
+ix_resource_touch = Index(
+    "ix_resource_touch", next(
+        c for c in Resource.__table__.c
+        if any(fk.references(Touch.__table__) for fk in c.foreign_keys)))
+
+_tuned = weakref.WeakKeyDictionary()
+
+
+def pragmas(config=None):
+    """
+    Returns the SQLite pragmas to apply, with any values from the
+    `db.sqlite` section of `config` in place of the defaults.
+    """
+    rv = OrderedDict(DFLT_PRAGMAS)
+    if config is not None and config.has_section("db.sqlite"):
+        rv.update(
+            (k, v) for k, v in config.items("db.sqlite") if k in rv)
+    return rv
+
+
+def apply_pragmas(dbapi_con, values):
+    cur = dbapi_con.cursor()
+    try:
+        for k, v in values.items():
+            cur.execute("PRAGMA {}={}".format(k, v))
+    finally:
+        cur.close()
+
+
+def tune(engine, config=None):
+    """
+    Arranges for every new connection made by `engine` to be tuned with
+    the pragmas from `config`. It is safe to call this more than once.
+    """
+    if engine in _tuned:
+        return _tuned[engine]
+
+    values = _tuned[engine] = pragmas(config)
+
+    def on_connect(dbapi_con, record):
+        apply_pragmas(dbapi_con, values)
+
+    event.listen(engine, "connect", on_connect)
+    return values
+
+
+def bootstrap(session, config=None):
+    """
+    Tunes the SQLite database behind `session`. This applies to the
+    connection already held by the session and to any made afterwards.
+
+    :param object session:  A SQLALchemy database session.
+    :param object config:   A ConfigParser object.
+    :returns: The session.
+    """
+    log = logging.getLogger("cloudhands.identity.database.bootstrap")
+    values = tune(session.get_bind(), config)
+    apply_pragmas(session.connection().connection, values)
+    session.commit()
+    log.debug("Applied {}".format(
+        ", ".join("{}={}".format(k, v) for k, v in values.items())))
+    return session
+
+
+def create_indexes(session, indexes):
+    """
+    Creates those of `indexes` which the database behind `session` is
+    missing. The caller commits.
+
+    :param object session:  A SQLALchemy database session.
+    :returns: The names of the indexes created.
+    """
+    log = logging.getLogger("cloudhands.identity.database.create_indexes")
+    connection = session.connection()
+    held = {}
+    rv = []
+    for index in indexes:
+        table = index.table.name
+        if table not in held:
+            held[table] = {
+                i["name"] for i in inspect(connection).get_indexes(table)}
+        if index.name not in held[table]:
+            index.create(connection)
+            held[table].add(index.name)
+            rv.append(index.name)
+            log.info("Created index {} on {}".format(index.name, table))
+    return rv
+
+
+def has_table(session, table, cache):
+    """
+    Returns `True` if `table` exists in the database behind `session`.
+    The answer is kept in `cache`, a WeakKeyDictionary, under the engine.
+    A module which creates the table sets the entry to `True`.
+    """
+    engine = session.get_bind()
+    try:
+        return cache[engine]
+    except KeyError:
+        rv = cache[engine] = engine.dialect.has_table(
+            session.connection(), table.name)
+        return rv
+
+
+def latest_resource(session, artifact, typ):
+    """
+    Returns the newest resource of type `typ` attached to a change of
+    `artifact`, or `None` if there is none.
+    """
+    return session.query(typ).join(Touch).filter(
+        Touch.artifact_id == artifact.id).order_by(
+        desc(Touch.at), desc(Touch.id)).first()
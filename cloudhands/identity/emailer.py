@@ -18,6 +18,8 @@ from cloudhands.common.schema import Membership
 from cloudhands.common.schema import TimeInterval
 from cloudhands.common.schema import Touch
 
+from cloudhands.identity.database import bootstrap
+
 
 class Emailer:
 
@@ -52,7 +54,8 @@ class Emailer:
     @asyncio.coroutine
     def notify(self):
         log = logging.getLogger("cloudhands.identity.emailer")
-        session = Registry().connect(sqlite3, self.args.db).session
+        session = bootstrap(
+            Registry().connect(sqlite3, self.args.db).session, self.config)
         initialise(session)
         actor = session.query(Component).filter(
             Component.handle=="identity.controller").one()
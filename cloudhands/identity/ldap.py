@@ -24,6 +24,7 @@ from cloudhands.common.schema import PosixUId
 from cloudhands.common.schema import Registration
 from cloudhands.common.schema import Touch
 from cloudhands.common.states import RegistrationState
+from cloudhands.identity.database import bootstrap
 from cloudhands.web import __version__
 
 import ldap3
@@ -330,7 +331,8 @@ class LDAPProxy:
     @asyncio.coroutine
     def operate(self):
         log = logging.getLogger("cloudhands.identity.ldap")
-        session = Registry().connect(sqlite3, self.args.db).session
+        session = bootstrap(
+            Registry().connect(sqlite3, self.args.db).session, self.config)
         initialise(session)
         while True:
             msg = yield from self.q.get()
@@ -19,7 +19,11 @@ Command line tool to change LDAP passwords.
 
 DFLT_DB = ":memory:"
 
-def discover_uids(config=None):
+def discover_uids(config=None, since=None):
+    """
+    Returns the set of uidNumbers of posix accounts in LDAP. If `since`
+    is a datetime, only accounts modified after it are examined.
+    """
     log = logging.getLogger("cloudhands.identity.discovery")
     config = config or next(iter(settings.values()))
     s = ldap3.Server(
@@ -31,7 +35,11 @@ def discover_uids(config=None):
     log.info("Opening LDAP connection to {}.".format(
         config["ldap.search"]["host"]))
 
-    c.search(config["ldap.match"]["query"], "(objectclass=posixAccount)",
+    query = "(objectclass=posixAccount)"
+    if since is not None:
+        query = "(&{}(modifyTimestamp>={:%Y%m%d%H%M%S}Z))".format(
+            query, since)
+    c.search(config["ldap.match"]["query"], query,
         ldap3.SEARCH_SCOPE_WHOLE_SUBTREE,
         attributes=["uidNumber"])
     return {
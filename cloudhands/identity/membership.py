@@ -6,11 +6,18 @@ import uuid
 
 import cloudhands.common.factories
 import cloudhands.common.schema
+from cloudhands.common.schema import EmailAddress
 from cloudhands.common.schema import Membership
+from cloudhands.common.schema import Registration
 from cloudhands.common.schema import Touch
 from cloudhands.common.schema import User
 
 from cloudhands.common.states import MembershipState
+from cloudhands.common.states import RegistrationState
+
+from cloudhands.web.context import privilege
+
+DFLT_BATCH = 100
 
 
 def handle_from_email(addrVal):
@@ -40,10 +47,7 @@ class Invitation():
         :param object session:  A SQLALchemy database session.
         :returns: a :py:func:`cloudhands.common.schema.Touch` object.
         """
-        prvlg = session.query(Membership).join(Touch).join(User).filter(
-            User.id == self.user.id).filter(
-            Membership.organisation == self.org).filter(
-            Membership.role == "admin").first()
+        prvlg = privilege(session, self.user, self.org.name)
         if not prvlg or prvlg.changes[-1].state.name in (
             "created", "invited", "expired", "withdrawn"
         ):
@@ -73,6 +77,126 @@ class Invitation():
         return act
 
 
+def registration(user, emailAddr, state, at):
+    """
+    Returns the email address resource of a new registration for
+    `user`. Adding it to a session adds the registration too.
+    """
+    reg = Registration(
+        uuid=uuid.uuid4().hex, model=cloudhands.common.__version__)
+    act = Touch(artifact=reg, actor=user, state=state, at=at)
+    return EmailAddress(touch=act, value=emailAddr)
+
+
+class BulkInvitation():
+    """
+    Invites many people to an organisation at once.
+
+    :param object user: A :py:func:`cloudhands.common.schema.User` object.
+    :param object org: A :py:func:`cloudhands.common.schema.Organisation`.
+    :param rows: A sequence of (handle, surname, emailAddr) tuples.
+    :param int batch: The number of rows in each transaction.
+    """
+    def __init__(self, user, org, rows, batch=DFLT_BATCH):
+        self.user = user
+        self.org = org
+        self.rows = list(rows)
+        self.batch = batch
+
+    def __call__(self, session):
+        """
+        Invites the person in each row as :py:class:`Invitation` does.
+        Someone already known by their handle is invited as that user.
+        A registration is made for each email address not yet known.
+
+        A row is not invited if the person is already a member of the
+        organisation, or if the email address belongs to someone else.
+
+        The privilege check and the lookups of users, members and
+        addresses are done once for all the rows. The rows are committed
+        `batch` at a time. Each row is made inside a savepoint, so a row
+        which fails is rolled back entirely and reported as such; the
+        others stand.
+
+        If the `user` attribute is not privileged in the organisation, the
+        operation will fail and `None` will be returned.
+
+        :param object session:  A SQLALchemy database session.
+        :returns: A list of dictionaries, one for each row, with `handle`,
+                  `email` and `status` keys. New memberships have a
+                  `uuid` key too.
+        """
+        prvlg = privilege(session, self.user, self.org.name)
+        if not prvlg or prvlg.changes[-1].state.name in (
+            "created", "invited", "expired", "withdrawn"
+        ):
+            return None
+
+        invite = session.query(MembershipState).filter(
+            MembershipState.name == "created").one()
+        preconfirm = session.query(RegistrationState).filter(
+            RegistrationState.name == "pre_registration_person").one()
+
+        handles = {i[0] for i in self.rows}
+        addrs = {i[2] for i in self.rows}
+        users = {}
+        members = set()
+        owners = {}
+        if self.rows:
+            users.update((i.handle, i) for i in session.query(User).filter(
+                User.handle.in_(handles)))
+            members.update(i for (i,) in session.query(
+                User.handle).select_from(Membership).join(Touch).join(
+                User).filter(Membership.organisation == self.org).filter(
+                User.handle.in_(handles)))
+            owners.update(session.query(
+                EmailAddress.value, User.handle).join(Touch).join(User).filter(
+                EmailAddress.value.in_(addrs)))
+
+        report = []
+        for n, (handle, surname, emailAddr) in enumerate(self.rows):
+            result = {"handle": handle, "email": emailAddr}
+            report.append(result)
+            owner = owners.get(emailAddr, None)
+            if handle in members:
+                result["status"] = "member"
+            elif owner not in (None, handle):
+                result["status"] = "conflict"
+            else:
+                try:
+                    with session.begin_nested():
+                        guest = users.get(handle, None) or User(
+                            handle=handle, uuid=uuid.uuid4().hex)
+                        mship = Membership(
+                            uuid=uuid.uuid4().hex,
+                            model=cloudhands.web.__version__,
+                            organisation=self.org,
+                            role="user")
+                        now = datetime.datetime.utcnow()
+                        session.add_all((
+                            Touch(
+                                artifact=mship, actor=self.user,
+                                state=invite, at=now),
+                            Touch(
+                                artifact=mship, actor=guest,
+                                state=invite, at=now)))
+                        if owner is None:
+                            session.add(registration(
+                                guest, emailAddr, preconfirm, now))
+                except Exception:
+                    result["status"] = "failed"
+                else:
+                    users[handle] = guest
+                    members.add(handle)
+                    owners[emailAddr] = handle
+                    result.update(status="invited", uuid=mship.uuid)
+
+            if (n + 1) % self.batch == 0:
+                session.commit()
+        session.commit()
+        return report
+
+
 class Acceptance():
     """
     :param object mship: A :py:func:`cloudhands.common.schema.Membership`.
@@ -28,6 +28,8 @@ from cloudhands.common.schema import User
 from cloudhands.common.states import MembershipState
 from cloudhands.common.states import RegistrationState
 
+from cloudhands.identity.database import bootstrap
+from cloudhands.identity.database import latest_resource
 from cloudhands.identity.ldap import LDAPProxy
 from cloudhands.identity.ldap import LDAPRecord
 from cloudhands.identity.ldap import RecordPatterns
@@ -60,7 +62,8 @@ class Observer:
     @asyncio.coroutine
     def mailer(self):
         log = logging.getLogger(__name__ + ".mailer")
-        session = Registry().connect(sqlite3, self.args.db).session
+        session = bootstrap(
+            Registry().connect(sqlite3, self.args.db).session, self.config)
         initialise(session)
         actor = session.query(Component).filter(
             Component.handle=="identity.controller").one()
@@ -99,7 +102,8 @@ class Observer:
     @asyncio.coroutine
     def publish_userhandle(self):
         log = logging.getLogger(__name__ + ".name")
-        session = Registry().connect(sqlite3, self.args.db).session
+        session = bootstrap(
+            Registry().connect(sqlite3, self.args.db).session, self.config)
         initialise(session)
         actor = session.query(Component).filter(
             Component.handle=="identity.controller").one()
@@ -139,7 +143,8 @@ class Observer:
     @asyncio.coroutine
     def publish_uuid(self):
         log = logging.getLogger(__name__ + ".uuid")
-        session = Registry().connect(sqlite3, self.args.db).session
+        session = bootstrap(
+            Registry().connect(sqlite3, self.args.db).session, self.config)
         initialise(session)
         actor = session.query(Component).filter(
             Component.handle=="identity.controller").one()
@@ -186,7 +191,8 @@ class Observer:
     @asyncio.coroutine
     def publish_uidnumber(self):
         log = logging.getLogger(__name__ + ".uidnumber")
-        session = Registry().connect(sqlite3, self.args.db).session
+        session = bootstrap(
+            Registry().connect(sqlite3, self.args.db).session, self.config)
         initialise(session)
         actor = session.query(Component).filter(
             Component.handle=="identity.controller").one()
@@ -198,14 +204,14 @@ class Observer:
                     "user_posixaccount")]
 
                 for reg in unpublished:
-                    resources = [r for c in reversed(reg.changes)
-                                 for r in c.resources]
+                    emailAddr, uid, uidNumber = (
+                        latest_resource(session, reg, i)
+                        for i in (EmailAddress, PosixUId, PosixUIdNumber))
+                    if None in (emailAddr, uid, uidNumber):
+                        log.warning(
+                            "Registration {} is incomplete".format(reg.uuid))
+                        continue
 
-                    emailAddr = next(i for i in resources
-                                     if isinstance(i, EmailAddress))
-                    uid = next(i for i in resources if isinstance(i, PosixUId))
-                    uidNumber = next(i for i in resources
-                                     if isinstance(i, PosixUIdNumber))
                     record = LDAPRecord(
                         dn={("cn={},ou=jasmin2,"
                         "ou=People,o=hpc,dc=rl,dc=ac,dc=uk").format(uid.value)},
@@ -234,7 +240,8 @@ class Observer:
     @asyncio.coroutine
     def publish_sshpublickey(self):
         log = logging.getLogger(__name__ + ".sshpublickey")
-        session = Registry().connect(sqlite3, self.args.db).session
+        session = bootstrap(
+            Registry().connect(sqlite3, self.args.db).session, self.config)
         initialise(session)
         actor = session.query(Component).filter(
             Component.handle=="identity.controller").one()
@@ -247,17 +254,17 @@ class Observer:
 
                 for reg in unpublished:
                     user = reg.changes[0].actor
-                    resources = [r for c in reversed(reg.changes)
-                                 for r in c.resources]
-
-                    key = next(
-                        (i for i in resources if isinstance(i, PublicKey)),
-                        None)
+                    key = latest_resource(session, reg, PublicKey)
 
                     if key is None:
                         continue
 
-                    uid = next(i for i in resources if isinstance(i, PosixUId))
+                    uid = latest_resource(session, reg, PosixUId)
+                    if uid is None:
+                        log.warning(
+                            "Registration {} has no uid".format(reg.uuid))
+                        continue
+
                     record = LDAPRecord(
                         dn={("cn={},ou=jasmin2,"
                         "ou=People,o=hpc,dc=rl,dc=ac,dc=uk").format(uid.value)},
@@ -277,7 +284,8 @@ class Observer:
     @asyncio.coroutine
     def publish_user_membership(self):
         log = logging.getLogger(__name__ + ".publish_user_membership")
-        session = Registry().connect(sqlite3, self.args.db).session
+        session = bootstrap(
+            Registry().connect(sqlite3, self.args.db).session, self.config)
         initialise(session)
         while True:
             try:
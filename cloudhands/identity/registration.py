@@ -132,11 +132,14 @@ def from_pool(pool:set, taken:set=set()):
 
 class NewPassword:
     """
-    Adds a new password to a user registration
+    Adds a new password to a user registration.
+
+    A `hash` already computed from `passwd` may be given, so the caller
+    can do the work elsewhere.
     """
-    def __init__(self, user, passwd, reg):
+    def __init__(self, user, passwd, reg, hash=None):
         self.user = user
-        self.hash = bcrypt.hashpw(passwd, bcrypt.gensalt(12))
+        self.hash = hash or bcrypt.hashpw(passwd, bcrypt.gensalt(12))
         self.reg = reg
 
     def match(self, attempt):
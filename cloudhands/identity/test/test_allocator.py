@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import sqlite3
+import unittest
+
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+
+from cloudhands.identity.allocator import create
+from cloudhands.identity.allocator import discard
+from cloudhands.identity.allocator import free
+from cloudhands.identity.allocator import FreeList
+from cloudhands.identity.allocator import next_uidnumber
+from cloudhands.identity.allocator import Reconciler
+from cloudhands.identity.allocator import reconcile
+from cloudhands.identity.allocator import seed
+
+
+class FreeListTests(unittest.TestCase):
+
+    def test_discard_splits_intervals(self):
+        intervals = FreeList([(0, 10)])
+        self.assertTrue(intervals.discard(0))
+        self.assertTrue(intervals.discard(5))
+        self.assertTrue(intervals.discard(9))
+        self.assertFalse(intervals.discard(5))
+        self.assertFalse(intervals.discard(10))
+        self.assertEqual([(1, 5), (6, 9)], list(intervals))
+        self.assertEqual(7, len(intervals))
+        self.assertIn(6, intervals)
+        self.assertNotIn(5, intervals)
+
+
+class AllocatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        initialise(self.session)
+        create(self.session)
+        seed(self.session, 100, 110, taken={100, 101, 105}, discover=None)
+        self.session.commit()
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, ":memory:")
+
+    def intervals(self):
+        return [
+            tuple(i) for i in self.session.connection().execute(
+                free.select().order_by(free.c.lo))]
+
+    def test_create_holds_free_intervals(self):
+        self.assertEqual([(102, 105), (106, 110)], self.intervals())
+
+    def test_seed_keeps_existing_table(self):
+        create(self.session)
+        self.assertTrue(seed(self.session, 0, 1000, discover=None))
+        self.assertEqual([(102, 105), (106, 110)], self.intervals())
+
+    def test_caller_commits_reservation(self):
+        self.assertEqual(102, next_uidnumber(self.session))
+        self.session.rollback()
+        self.assertEqual(102, next_uidnumber(self.session))
+        self.session.commit()
+        self.assertEqual(103, next_uidnumber(self.session))
+
+    def test_numbers_are_allocated_in_order(self):
+        self.assertEqual(
+            [102, 103, 104, 106, 107, 108, 109, None],
+            [next_uidnumber(self.session) for i in range(8)])
+        self.assertEqual([], self.intervals())
+
+    def test_discard_splits_interval(self):
+        self.assertTrue(discard(self.session, 107))
+        self.assertTrue(discard(self.session, 102))
+        self.assertTrue(discard(self.session, 109))
+        self.assertFalse(discard(self.session, 105))
+        self.assertEqual(
+            [(103, 105), (106, 107), (108, 109)], self.intervals())
+
+    def test_reconciler_scans_incrementally(self):
+        calls = []
+
+        def discover(since=None):
+            calls.append(since)
+            return {103, 108} if since is None else {104}
+
+        reconciler = Reconciler(lambda: self.session, discover=discover)
+        self.assertEqual(2, reconciler.scan())
+        self.assertEqual(1, reconciler.scan())
+        self.assertIsNone(calls[0])
+        self.assertIsNotNone(calls[1])
+        self.assertEqual(
+            [(102, 103), (106, 108), (109, 110)], self.intervals())
+        self.assertEqual(0, reconcile(self.session, {103, 104}))
+
+
+class SeedTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        initialise(self.session)
+        create(self.session)
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, ":memory:")
+
+    @staticmethod
+    def unreachable(since=None):
+        raise OSError("LDAP unreachable")
+
+    def test_no_numbers_until_ldap_consulted(self):
+        self.assertFalse(
+            seed(self.session, 100, 110, discover=self.unreachable))
+        self.assertIsNone(
+            next_uidnumber(self.session, discover=self.unreachable))
+        self.assertEqual(
+            [], self.session.connection().execute(free.select()).fetchall())
+
+        self.assertTrue(seed(self.session, 100, 110, discover=lambda: {100}))
+        self.assertEqual(
+            101, next_uidnumber(self.session, discover=self.unreachable))
+
+    def test_reconciler_waits_for_seed(self):
+        reconciler = Reconciler(
+            lambda: self.session, discover=self.unreachable)
+        self.assertEqual(0, reconciler.scan())
+        self.assertIsNone(reconciler.since)
+
+
+if __name__ == "__main__":
+    unittest.main()
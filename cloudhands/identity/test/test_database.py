@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import configparser
+import sqlite3
+import unittest
+import weakref
+
+from sqlalchemy import inspect
+
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import Touch
+
+from cloudhands.identity.database import create_indexes
+from cloudhands.identity.database import has_table
+from cloudhands.identity.database import ix_resource_touch
+from cloudhands.identity.database import ix_touch_artifact_at
+from cloudhands.identity.database import pragmas
+
+
+class PragmaTests(unittest.TestCase):
+
+    def test_defaults_use_wal(self):
+        self.assertEqual("WAL", pragmas()["journal_mode"])
+        self.assertEqual("NORMAL", pragmas()["synchronous"])
+
+    def test_config_overrides_defaults(self):
+        cfg = configparser.ConfigParser()
+        cfg.read_string("[db.sqlite]\nbusy_timeout = 100\nunknown = 1\n")
+        rv = pragmas(cfg)
+        self.assertEqual("100", rv["busy_timeout"])
+        self.assertNotIn("unknown", rv)
+
+
+class SchemaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        initialise(self.session)
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, ":memory:")
+
+    def test_create_indexes_once(self):
+        indexes = (ix_touch_artifact_at, ix_resource_touch)
+        create_indexes(self.session, indexes)
+        self.assertEqual([], create_indexes(self.session, indexes))
+        for index in indexes:
+            self.assertIn(index.name, {
+                i["name"] for i in inspect(
+                    self.session.connection()).get_indexes(index.table.name)})
+
+    def test_has_table_is_cached(self):
+        cache = weakref.WeakKeyDictionary()
+        self.assertTrue(has_table(self.session, Touch.__table__, cache))
+        self.assertEqual([True], list(cache.values()))
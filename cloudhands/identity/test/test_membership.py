@@ -4,6 +4,7 @@
 import datetime
 import sqlite3
 import unittest
+import unittest.mock
 import uuid
 
 import cloudhands.common
@@ -20,7 +21,9 @@ from cloudhands.common.states import MembershipState
 
 from cloudhands.identity.membership import handle_from_email
 from cloudhands.identity.membership import Acceptance
+from cloudhands.identity.membership import BulkInvitation
 from cloudhands.identity.membership import Invitation
+from cloudhands.identity.membership import registration
 
 
 class MembershipLifecycleTests(unittest.TestCase):
@@ -109,6 +112,92 @@ class InvitationTests(MembershipLifecycleTests):
                 "handle", "Surname", "e.m@il")(self.session), Touch)
 
 
+class BulkInvitationTests(MembershipLifecycleTests):
+
+    def test_only_admins_create_bulk_invites(self):
+        rows = [("someone", "New", "someone@test.org")]
+        self.assertIsNone(
+            BulkInvitation(self.user, self.org, rows)(self.session))
+        self.assertEqual(
+            0, self.session.query(EmailAddress).filter(
+            EmailAddress.value == "someone@test.org").count())
+
+    def test_bulk_invites(self):
+        rows = [
+            ("person{}".format(n), "Surname", "person{}@test.org".format(n))
+            for n in range(5)]
+        report = BulkInvitation(self.admin, self.org, rows)(self.session)
+        self.assertEqual(5, len(report))
+        self.assertTrue(all(i["status"] == "invited" for i in report))
+        for result in report:
+            mship = self.session.query(Membership).filter(
+                Membership.uuid == result["uuid"]).one()
+            self.assertEqual(self.org, mship.organisation)
+            self.assertEqual(
+                ["created", "created"],
+                [i.state.name for i in mship.changes])
+            self.assertEqual(result["handle"], mship.changes[1].actor.handle)
+        self.assertEqual(
+            5, self.session.query(EmailAddress).filter(
+            EmailAddress.value.like("person%@test.org")).count())
+
+    def test_bulk_invite_rows_are_atomic(self):
+        nMemberships = self.session.query(Membership).count()
+        rows = [
+            ("person{}".format(n), "Surname", "person{}@test.org".format(n))
+            for n in range(3)]
+        real = registration
+
+        def fail_second(user, emailAddr, state, at):
+            if emailAddr == "person1@test.org":
+                raise ValueError(emailAddr)
+            return real(user, emailAddr, state, at)
+
+        with unittest.mock.patch(
+            "cloudhands.identity.membership.registration",
+            side_effect=fail_second
+        ):
+            report = BulkInvitation(
+                self.admin, self.org, rows, batch=2)(self.session)
+
+        self.assertEqual(
+            ["invited", "failed", "invited"], [i["status"] for i in report])
+        self.assertEqual(
+            nMemberships + 2, self.session.query(Membership).count())
+        self.assertEqual(
+            0, self.session.query(User).filter(
+            User.handle == "person1").count())
+        self.assertEqual(
+            0, self.session.query(EmailAddress).filter(
+            EmailAddress.value == "person1@test.org").count())
+
+    def test_bulk_invites_reuse_known_users(self):
+        outsider = User(handle="Outsider", uuid=uuid.uuid4().hex)
+        self.session.add(outsider)
+        self.session.commit()
+        nUsers = self.session.query(User).count()
+
+        rows = [("Outsider", "Surname", "outsider@test.org")]
+        report = BulkInvitation(self.admin, self.org, rows)(self.session)
+        self.assertEqual("invited", report[0]["status"])
+        mship = self.session.query(Membership).filter(
+            Membership.uuid == report[0]["uuid"]).one()
+        self.assertEqual(outsider.id, mship.changes[1].actor.id)
+        self.assertEqual(nUsers, self.session.query(User).count())
+
+    def test_bulk_invites_report_existing_people(self):
+        rows = [
+            ("User", "Surname", "user@test.org"),
+            ("person", "Surname", "person@test.org"),
+            ("again", "Surname", "person@test.org"),
+            ("person", "Surname", "person@test.org")]
+        report = BulkInvitation(self.admin, self.org, rows)(self.session)
+        self.assertEqual(
+            ["member", "invited", "conflict", "member"],
+            [i["status"] for i in report])
+        self.assertNotIn("uuid", report[0])
+
+
 class ActivationTests(MembershipLifecycleTests):
 
     def test_typical_add_user(self):
@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import argparse
+from collections import OrderedDict
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import http.client
+import json
+import logging
+import math
+import os.path
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import bcrypt
+
+from pyramid.request import Request
+
+from waitress.server import create_server
+
+import cloudhands.common
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import BcryptedPassword
+from cloudhands.common.schema import CatalogueItem
+from cloudhands.common.schema import Membership
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import PosixUId
+from cloudhands.common.schema import Provider
+from cloudhands.common.schema import Registration
+from cloudhands.common.schema import Subscription
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+from cloudhands.common.states import MembershipState
+from cloudhands.common.states import RegistrationState
+from cloudhands.common.states import SubscriptionState
+
+import cloudhands.web.main
+from cloudhands.web import __version__
+from cloudhands.web.demo import WebFixture
+from cloudhands.web import loaders
+from cloudhands.web.metrics import StatementLog
+from cloudhands.web.tricks import latest_resource
+
+__doc__ = """
+This utility measures the performance of the web portal.
+
+It serves the portal from a temporary database and runs one of these
+scenarios:
+
+threads
+    Reports how many requests per second can be handled as the number
+    of server threads grows.
+
+routes
+    Fills the database with generated data, then drives every GET route
+    in-process. It goes on to create appliances in bulk and to change
+    the state of a batch of them, so that writes are measured too.
+    Reports latency percentiles and requests per second for each route.
+    A large run looks like this::
+
+        cloud-benchmark --scenario routes --orgs 1000 --users 10000 \\
+        --appliances 50000 --touches 20 --output bench.json
+
+queries
+    Fills the database as for `routes`, then counts the SQL statements
+    made by one request to each route. Each route is measured with
+    lazy loading and again with the eager loaders of
+    :py:mod:`cloudhands.web.loaders`.
+
+login
+    Times `POST /login` for a user subscribed to `--subscriptions`
+    providers, each with a token pipe of its own. The pipes are written
+    once with a writer opened and closed for every message, and again
+    with the long-lived writers of :py:mod:`cloudhands.web.pipes`.
+
+latest
+    Finds the newest password of registrations which each have
+    `--history` touches. The lookup is timed once by loading every
+    change and its resources as the portal used to, and again with
+    :py:func:`cloudhands.web.tricks.latest_resource`.
+
+Results may be saved as JSON with the `--output` option so that they
+can be compared between commits.
+"""
+
+DFLT_APPLIANCES = 500
+DFLT_BATCH = 10
+DFLT_HISTORY = 200
+DFLT_NUMBER = 50
+DFLT_ORGS = 10
+DFLT_PATHS = ["/", "/login"]
+DFLT_REQUESTS = 400
+DFLT_SUBSCRIPTIONS = 5
+DFLT_THREADS = [1, 2, 4, 8]
+DFLT_TOUCHES = 20
+DFLT_USERS = 100
+
+
+def percentile(values, q):
+    """
+    Returns the `q` percentile of `values` by the nearest-rank method.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summary(latencies):
+    """
+    Summarises a list of request latencies in seconds.
+    """
+    total = sum(latencies)
+    return OrderedDict([
+        ("requests", len(latencies)),
+        ("p50", percentile(latencies, 50)),
+        ("p95", percentile(latencies, 95)),
+        ("p99", percentile(latencies, 99)),
+        ("rps", len(latencies) / total if total else None),
+    ])
+
+
+def fetch(host, port, paths, number):
+    """
+    Issues `number` GET requests over a single keep-alive connection.
+    Returns the count of responses with a status below 500.
+    """
+    con = http.client.HTTPConnection(host, port)
+    rv = 0
+    try:
+        for n in range(number):
+            con.request("GET", paths[n % len(paths)])
+            rsp = con.getresponse()
+            rsp.read()
+            rv += 1 if rsp.status < 500 else 0
+    finally:
+        con.close()
+    return rv
+
+
+def throughput(app, threads, requests, paths=DFLT_PATHS, host="127.0.0.1"):
+    """
+    Serves `app` from waitress with `threads` worker threads and drives
+    it with twice as many concurrent clients.
+
+    :returns: A tuple of (successful responses, elapsed seconds).
+    """
+    server = create_server(app, host=host, port=0, threads=threads)
+    port = server.effective_port
+    daemon = threading.Thread(target=server.run, daemon=True)
+    daemon.start()
+
+    clients = threads * 2
+    share = max(1, requests // clients)
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            done = sum(pool.map(
+                lambda n: fetch(host, port, paths, share), range(clients)))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.close()
+    return done, elapsed
+
+
+def drive(app, path, number, accept="text/html"):
+    """
+    Issues `number` GET requests for `path` to `app` in-process.
+
+    :returns: A tuple of (latencies, status codes).
+    """
+    latencies = []
+    statuses = set()
+    for n in range(number):
+        request = Request.blank(path, headers={"Accept": accept})
+        start = time.perf_counter()
+        response = request.get_response(app)
+        response.body
+        latencies.append(time.perf_counter() - start)
+        statuses.add(response.status_int)
+    return latencies, statuses
+
+
+def post(app, path, params, number):
+    """
+    Issues `number` form POSTs of `params` to `path` in-process.
+
+    :returns: A tuple of (latencies, status codes).
+    """
+    latencies = []
+    statuses = set()
+    for n in range(number):
+        request = Request.blank(path, POST=params)
+        start = time.perf_counter()
+        response = request.get_response(app)
+        response.body
+        latencies.append(time.perf_counter() - start)
+        statuses.add(response.status_int)
+    return latencies, statuses
+
+
+def send(app, path, body, number):
+    """
+    Issues `number` POSTs of `body` as JSON to `path` in-process.
+
+    :returns: A tuple of (latencies, status codes).
+    """
+    latencies = []
+    statuses = set()
+    for n in range(number):
+        request = Request.blank(
+            path, method="POST", body=json.dumps(body).encode("utf-8"),
+            content_type="application/json",
+            headers={"Accept": "application/json"})
+        start = time.perf_counter()
+        response = request.get_response(app)
+        response.body
+        latencies.append(time.perf_counter() - start)
+        statuses.add(response.status_int)
+    return latencies, statuses
+
+
+def drain(path):
+    """
+    Creates a named pipe at `path` and reads it on a daemon thread for
+    as long as the process runs.
+    """
+    os.mkfifo(path)
+
+    def read():
+        while True:
+            with open(path, "rb") as pipe:
+                while pipe.read(4096):
+                    pass
+
+    threading.Thread(target=read, daemon=True).start()
+    return path
+
+
+def targets(session):
+    """
+    Chooses a sample artifact for each GET route, and a body for each
+    write route. The chosen user is the admin of the first organisation
+    which has appliances.
+
+    :returns: A tuple of (user handle, OrderedDict of route name to path,
+              OrderedDict of route name to path and JSON body).
+    """
+    org = session.query(Organisation).join(Appliance).order_by(
+        Organisation.name).first() or session.query(Organisation).first()
+    mship = session.query(Membership).filter(
+        Membership.organisation_id == org.id).filter(
+        Membership.role == "admin").first()
+    user = mship.changes[0].actor
+    reg = session.query(Registration).join(Touch).join(User).filter(
+        User.id == user.id).first()
+    apps = session.query(Appliance).filter(
+        Appliance.organisation_id == org.id).limit(DFLT_BATCH).all()
+    app = apps[0] if apps else None
+    item = session.query(CatalogueItem).filter(
+        CatalogueItem.organisation == org).first()
+
+    rv = OrderedDict([
+        ("top", "/"),
+        ("login", "/login"),
+        ("organisation", "/organisation/{}".format(org.name)),
+        ("organisation_catalogue",
+            "/organisation/{}/catalogue".format(org.name)),
+        ("membership", "/membership/{}".format(mship.uuid)),
+        ("account", "/account/{}".format(reg.uuid)),
+        ("registration", "/registration/{}".format(reg.uuid)),
+        ("user", "/user/{}".format(user.uuid)),
+        ("metrics", "/metrics"),
+    ])
+    if app is not None:
+        rv["appliance"] = "/appliance/{}".format(app.uuid)
+
+    writes = OrderedDict()
+    if item is not None:
+        writes["organisation_appliances_bulk"] = (
+            "/organisation/{}/appliances/bulk".format(org.name),
+            {"uuid": item.uuid, "count": DFLT_BATCH})
+    if apps:
+        writes["organisation_appliances_transitions"] = (
+            "/organisation/{}/appliances/transitions".format(org.name),
+            {"transitions": [
+                {"uuid": i.uuid, "fsm": "appliance", "name": "pre_stop"}
+                for i in apps]})
+    return user.handle, rv, writes
+
+
+def scale_threads(args, cfg, session):
+    log = logging.getLogger("cloudhands.web.benchmark.scale_threads")
+    rv = OrderedDict()
+    for n in args.scale:
+        app = cloudhands.web.main.wsgi_app(
+            argparse.Namespace(**dict(vars(args), threads=n)), cfg)
+        done, elapsed = throughput(app, n, args.requests, paths=args.paths)
+        rv[str(n)] = OrderedDict([
+            ("requests", done), ("seconds", elapsed), ("rps", done / elapsed)])
+        log.info("{} threads: {:.1f} req/s".format(n, done / elapsed))
+    return rv
+
+
+def seed(args, session):
+    log = logging.getLogger("cloudhands.web.benchmark.seed")
+    start = time.perf_counter()
+    total = sum(WebFixture.create_volume(
+        session, orgs=args.orgs, users=args.users,
+        appliances=args.appliances, touches=args.touches))
+    log.info("Generated {} records in {:.1f}s".format(
+        total, time.perf_counter() - start))
+
+    rv = targets(session)
+    session.close()
+    return rv
+
+
+@contextlib.contextmanager
+def authenticated(handle):
+    """
+    Makes every request appear to come from the user `handle`.
+    """
+    unpatch = cloudhands.web.main.authenticated_userid
+    cloudhands.web.main.authenticated_userid = lambda request=None: handle
+    try:
+        yield handle
+    finally:
+        cloudhands.web.main.authenticated_userid = unpatch
+
+
+def scale_routes(args, cfg, session):
+    log = logging.getLogger("cloudhands.web.benchmark.scale_routes")
+    handle, paths, writes = seed(args, session)
+    app = cloudhands.web.main.wsgi_app(args, cfg)
+    rv = OrderedDict()
+    with authenticated(handle):
+        for name, path in paths.items():
+            latencies, statuses = drive(app, path, args.number)
+            rv[name] = summary(latencies)
+            rv[name]["status"] = sorted(statuses)
+            log.info("{} p95 {:.4f}s".format(name, rv[name]["p95"]))
+        for name, (path, body) in writes.items():
+            latencies, statuses = send(app, path, body, args.number)
+            rv[name] = summary(latencies)
+            rv[name]["status"] = sorted(statuses)
+            log.info("{} p95 {:.4f}s".format(name, rv[name]["p95"]))
+    return rv
+
+
+def count_queries(args, cfg, session):
+    """
+    Counts the SQL statements issued by each route, first with lazy
+    loading and then with the eager loaders.
+    """
+    log = logging.getLogger("cloudhands.web.benchmark.count_queries")
+    handle, paths, writes = seed(args, session)
+    app = cloudhands.web.main.wsgi_app(args, cfg)
+    rv = OrderedDict((name, OrderedDict()) for name in paths)
+    with authenticated(handle):
+        for mode, eager in (("lazy", False), ("eager", True)):
+            loaders.eager = eager
+            for name, path in paths.items():
+                drive(app, path, 1)
+                with StatementLog() as statements:
+                    drive(app, path, 1)
+                rv[name][mode] = len(statements)
+        loaders.eager = True
+    for name, result in rv.items():
+        log.info("{} {lazy} -> {eager} statements".format(name, **result))
+    return rv
+
+
+def seed_login(session, subscriptions, password):
+    """
+    Creates a user who may log in with `password` and who belongs to
+    `subscriptions` organisations, each subscribed to its own provider.
+
+    :returns: A tuple of (user handle, list of provider names).
+    """
+    def state(typ, name):
+        return session.query(typ).filter(typ.name == name).one()
+
+    now = datetime.datetime.utcnow()
+    user = User(handle="benchuser", uuid=uuid.uuid4().hex)
+    reg = Registration(
+        uuid=uuid.uuid4().hex, model=cloudhands.common.__version__)
+    act = Touch(
+        artifact=reg, actor=user, at=now,
+        state=state(RegistrationState, "pre_registration_inetorgperson_cn"))
+    hash = bcrypt.hashpw(password, bcrypt.gensalt(4))
+    objs = [
+        BcryptedPassword(touch=act, value=hash),
+        PosixUId(touch=act, value=user.handle)]
+
+    active = state(MembershipState, "active")
+    maintenance = state(SubscriptionState, "maintenance")
+    names = []
+    for n in range(subscriptions):
+        provider = Provider(
+            name="provider{:02}.example.org".format(n),
+            uuid=uuid.uuid4().hex)
+        org = Organisation(
+            uuid=uuid.uuid4().hex, name="BenchOrg{:02}".format(n))
+        subs = Subscription(
+            uuid=uuid.uuid4().hex, model=cloudhands.common.__version__,
+            organisation=org, provider=provider)
+        mship = Membership(
+            uuid=uuid.uuid4().hex, model=cloudhands.common.__version__,
+            organisation=org, role="user")
+        objs.extend((
+            Touch(artifact=subs, actor=user, state=maintenance, at=now),
+            Touch(artifact=mship, actor=user, state=active, at=now)))
+        names.append(provider.name)
+    session.add_all(objs)
+    session.commit()
+    return user.handle, names
+
+
+def login_pipes(args, cfg, session):
+    """
+    Compares login latency with transient and long-lived pipe writers.
+    """
+    log = logging.getLogger("cloudhands.web.benchmark.login_pipes")
+    password = "BenchPa$$w0rd"
+    handle, names = seed_login(session, args.subscriptions, password)
+    session.close()
+
+    if not cfg.has_section("pipe.tokens"):
+        cfg.add_section("pipe.tokens")
+    root = os.path.dirname(os.path.abspath(args.db))
+    for name in names:
+        cfg["pipe.tokens"][name] = drain(
+            os.path.join(root, "{}.fifo".format(name)))
+
+    app = cloudhands.web.main.wsgi_app(args, cfg)
+    pipes = cloudhands.web.main.PIPES
+    params = {"username": handle, "password": password}
+    rv = OrderedDict()
+    for mode, persistent in (("reopen", False), ("pooled", True)):
+        pipes.close()
+        pipes.persistent = persistent
+        post(app, "/login", params, 1)
+        latencies, statuses = post(app, "/login", params, args.number)
+        rv[mode] = summary(latencies)
+        rv[mode]["status"] = sorted(statuses)
+        log.info("{} writers, {} subscriptions: p95 {:.4f}s".format(
+            mode, len(names), rv[mode]["p95"]))
+    pipes.close()
+    return rv
+
+
+def seed_history(session, registrations, history):
+    """
+    Creates `registrations` registrations, each with `history` touches
+    which carry a new password.
+
+    :returns: A list of registration uuids.
+    """
+    state = session.query(RegistrationState).filter(
+        RegistrationState.name == "user_posixaccount").one()
+    then = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    rv = []
+    for n in range(registrations):
+        user = User(handle="historic{:04}".format(n), uuid=uuid.uuid4().hex)
+        reg = Registration(
+            uuid=uuid.uuid4().hex, model=cloudhands.common.__version__)
+        objs = [
+            BcryptedPassword(touch=Touch(
+                artifact=reg, actor=user, state=state,
+                at=then + datetime.timedelta(seconds=i)),
+                value="hash{}".format(i))
+            for i in range(history)]
+        objs.append(PosixUId(touch=objs[0].touch, value=user.handle))
+        session.add_all(objs)
+        session.commit()
+        rv.append(reg.uuid)
+    return rv
+
+
+def latest_lookup(args, cfg, session):
+    """
+    Compares scanning every change with one indexed query when finding
+    the newest resource of a registration.
+    """
+    log = logging.getLogger("cloudhands.web.benchmark.latest_lookup")
+
+    def scan(reg):
+        return sorted(
+            ((c.at, r) for c in reg.changes for r in c.resources
+            if isinstance(r, BcryptedPassword)),
+            key=lambda x: x[0], reverse=True)[0][1]
+
+    def query(reg):
+        return latest_resource(session, reg, BcryptedPassword)
+
+    uuids = seed_history(session, max(1, args.users // 10), args.history)
+    rv = OrderedDict()
+    for mode, fn in (("scan", scan), ("query", query)):
+        latencies = []
+        n = 0
+        for i in range(args.number):
+            session.expire_all()
+            reg = session.query(Registration).filter(
+                Registration.uuid == uuids[i % len(uuids)]).one()
+            with StatementLog() as statements:
+                start = time.perf_counter()
+                fn(reg)
+                latencies.append(time.perf_counter() - start)
+            n += len(statements)
+        rv[mode] = summary(latencies)
+        rv[mode]["statements"] = n / args.number
+        log.info("{} of {} touches: p95 {:.4f}s".format(
+            mode, args.history, rv[mode]["p95"]))
+    return rv
+
+
+scenarios = OrderedDict([
+    ("threads", scale_threads),
+    ("routes", scale_routes),
+    ("queries", count_queries),
+    ("login", login_pipes),
+    ("latest", latest_lookup),
+])
+
+
+def main(args):
+    logging.basicConfig(
+        level=args.log_level,
+        format="%(asctime)s %(levelname)-7s %(name)s|%(message)s")
+
+    with tempfile.TemporaryDirectory() as td:
+        args.db = args.db or os.path.join(td, "benchmark.sl3")
+        cfg, session = cloudhands.web.main.configure(args)
+        # The routes scenario measures the metrics view too.
+        if not cfg.has_section("metrics"):
+            cfg.add_section("metrics")
+        cfg["metrics"]["enable"] = "true"
+        results = scenarios[args.scenario](args, cfg, session)
+
+    report = OrderedDict([
+        ("version", __version__),
+        ("scenario", args.scenario),
+        ("at", datetime.datetime.utcnow().isoformat()),
+        ("parameters", OrderedDict(
+            (k, getattr(args, k)) for k in (
+                "orgs", "users", "appliances", "touches", "number",
+                "requests", "scale", "subscriptions", "history"))),
+        ("results", results),
+    ])
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=4)
+
+    for name, result in results.items():
+        sys.stdout.write("{:<24} {}\n".format(name, " ".join(
+            "{}={:.4g}".format(k, v) if isinstance(v, float)
+            else "{}={}".format(k, v) for k, v in result.items())))
+    return 0
+
+
+def positive(value):
+    rv = int(value)
+    if rv < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return rv
+
+
+def parser(description=__doc__):
+    rv = cloudhands.web.main.parser(description)
+    rv.formatter_class = argparse.RawDescriptionHelpFormatter
+    rv.set_defaults(db=None)
+    rv.add_argument(
+        "--scenario", choices=list(scenarios.keys()), default="threads",
+        help="Choose the measurement to make [threads]")
+    rv.add_argument(
+        "--output", default=None,
+        help="Set a file path for JSON results")
+    rv.add_argument(
+        "--scale", type=int, nargs="+", default=DFLT_THREADS,
+        help="Set the server thread counts to measure [{}]".format(
+            " ".join(str(i) for i in DFLT_THREADS)))
+    rv.add_argument(
+        "--requests", type=int, default=DFLT_REQUESTS,
+        help="Set the number of requests per measurement [{}]".format(
+            DFLT_REQUESTS))
+    rv.add_argument(
+        "--path", action="append", default=None, dest="paths",
+        help="Add a path to request [{}]".format(", ".join(DFLT_PATHS)))
+    rv.add_argument(
+        "--number", type=positive, default=DFLT_NUMBER,
+        help="Set the number of requests per route [{}]".format(DFLT_NUMBER))
+    rv.add_argument(
+        "--orgs", type=positive, default=DFLT_ORGS,
+        help="Set the number of organisations [{}]".format(DFLT_ORGS))
+    rv.add_argument(
+        "--users", type=positive, default=DFLT_USERS,
+        help="Set the number of users [{}]".format(DFLT_USERS))
+    rv.add_argument(
+        "--appliances", type=int, default=DFLT_APPLIANCES,
+        help="Set the number of appliances [{}]".format(DFLT_APPLIANCES))
+    rv.add_argument(
+        "--subscriptions", type=int, default=DFLT_SUBSCRIPTIONS,
+        help="Set the number of providers for the login user [{}]".format(
+            DFLT_SUBSCRIPTIONS))
+    rv.add_argument(
+        "--history", type=int, default=DFLT_HISTORY,
+        help="Set the number of touches per registration [{}]".format(
+            DFLT_HISTORY))
+    rv.add_argument(
+        "--touches", type=positive, default=DFLT_TOUCHES,
+        help="Set the number of touches per appliance [{}]".format(
+            DFLT_TOUCHES))
+    return rv
+
+
+def run():
+    p = parser()
+    args = p.parse_args()
+    args.paths = args.paths or DFLT_PATHS
+    if args.version:
+        sys.stdout.write(__version__ + "\n")
+        rv = 0
+    else:
+        rv = main(args)
+    sys.exit(rv)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import OrderedDict
+import threading
+import time
+
+__doc__ = """
+In-process caches which are shared by all server threads.
+"""
+
+
+class TTLCache:
+    """
+    A bounded mapping whose entries expire.
+
+    When full, the least recently used entry is evicted. An entry older
+    than `ttl` seconds is treated as missing. All operations are
+    protected by a lock so the cache may be used by many threads.
+
+    :param int maxlen: The maximum number of entries.
+    :param float ttl: The lifetime of an entry in seconds.
+    """
+
+    def __init__(self, maxlen=1024, ttl=300, clock=time.monotonic):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            return entry[1]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self.clock() + self.ttl, value)
+            while len(self._data) > self.maxlen:
+                self._data.popitem(last=False)
+
+    def _lookup(self, key):
+        try:
+            entry = self._data[key]
+        except KeyError:
+            return None
+
+        if entry[0] < self.clock():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_values(self, values):
+        """
+        Removes every entry whose value is in `values`.
+        """
+        with self._lock:
+            for key in [k for k, (t, v) in self._data.items() if v in values]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
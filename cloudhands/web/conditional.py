@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import namedtuple
+import hashlib
+
+from pyramid.httpexceptions import HTTPNotModified
+
+from sqlalchemy import func
+from sqlalchemy import or_
+
+from webob.etag import ETagMatcher
+
+from cloudhands.common.schema import Touch
+
+from cloudhands.web import __version__
+
+__doc__ = """
+Conditional GET for artifact pages.
+
+Every change to an artifact is recorded by a new Touch, and Touch ids
+only increase. A page is versioned by the newest Touch of the artifacts
+it shows: its own artifact, or those of its organisation, and the
+memberships of its user, which decide the organisations and options
+shown. Touches are indexed by artifact, so the version is far cheaper
+to find than the page is to render. Writes to other artifacts, eg: in
+other organisations, leave the version of a page unchanged.
+
+Some things shown on a page, eg: catalogue items, are not recorded by
+Touches. A view must pass a summary of those as salt.
+
+The representation depends on the `Accept` header, so responses carry
+`Vary: Accept`.
+"""
+
+Validator = namedtuple("Validator", ["etag", "modified"])
+
+
+def artifacts(*sources):
+    """
+    Returns an SQL criterion for the Touches of the artifacts given by
+    `sources`. Each source is a sequence of artifact ids, or a query
+    which selects them.
+    """
+    return or_(*(
+        Touch.artifact_id.in_(i) for i in sources
+        if not isinstance(i, (list, tuple)) or i))
+
+
+def touch_validator(session, criterion, *salt):
+    """
+    Computes a validator from the newest Touch which meets `criterion`.
+
+    :param object session: A SQLAlchemy database session.
+    :param criterion:      An SQL criterion for the Touches of the
+                           artifacts shown, as made by
+                           :py:func:`artifacts`.
+    :param salt:           Further values which distinguish one
+                           rendering from another, eg: the user id.
+    :returns: A Validator.
+    """
+    latest, modified = session.query(
+        func.max(Touch.id), func.max(Touch.at)).filter(criterion).one()
+    digest = hashlib.sha1("|".join(
+        str(i) for i in (__version__, latest) + salt).encode("utf-8"))
+    return Validator(digest.hexdigest(), modified)
+
+
+def not_modified(request, validator):
+    """
+    Sets the validator headers of the response to `request`.
+
+    :returns: An HTTPNotModified response if the client already holds
+              this version of the page. Otherwise `None`.
+    """
+    headers = {
+        "ETag": '"{}"'.format(validator.etag),
+        "Cache-Control": "private, no-cache",
+        "Vary": "Accept",
+    }
+    request.response.headers.update(headers)
+    if validator.modified is not None:
+        request.response.last_modified = validator.modified
+
+    matcher = ETagMatcher.parse(request.headers.get("If-None-Match", ""))
+    if validator.etag in matcher:
+        return HTTPNotModified(headers=headers)
+    return None
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import operator
+
+from pyramid.decorator import reify
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from cloudhands.common.schema import Membership
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Registration
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+
+from cloudhands.web.loaders import memberships
+
+__doc__ = """
+What a request knows about its user.
+
+Most pages show the organisations of the user in their nav region, and
+many check whether the user is an admin of one of them. A
+:py:class:`UserContext` loads the memberships and the registration of
+the user the first time they are asked for, and keeps them for the
+rest of the request.
+
+While a request is served, its context is kept in the `info` of its
+database session. :py:func:`privilege` looks there first, so the
+privilege checks of views and models running in the same request share
+the memberships already loaded. The context is dropped from the
+session when the session commits or rolls back, because that may
+change the memberships.
+"""
+
+KEY = "cloudhands.user_context"
+
+
+class UserContext:
+    """
+    The memberships, organisations and registration of `user`, each
+    loaded on first use.
+
+    :param object session:  A SQLALchemy database session.
+    :param object user: A :py:func:`cloudhands.common.schema.User`
+                        object, or `None`.
+    """
+
+    def __init__(self, session, user):
+        self.session = session
+        self.user = user
+
+    @reify
+    def memberships(self):
+        if self.user is None:
+            return []
+        return self.session.query(Membership).join(Touch).join(User).filter(
+            User.id == self.user.id).options(*memberships()).all()
+
+    @reify
+    def organisations(self):
+        """
+        The organisations of the user, sorted by name.
+        """
+        return sorted(
+            {i.organisation for i in self.memberships},
+            key=operator.attrgetter("name"))
+
+    @reify
+    def admin(self):
+        """
+        The admin memberships of the user, by organisation name.
+        """
+        return {
+            i.organisation.name: i for i in self.memberships
+            if i.role == "admin"}
+
+    @reify
+    def registration(self):
+        if self.user is None:
+            return None
+        return self.session.query(Registration).join(Touch).join(User).filter(
+            User.uuid == self.user.uuid).first()
+
+    def privilege(self, name):
+        """
+        Returns the admin membership of the user in the organisation
+        called `name`, or `None`.
+        """
+        return self.admin.get(name, None)
+
+    def bind(self):
+        """
+        Makes this context the one found by :py:func:`privilege` for its
+        session.
+        """
+        if self.user is not None:
+            self.session.info[KEY] = self
+        return self
+
+    def release(self, request=None):
+        if self.session.info.get(KEY, None) is self:
+            del self.session.info[KEY]
+
+
+def privilege(session, user, name):
+    """
+    Returns the admin membership of `user` in the organisation called
+    `name`, or `None`. The memberships of the current request are
+    used if they belong to `user`.
+    """
+    context = session.info.get(KEY, None)
+    if context is not None and context.user is user:
+        return context.privilege(name)
+    return session.query(Membership).join(Organisation).join(
+        Touch).join(User).filter(
+        User.id == user.id).filter(
+        Organisation.name == name).filter(
+        Membership.role == "admin").first()
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def discard(session):
+    session.info.pop(KEY, None)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import namedtuple
+import logging
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from cloudhands.identity.database import tune
+from cloudhands.web.hateoas import Streamed
+
+__doc__ = """
+Database sessions for the web server and the identity processes.
+
+Every request takes its own session, backed by a pool of connections
+to the database file. The session is closed when the request is finished,
+which returns the connection to the pool.
+
+Each process which opens the database tunes it with
+:py:func:`cloudhands.identity.database.bootstrap`. The connections of a
+pool are tuned the same way. A view which fails because the database is
+busy is run again, up to `retries` times as given in the `db.sqlite`
+section of the configuration, eg::
+
+    [db.sqlite]
+    retries = 3
+
+Only views with a safe method are run again, and then only if the
+request session has not yet committed. Some views commit on a GET, eg:
+accepting an invitation. Once they have done so the failure is raised.
+"""
+
+DFLT_POOL = 4
+DFLT_RETRIES = 3
+DFLT_INTERVAL = 0.05
+DFLT_CATCH_UP = 10.0
+
+# Only requests with these methods are re-run on SQLITE_BUSY. Other
+# views may have committed part of their work before the failure.
+SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+Connection = namedtuple("Connection", ["session"])
+
+
+def retries(config=None):
+    if config is not None and config.has_section("db.sqlite"):
+        return config.getint("db.sqlite", "retries", fallback=DFLT_RETRIES)
+    return DFLT_RETRIES
+
+
+def busy(exc):
+    """
+    Returns `True` if `exc` was raised because another process holds a
+    lock on the database (SQLITE_BUSY).
+    """
+    msg = str(exc).lower()
+    return isinstance(exc, OperationalError) and (
+        "database is locked" in msg or "database is busy" in msg)
+
+
+def retrying(fn, attempts=DFLT_RETRIES, interval=DFLT_INTERVAL, undo=None):
+    """
+    Calls `fn` until it no longer fails with SQLITE_BUSY, up to `attempts`
+    times. The wait between attempts doubles each time. The callable
+    `undo`, if given, is invoked before each retry. It returns `False`
+    if the work of the failed attempt cannot be undone, in which case
+    the error is raised.
+    """
+    for n in range(attempts):
+        try:
+            return fn()
+        except OperationalError as e:
+            if not busy(e) or n == attempts - 1:
+                raise
+            if undo is not None and undo() is False:
+                raise
+            time.sleep(interval * 2 ** n)
+
+
+def pooled_sessions(path, size=DFLT_POOL, config=None):
+    """
+    Creates a session factory for the database at `path`.
+
+    :param str path: The path to a SQLite database file.
+    :param int size: The number of pooled connections. This should match
+                     the number of server threads.
+    :param object config: A ConfigParser object with pragma settings.
+    :returns: A SQLAlchemy session factory, or `None` if the database is
+              held in memory. An in-memory database exists only for
+              the lifetime of one connection, so it cannot be pooled.
+    """
+    log = logging.getLogger("cloudhands.web.database.pooled_sessions")
+    if path == ":memory:":
+        return None
+
+    engine = create_engine(
+        "sqlite:///{}".format(path),
+        poolclass=QueuePool, pool_size=size, max_overflow=size,
+        connect_args={"check_same_thread": False})
+    tune(engine, config)
+    log.info("Pooling {} connections to {}".format(size, path))
+    return sessionmaker(bind=engine)
+
+
+def request_session(request):
+    """
+    Returns a new session for the lifetime of `request`.
+
+    This function is registered as a reified request method, so the
+    session is created on first use and shared by every call
+    made during the request.
+    """
+    session = request.registry.settings["sessions"]()
+
+    def committed(session):
+        session.info["committed"] = True
+
+    event.listen(session, "after_commit", committed)
+
+    def release(request):
+        if getattr(request, "exception", None) is not None:
+            session.rollback()
+        # A streamed body is encoded after the request has finished.
+        # Tweens may have wrapped it, eg: to count the bytes sent.
+        response = request.__dict__.get("response", None)
+        body = getattr(response, "app_iter", None)
+        while body is not None and not isinstance(body, Streamed):
+            body = getattr(body, "app_iter", None)
+        if body is not None:
+            body.on_close(session.close)
+        else:
+            session.close()
+
+    request.add_finished_callback(release)
+    return session
+
+
+def busy_retry_tween_factory(handler, registry):
+    """
+    Re-runs a request whose view failed with SQLITE_BUSY. The request
+    session is rolled back before each new attempt.
+
+    Only safe methods are retried. A POST may commit several times, so
+    running it again could duplicate the records it made before the
+    failure. For the same reason a GET is not retried once its session
+    has committed.
+    """
+    attempts = registry.settings.get("db.retries", DFLT_RETRIES)
+
+    def busy_retry_tween(request):
+        if request.method not in SAFE_METHODS:
+            return handler(request)
+
+        def undo():
+            # Only roll back a session the request has already created.
+            session = request.__dict__.get("db_session", None)
+            if session is None:
+                return True
+            if session.info.get("committed", False):
+                return False
+            session.rollback()
+            return True
+
+        return retrying(
+            lambda: handler(request), attempts=attempts, undo=undo)
+
+    return busy_retry_tween
+
+
+class CatchUp:
+    """
+    Calls each of `tasks` with a new session every `interval` seconds,
+    in a background thread.
+
+    Tables which this process keeps in step with its own commits use
+    this to follow the commits of other processes too. Each task is
+    responsible for committing its session.
+
+    :param sessions: A SQLAlchemy session factory.
+    :param tasks: A sequence of callables which take a session.
+    :param float interval: Seconds between rounds.
+    """
+
+    def __init__(self, sessions, tasks, interval=DFLT_CATCH_UP):
+        self.sessions = sessions
+        self.tasks = list(tasks)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="cloudhands.web.database.catch_up",
+                daemon=True)
+            self.thread.start()
+        return self
+
+    def step(self):
+        log = logging.getLogger("cloudhands.web.database.catch_up")
+        for task in self.tasks:
+            session = self.sessions()
+            try:
+                task(session)
+            except Exception as e:
+                session.rollback()
+                log.warning(e)
+            finally:
+                session.close()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.step()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import namedtuple
+
+from pyramid.httpexceptions import HTTPBadRequest
+
+from sqlalchemy import Index
+
+from cloudhands.common.schema import Touch
+
+from cloudhands.identity.database import create_indexes
+from cloudhands.web.paging import timestamp
+
+__doc__ = """
+Delta mode for pages which clients poll.
+
+A request with a `since` parameter asks only for what has changed. The
+value is either the id of the last Touch the client saw, or a timestamp
+in ISO format. A page in delta mode holds just the facets of artifacts
+with a newer Touch, and a tombstone for each of those which has been
+deleted.
+
+Every page gives the id of the newest Touch it reflects, so that the
+client knows what to send as `since` next time.
+
+Touch ids are a primary key, and Touch times are indexed. The index is
+declared on the Touch table, so new databases have it; for existing
+ones :py:func:`create` adds it. So a poll where nothing has changed
+costs one indexed query whichever form of `since` is used.
+
+The index on (artifact, time) from :py:mod:`cloudhands.identity.database`
+does not make this one redundant. It serves lookups within one artifact,
+but a range of times across all artifacts, as a timestamp `since` or
+the newest Touches of the front page need, cannot use it.
+"""
+
+# Appliances in these states are reported as tombstones.
+DELETED = ("deleted",)
+
+Since = namedtuple("Since", ["touch_id", "at"])
+
+ix_touch_at = Index("ix_touch_at", Touch.__table__.c.at)
+
+
+def since(request):
+    """
+    Returns the Since value of the `since` parameter in `request`, or
+    `None` if there is none.
+    """
+    value = request.params.get("since", None)
+    if not value:
+        return None
+    try:
+        return Since(int(value), None)
+    except ValueError:
+        pass
+    try:
+        return Since(None, timestamp(value))
+    except ValueError:
+        raise HTTPBadRequest("Bad value for since")
+
+
+def newer(value):
+    """
+    Returns an SQL criterion for the Touches later than `value`.
+    """
+    if value.touch_id is not None:
+        return Touch.id > value.touch_id
+    else:
+        return Touch.at > value.at
+
+
+def create(session):
+    """
+    Creates the index on Touch times if it is missing.
+
+    :param object session:  A SQLALchemy database session.
+    :returns: The session.
+    """
+    create_indexes(session, (ix_touch_at,))
+    session.commit()
+    return session
@@ -19,12 +19,14 @@ from cloudhands.common.connectors import Registry
 from cloudhands.common.discovery import providers
 from cloudhands.common.discovery import settings
 
+from cloudhands.common.schema import Appliance
 from cloudhands.common.schema import Archive
 from cloudhands.common.schema import CatalogueItem
 from cloudhands.common.schema import Component
 from cloudhands.common.schema import Directory
 from cloudhands.common.schema import EmailAddress
 from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import Label
 from cloudhands.common.schema import Membership
 from cloudhands.common.schema import Organisation
 from cloudhands.common.schema import PosixUId
@@ -36,6 +38,7 @@ from cloudhands.common.schema import Subscription
 from cloudhands.common.schema import Touch
 from cloudhands.common.schema import User
 
+from cloudhands.common.states import ApplianceState
 from cloudhands.common.states import MembershipState
 from cloudhands.common.states import RegistrationState
 from cloudhands.common.states import SubscriptionState
@@ -335,6 +338,103 @@ class WebFixture(object):
                     finally:
                         session.flush()
 
+    @staticmethod
+    def create_volume(
+        session, orgs=10, users=100, appliances=500, touches=20, batch=1000
+    ):
+        """
+        Generates a synthetic data set for load testing.
+
+        Every user has a valid registration and is a member of one
+        organisation. The first member of each organisation is its admin.
+        Appliances are shared evenly among the organisations. Each one
+        has a label and a history of `touches` state changes.
+
+        Yields the number of records committed by each batch. A batch
+        which fails to commit raises its exception.
+        """
+        if orgs < 1 or users < 1:
+            raise ValueError("At least one organisation and one user needed")
+
+        valid = session.query(RegistrationState).filter(
+            RegistrationState.name == "valid").one()
+        active = session.query(MembershipState).filter(
+            MembershipState.name == "active").one()
+        names = [
+            "configuring", "pre_provision", "provisioning", "pre_operational",
+            "operational", "pre_start", "running", "pre_stop", "stopped"]
+        lifecycle = sorted(
+            session.query(ApplianceState).filter(
+                ApplianceState.name.in_(names)).all(),
+            key=lambda i: names.index(i.name))
+
+        def commit(n):
+            session.commit()
+            return n
+
+        start = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=appliances * touches)
+
+        organisations = [
+            Organisation(uuid=uuid.uuid4().hex, name="bench{:05}".format(n))
+            for n in range(orgs)]
+        for n, org in enumerate(organisations):
+            session.add_all((
+                org,
+                CatalogueItem(
+                    name="bench_vm_{:05}".format(n),
+                    description="Headless VM for load testing",
+                    note="<p>Generated for load testing.</p>",
+                    logo="headless", natrouted=False,
+                    organisation=org, uuid=uuid.uuid4().hex),
+            ))
+        yield commit(orgs)
+
+        admins = []
+        for n in range(users):
+            user = User(handle="user{:06}".format(n), uuid=uuid.uuid4().hex)
+            reg = Registration(
+                uuid=uuid.uuid4().hex, model=cloudhands.common.__version__)
+            act = Touch(artifact=reg, actor=user, state=valid, at=start)
+            session.add_all((
+                EmailAddress(
+                    touch=act, value="{}@example.org".format(user.handle)),
+                PosixUId(touch=act, value=user.handle),
+            ))
+            mship = Membership(
+                uuid=uuid.uuid4().hex,
+                model=cloudhands.common.__version__,
+                organisation=organisations[n % orgs],
+                role="admin" if n < orgs else "user")
+            session.add(Touch(
+                artifact=mship, actor=user, state=active, at=start))
+            if n < orgs:
+                admins.append(user)
+            if n % batch == batch - 1:
+                yield commit(batch)
+        yield commit(users % batch)
+
+        for n in range(appliances):
+            actor = admins[n % len(admins)]
+            app = Appliance(
+                uuid=uuid.uuid4().hex,
+                model=cloudhands.common.__version__,
+                organisation=organisations[n % orgs])
+            for t in range(touches):
+                at = start + datetime.timedelta(seconds=n * touches + t)
+                act = Touch(
+                    artifact=app, actor=actor,
+                    state=lifecycle[t % len(lifecycle)], at=at)
+                if t == 0:
+                    session.add(Label(
+                        name="app{:07}".format(n),
+                        description="Appliance for load testing", touch=act))
+                else:
+                    session.add(act)
+            if n % batch == batch - 1:
+                yield commit(batch * touches)
+        yield commit((appliances % batch) * touches)
+
 
 def main(args):
     logging.basicConfig(
@@ -407,7 +507,8 @@ def main(args):
 
     app = cloudhands.web.main.wsgi_app(args, cfg)
     cloudhands.web.main.serve(
-        app, host=platform.node(), port=args.port, url_scheme="http")
+        app, host=platform.node(), port=args.port, threads=args.threads,
+        url_scheme="http")
     return 0
 
 
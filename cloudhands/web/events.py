@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import defaultdict
+from collections import deque
+from collections import namedtuple
+import json
+import logging
+import queue
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import State
+from cloudhands.common.schema import Touch
+
+__doc__ = """
+Server-sent events for appliance state changes.
+
+A single :py:class:`EventBroker` thread looks for new appliance Touches
+and hands each one to the subscribers of its organisation. All open
+streams share that one query, however many there are.
+
+The broker polls at a fixed interval so that it sees changes committed
+by other processes. A commit in this process wakes it at once.
+
+Each open stream occupies a server thread. The number of streams is
+capped by :py:func:`stream_limit` at half the server threads, so pages
+are still served while every stream is open. Each stream ends after
+`lifetime` seconds. Browsers reconnect by themselves and send the id of
+the last event they saw, so nothing is lost in between.
+"""
+
+DFLT_INTERVAL = 2.0
+DFLT_HEARTBEAT = 15.0
+DFLT_LIFETIME = 300.0
+DFLT_STREAMS = 16
+DFLT_BACKLOG = 1024
+
+Change = namedtuple("Change", ["id", "at", "state", "uuid", "organisation"])
+
+
+def stream_limit(threads):
+    """
+    Returns the number of event streams allowed in a server with
+    `threads` threads.
+    """
+    return min(DFLT_STREAMS, threads // 2)
+
+
+class Subscription:
+
+    def __init__(self, organisation, maxsize=256):
+        self.organisation = organisation
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.lagged = False
+
+    def put(self, change):
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            # A slow reader is dropped rather than allowed to hold memory.
+            self.lagged = True
+
+
+class EventBroker:
+    """
+    Detects appliance state changes and distributes them.
+
+    :param sessions: A SQLAlchemy session factory.
+    :param float interval: Seconds between polls of the database.
+    :param int streams: The maximum number of subscribers.
+    """
+
+    def __init__(
+        self, sessions, interval=DFLT_INTERVAL, streams=DFLT_STREAMS,
+        backlog=DFLT_BACKLOG
+    ):
+        self.sessions = sessions
+        self.interval = interval
+        self.streams = streams
+        self.recent = deque(maxlen=backlog)
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.latest = None
+        self.thread = None
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(i) for i in self.subscribers.values())
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="cloudhands.web.events",
+                    daemon=True)
+                self.thread.start()
+
+    def subscribe(self, organisation, lastId=None):
+        """
+        Registers interest in the appliances of `organisation`.
+
+        :param int lastId: The id of the last event seen by the client.
+                           Any later events still held are replayed.
+        :returns: A Subscription, or `None` if there are too many already.
+        """
+        sub = Subscription(organisation)
+        with self.lock:
+            if sum(len(i) for i in self.subscribers.values()) >= self.streams:
+                return None
+            self.subscribers[organisation].add(sub)
+            if lastId is not None:
+                for change in self.recent:
+                    if (change.id > lastId and
+                            change.organisation == organisation):
+                        sub.put(change)
+        self.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            subs = self.subscribers.get(sub.organisation, set())
+            subs.discard(sub)
+            if not subs:
+                self.subscribers.pop(sub.organisation, None)
+
+    def poll(self, session):
+        """
+        Returns a list of the appliance Touches since the last poll.
+        """
+        if self.latest is None:
+            self.latest = session.query(func.max(Touch.id)).scalar() or 0
+            return []
+
+        rv = [
+            Change(*row) for row in session.query(
+                Touch.id, Touch.at, State.name, Appliance.uuid,
+                Organisation.name).join(Touch.state).join(
+                Appliance, Touch.artifact_id == Appliance.id).join(
+                Organisation, Appliance.organisation_id == Organisation.id
+            ).filter(Touch.id > self.latest).order_by(Touch.id).all()]
+        if rv:
+            self.latest = rv[-1].id
+        return rv
+
+    def publish(self, changes):
+        with self.lock:
+            for change in changes:
+                self.recent.append(change)
+                for sub in self.subscribers.get(change.organisation, ()):
+                    sub.put(change)
+
+    def run(self):
+        log = logging.getLogger("cloudhands.web.events.broker")
+        while True:
+            session = self.sessions()
+            try:
+                self.publish(self.poll(session))
+            except Exception as e:
+                log.warning(e)
+            finally:
+                session.close()
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+
+_brokers = weakref.WeakSet()
+
+
+@event.listens_for(Session, "after_flush")
+def note_appliance_touches(session, context):
+    if any(
+        isinstance(i, Touch) and isinstance(i.artifact, Appliance)
+        for i in session.new
+    ):
+        session.info["cloudhands.events"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def wake_brokers(session):
+    if session.info.pop("cloudhands.events", False):
+        for broker in list(_brokers):
+            broker.wake.set()
+
+
+def register(broker):
+    """
+    Arranges for `broker` to be woken by commits in this process.
+    """
+    _brokers.add(broker)
+    return broker
+
+
+def frame(change):
+    data = json.dumps({
+        "uuid": change.uuid,
+        "state": change.state,
+        "at": str(change.at),
+    })
+    return "id: {}\nevent: touch\ndata: {}\n\n".format(
+        change.id, data).encode("utf-8")
+
+
+class EventStream:
+    """
+    The body of an event stream for the subscription `sub`.
+
+    The WSGI server calls :py:meth:`close` when the response is done or
+    the client goes away, which ends the subscription.
+    """
+
+    def __init__(
+        self, broker, sub, heartbeat=DFLT_HEARTBEAT, lifetime=DFLT_LIFETIME
+    ):
+        self.broker = broker
+        self.sub = sub
+        self.heartbeat = heartbeat
+        self.lifetime = lifetime
+
+    def __iter__(self):
+        end = time.monotonic() + self.lifetime
+        yield "retry: {}\n\n".format(
+            int(self.broker.interval * 1000)).encode("utf-8")
+        while not self.sub.lagged:
+            timeout = min(self.heartbeat, end - time.monotonic())
+            if timeout <= 0:
+                break
+            try:
+                yield frame(self.sub.queue.get(timeout=timeout))
+            except queue.Empty:
+                yield b": keep-alive\n\n"
+
+    def close(self):
+        self.broker.unsubscribe(self.sub)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import defaultdict
+from collections import deque
+from collections import namedtuple
+import logging
+import threading
+import weakref
+
+from sqlalchemy import and_
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import desc
+from sqlalchemy import event
+from sqlalchemy import Index
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import Session
+
+from cloudhands.common.schema import Touch
+
+from cloudhands.identity.database import create_indexes
+from cloudhands.identity.database import has_table
+
+__doc__ = """
+An activity feed for each user, drawn from their organisations.
+
+A Touch does not know the organisation of its artifact, so Touches
+cannot be listed by organisation without joining every artifact type.
+This module keeps an `activity` table with one row for each Touch on
+an artifact which belongs to an organisation. Rows are written in the
+same flush as their Touch, and are indexed on (organisation, time).
+
+Other processes, eg: the identity and burst controllers, add Touches
+without this module to record them. :py:func:`catch_up` records any
+Touches which have no activity yet. The `activity_mark` table holds the id
+of the newest Touch it has looked at. The web server runs it
+periodically, and :py:func:`create` runs it at start up.
+
+Pages of the feed are found by keyset paging on the index. The first
+page, which is what most requests want, may instead be served from a
+:py:class:`Rings` object. It holds the most recent entries of each
+organisation in memory. The rings of a process are given the commits
+made in that process. When :py:func:`catch_up` finds an entry which
+the rings of an organisation lack, they are primed again from the
+database. So the rings may lag the commits of other processes by one
+round of catch up.
+"""
+
+DFLT_BATCH = 1000
+DFLT_RING = 64
+
+metadata = MetaData()
+
+activity = Table(
+    "activity", metadata,
+    Column("touch_id", Integer, primary_key=True, autoincrement=False),
+    Column("organisation_id", Integer, nullable=False),
+    Column("organisation", String(64), nullable=True),
+    Column("at", DateTime, nullable=False),
+    Column("typ", String(32), nullable=False),
+    Column("uuid", String(32), nullable=False),
+    Column("state", String(32), nullable=True),
+    Column("actor", String(64), nullable=True),
+    Column("actor_uuid", String(32), nullable=True),
+    Index("ix_activity_org_at", "organisation_id", "at"),
+)
+
+mark = Table(
+    "activity_mark", metadata,
+    Column("touch_id", Integer, nullable=False),
+)
+
+Entry = namedtuple(
+    "Entry", [
+        "touch_id", "organisation_id", "organisation", "at", "typ", "uuid",
+        "state", "actor", "actor_uuid"])
+
+_present = weakref.WeakKeyDictionary()
+_rings = weakref.WeakSet()
+
+
+def entry(touch):
+    """
+    Returns the feed Entry for `touch`, or `None` if its artifact does
+    not belong to an organisation.
+    """
+    org = getattr(touch.artifact, "organisation", None)
+    if org is None:
+        return None
+    actor = touch.actor
+    return Entry(
+        touch.id, org.id, org.name, touch.at,
+        type(touch.artifact).__name__.lower(), touch.artifact.uuid,
+        getattr(touch.state, "name", None),
+        getattr(actor, "handle", None), getattr(actor, "uuid", None))
+
+
+def key(item):
+    """
+    The sort key of the feed, newest first when reversed.
+    """
+    return (item.at, item.touch_id)
+
+
+class Rings:
+    """
+    The latest entries of each organisation, held in memory.
+
+    A ring is primed from the database the first time its organisation
+    is asked for. After that it is kept up to date by the commits of
+    this process.
+
+    :param int size: The number of entries held for each organisation.
+    """
+
+    def __init__(self, size=DFLT_RING):
+        self.size = size
+        self.rings = defaultdict(lambda: deque(maxlen=size))
+        self.primed = set()
+        self.lock = threading.Lock()
+
+    def add(self, entries):
+        with self.lock:
+            for item in sorted(entries, key=key):
+                if item.organisation_id in self.primed:
+                    self.rings[item.organisation_id].append(item)
+
+    def prime(self, org_id, entries):
+        with self.lock:
+            ring = self.rings[org_id]
+            ring.clear()
+            ring.extend(sorted(entries, key=key))
+            self.primed.add(org_id)
+
+    def refresh(self, entries):
+        """
+        Drops the rings which lack any of `entries` and would hold
+        them, so that they are primed again when next asked for.
+        """
+        with self.lock:
+            for item in entries:
+                org_id = item.organisation_id
+                if org_id not in self.primed:
+                    continue
+                ring = self.rings[org_id]
+                if item.touch_id in {i.touch_id for i in ring}:
+                    continue
+                if len(ring) == ring.maxlen and key(item) < key(ring[0]):
+                    continue
+                self.primed.discard(org_id)
+
+    def missing(self, org_ids):
+        with self.lock:
+            return [i for i in org_ids if i not in self.primed]
+
+    def page(self, org_ids, limit):
+        """
+        Returns the newest `limit` entries of the organisations in
+        `org_ids`, or `None` if the rings cannot tell.
+        """
+        if limit > self.size:
+            return None
+        with self.lock:
+            if any(i not in self.primed for i in org_ids):
+                return None
+            merged = [e for i in set(org_ids) for e in self.rings[i]]
+        return sorted(merged, key=key, reverse=True)[:limit]
+
+
+def register(rings):
+    """
+    Arranges for `rings` to receive the entries committed in this
+    process.
+    """
+    _rings.add(rings)
+    return rings
+
+
+def available(session):
+    """
+    Returns `True` if the activity table exists in the database behind
+    `session`.
+    """
+    return has_table(session, activity, _present)
+
+
+@event.listens_for(Session, "after_flush")
+def record(session, context):
+    touches = [i for i in session.new if isinstance(i, Touch)]
+    if not touches or not available(session):
+        return
+    entries = [i for i in (entry(t) for t in touches) if i is not None]
+    if entries:
+        session.connection().execute(
+            activity.insert(), [i._asdict() for i in entries])
+        session.info.setdefault("cloudhands.feed", []).extend(entries)
+
+
+@event.listens_for(Session, "after_commit")
+def publish(session):
+    entries = session.info.pop("cloudhands.feed", None)
+    if entries:
+        for rings in list(_rings):
+            rings.add(entries)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard(session):
+    session.info.pop("cloudhands.feed", None)
+
+
+def recent(session, org_ids, limit, after=None):
+    """
+    Returns the feed entries of the organisations in `org_ids`, newest
+    first.
+
+    :param int limit: The greatest number of entries to return.
+    :param tuple after: The (timestamp, touch id) of the last entry on
+                        the previous page.
+    """
+    if not org_ids:
+        return []
+    query = select([activity]).where(
+        activity.c.organisation_id.in_(list(org_ids)))
+    if after is not None:
+        at, touch_id = after
+        query = query.where(or_(
+            activity.c.at < at,
+            and_(activity.c.at == at, activity.c.touch_id < touch_id)))
+    query = query.order_by(
+        desc(activity.c.at), desc(activity.c.touch_id)).limit(limit)
+    return [
+        Entry(**{k: r[k] for k in Entry._fields})
+        for r in session.connection().execute(query)]
+
+
+def changes(session, org_ids, since, upto):
+    """
+    Returns every feed entry of the organisations in `org_ids` which is
+    newer than `since` and no newer than the Touch with id `upto`,
+    newest first.
+
+    :param object since: A :py:class:`cloudhands.web.delta.Since` value.
+    """
+    if not org_ids or upto is None:
+        return []
+    if since.touch_id is not None:
+        newer = activity.c.touch_id > since.touch_id
+    else:
+        newer = activity.c.at > since.at
+    query = select([activity]).where(
+        activity.c.organisation_id.in_(list(org_ids))).where(
+        newer).where(activity.c.touch_id <= upto).order_by(
+        desc(activity.c.at), desc(activity.c.touch_id))
+    return [
+        Entry(**{k: r[k] for k in Entry._fields})
+        for r in session.connection().execute(query)]
+
+
+def first_page(session, rings, org_ids, limit):
+    """
+    Returns the newest `limit` entries, from `rings` where it can.
+    """
+    if rings is None or limit > rings.size:
+        return recent(session, org_ids, limit)
+    for org_id in rings.missing(org_ids):
+        rings.prime(org_id, recent(session, [org_id], rings.size))
+    rv = rings.page(org_ids, limit)
+    return recent(session, org_ids, limit) if rv is None else rv
+
+
+def history(session, lo, batch):
+    """
+    Yields the Touches with ids above `lo` in batches, oldest first.
+    The session is cleared between batches.
+    """
+    while True:
+        touches = session.query(Touch).options(
+            joinedload(Touch.artifact), joinedload(Touch.state),
+            joinedload(Touch.actor)).filter(
+            Touch.id > lo).order_by(Touch.id).limit(batch).all()
+        if not touches:
+            break
+        yield touches
+        lo = touches[-1].id
+        session.expunge_all()
+
+
+def rebuild(session, batch=DFLT_BATCH):
+    """
+    Refills the activity table from the history of every artifact.
+    """
+    log = logging.getLogger("cloudhands.web.feed.rebuild")
+    connection = session.connection()
+    connection.execute(activity.delete())
+    connection.execute(mark.delete())
+    lo = 0
+    n = 0
+    for touches in history(session, lo, batch):
+        entries = [i for i in (entry(t) for t in touches) if i is not None]
+        if entries:
+            connection.execute(
+                activity.insert(), [i._asdict() for i in entries])
+        n += len(entries)
+        lo = touches[-1].id
+    connection.execute(mark.insert(), {"touch_id": lo})
+    session.commit()
+    log.info("Recorded {} activities".format(n))
+    return n
+
+
+def catch_up(session, batch=DFLT_BATCH):
+    """
+    Records the Touches newer than the mark which have no activity yet,
+    moves the mark up and commits. The registered rings are refreshed
+    with every entry looked at.
+
+    :returns: The number of entries recorded.
+    """
+    log = logging.getLogger("cloudhands.web.feed.catch_up")
+    if not available(session):
+        return 0
+    connection = session.connection()
+    lo = hi = connection.execute(select([mark.c.touch_id])).scalar() or 0
+    seen = []
+    n = 0
+    for touches in history(session, lo, batch):
+        entries = [i for i in (entry(t) for t in touches) if i is not None]
+        held = {r["touch_id"] for r in connection.execute(
+            select([activity.c.touch_id]).where(
+                activity.c.touch_id > hi).where(
+                activity.c.touch_id <= touches[-1].id))}
+        new = [i for i in entries if i.touch_id not in held]
+        if new:
+            connection.execute(activity.insert(), [i._asdict() for i in new])
+        seen.extend(entries)
+        n += len(new)
+        hi = touches[-1].id
+    if hi > lo:
+        connection.execute(mark.update().values(touch_id=hi))
+    session.commit()
+    for rings in list(_rings):
+        rings.refresh(seen)
+    if n:
+        log.info("Caught up with {} activities".format(n))
+    return n
+
+
+def create(session):
+    """
+    Creates the activity table if need be. Fills it if empty, otherwise
+    catches up with the Touches made since it was last used.
+
+    :param object session:  A SQLALchemy database session.
+    :returns: The session.
+    """
+    connection = session.connection()
+    metadata.create_all(connection)
+    create_indexes(session, activity.indexes)
+    _present[session.get_bind()] = True
+    if connection.execute(select([mark.c.touch_id])).first():
+        catch_up(session)
+    else:
+        rebuild(session)
+    return session
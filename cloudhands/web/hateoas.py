@@ -4,9 +4,12 @@
 from collections import OrderedDict
 from collections import namedtuple
 import functools
+import json
 from math import ceil
 from math import log10
 
+from pyramid.renderers import JSON
+
 from cloudhands.common.types import NamedDict
 from cloudhands.common.types import NamedList
 
@@ -82,3 +85,122 @@ class PageBase:
 
             yield (region.name,
                    OrderedDict([(facet.name, facet) for facet in region]))
+
+
+class Streamed:
+    """
+    A response body which is encoded as the server sends it.
+
+    Callables passed to :py:meth:`on_close` are called once the server
+    has finished with the body. They let the resources which encoding
+    needs, eg: a database session, outlive the request.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.callbacks = []
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def on_close(self, callback):
+        self.callbacks.append(callback)
+
+    def close(self):
+        try:
+            close = getattr(self.chunks, "close", None)
+            if close is not None:
+                close()
+        finally:
+            callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback()
+
+
+class HateoasJSON(JSON):
+    """
+    A JSON renderer for page regions.
+
+    The layout is chosen by content negotiation. A client may send an
+    `indent` parameter with the media type, eg::
+
+        Accept: application/json; indent=0
+
+    An indent of zero gives compact output with no whitespace.
+    Otherwise the renderer's own `indent` applies.
+
+    Payloads with more than `threshold` facets are encoded in chunks of
+    about `chunk` bytes while the server sends them. The response body
+    is a :py:class:`Streamed` generator, so neither the whole document
+    nor the list of its chunks is held in memory. Adapters may still
+    read from the database as they encode, because the request session
+    is kept until the server closes the body.
+    """
+
+    def __init__(self, indent=4, threshold=64, chunk=65536, **kwargs):
+        super().__init__(**kwargs)
+        self.indent = indent
+        self.threshold = threshold
+        self.chunk = chunk
+
+    @staticmethod
+    def negotiate(request, default=None):
+        """
+        Returns the indent requested by the client, or `default`.
+        """
+        accept = request.headers.get("Accept", "") if request else ""
+        for mediaRange in accept.split(","):
+            typ, *params = [i.strip() for i in mediaRange.split(";")]
+            if typ not in ("application/json", "application/*"):
+                continue
+            for param in params:
+                key, _, val = param.partition("=")
+                if key.strip() == "indent":
+                    try:
+                        return max(0, int(val))
+                    except ValueError:
+                        return default
+        return default
+
+    @staticmethod
+    def facets(value):
+        try:
+            return sum(
+                len(i) for i in value.values() if isinstance(i, dict))
+        except AttributeError:
+            return 0
+
+    def chunks(self, encoder, value):
+        buf = []
+        size = 0
+        for fragment in encoder.iterencode(value):
+            buf.append(fragment)
+            size += len(fragment)
+            if size >= self.chunk:
+                yield "".join(buf).encode("utf-8")
+                buf = []
+                size = 0
+        if buf:
+            yield "".join(buf).encode("utf-8")
+
+    def __call__(self, info):
+        def _render(value, system):
+            request = system.get("request")
+            indent = self.negotiate(request, self.indent) or None
+            encoder = json.JSONEncoder(
+                default=self._make_default(request),
+                indent=indent,
+                separators=(",", ":") if indent is None else (",", ": "))
+
+            response = getattr(request, "response", None)
+            if response is not None:
+                if response.content_type == response.default_content_type:
+                    response.content_type = "application/json"
+
+            if response is None or self.facets(value) <= self.threshold:
+                return encoder.encode(value)
+
+            response.app_iter = Streamed(self.chunks(encoder, value))
+            return None
+
+        return _render
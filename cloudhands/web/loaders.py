@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm import with_polymorphic
+
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Membership
+from cloudhands.common.schema import Registration
+from cloudhands.common.schema import Touch
+
+__doc__ = """
+Loader options for the object graphs which pages present.
+
+The presenters in :py:mod:`cloudhands.web.model` reach through the
+relationships of each artifact: its changes, their states, actors and
+resources, and its organisation. Loaded lazily, every step is a
+separate SELECT for every object. Loaded with these options, a graph
+costs a fixed number of queries however many objects it holds.
+
+Many-to-one relationships are joined into the parent query. Collections
+are loaded by one further query each, so as not to multiply rows.
+
+Use :py:func:`graph` to get the options for a type::
+
+    con.session.query(Appliance).options(*graph(Appliance))
+
+Resources of several types are best fetched in one query with the
+columns of every type joined in. Use :py:func:`polymorphic` for the
+entity to query::
+
+    con.session.query(polymorphic(Resource, (EmailAddress, PublicKey)))
+
+Setting `eager` to `False` turns every graph into lazy loading. This
+lets the benchmark compare the two.
+"""
+
+eager = True
+
+
+def changes(relation):
+    """
+    Options for the changes of an artifact, reached by `relation`.
+    """
+    return (
+        subqueryload(relation).joinedload(Touch.state),
+        subqueryload(relation).joinedload(Touch.actor),
+        subqueryload(relation).subqueryload(Touch.resources),
+    )
+
+
+_graphs = {
+    # ItemRegion.present_appliance
+    Appliance: changes(Appliance.changes) + (
+        joinedload(Appliance.organisation),),
+    # OptionRegion.present_membership
+    Membership: changes(Membership.changes) + (
+        joinedload(Membership.organisation),),
+    # NavRegion.present_registration and ItemRegion.present_registration
+    Registration: changes(Registration.changes),
+    # ItemRegion.present_touch
+    Touch: (
+        joinedload(Touch.state),
+        joinedload(Touch.actor),
+        joinedload(Touch.artifact),
+        subqueryload(Touch.resources),
+    ),
+}
+
+# Memberships listed only for their organisations in the nav region.
+nav = (joinedload(Membership.organisation),)
+
+
+def graph(typ):
+    """
+    Returns a tuple of loader options for the presentation of `typ`.
+    """
+    return _graphs.get(typ, ()) if eager else ()
+
+
+def memberships():
+    """
+    Returns loader options for memberships shown in the nav region.
+    """
+    return nav if eager else ()
+
+
+def polymorphic(typ, classes="*"):
+    """
+    Returns an entity for querying `typ` which loads the columns of
+    the subclasses in `classes` along with those of `typ`.
+    """
+    return with_polymorphic(typ, classes) if eager else typ
@@ -2,10 +2,12 @@
 #   encoding: UTF-8
 
 import argparse
+from collections import defaultdict
+import csv
 import datetime
 import functools
+import io
 import logging
-import operator
 import os.path
 import platform
 import re
@@ -13,8 +15,6 @@ import sqlite3
 import sys
 import uuid
 
-import bcrypt
-
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
@@ -25,8 +25,9 @@ from pyramid.httpexceptions import HTTPClientError
 from pyramid.httpexceptions import HTTPCreated
 from pyramid.httpexceptions import HTTPFound
 from pyramid.httpexceptions import HTTPInternalServerError
+from pyramid.httpexceptions import HTTPServiceUnavailable
 from pyramid.interfaces import IAuthenticationPolicy
-from pyramid.renderers import JSON
+from pyramid.response import Response
 from pyramid.security import authenticated_userid
 from pyramid.security import forget
 from pyramid.security import remember
@@ -34,7 +35,13 @@ from pyramid.security import remember
 from pyramid_authstack import AuthenticationStackPolicy
 from pyramid_macauth import MACAuthenticationPolicy
 
+from sqlalchemy import and_
 from sqlalchemy import desc
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.orm import Session
 
 from waitress import serve
 
@@ -42,7 +49,6 @@ from cloudhands.common.connectors import initialise
 from cloudhands.common.connectors import Registry
 from cloudhands.common.discovery import settings
 import cloudhands.common.factories
-from cloudhands.common.pipes import SimplePipeQueue
 from cloudhands.common.schema import Appliance
 from cloudhands.common.schema import BcryptedPassword
 from cloudhands.common.schema import CatalogueChoice
@@ -71,17 +77,53 @@ from cloudhands.common.states import MembershipState
 from cloudhands.common.states import RegistrationState
 
 import cloudhands.web
+from cloudhands.identity.allocator import create as create_allocator
+from cloudhands.identity.allocator import next_uidnumber
+from cloudhands.identity.allocator import Reconciler
+from cloudhands.identity.database import bootstrap
 from cloudhands.identity.ldap_account import change_password
-from cloudhands.identity.ldap_account import next_uidnumber
 from cloudhands.identity.membership import handle_from_email
 from cloudhands.identity.membership import Acceptance
+from cloudhands.identity.membership import BulkInvitation
 from cloudhands.identity.membership import Invitation
 from cloudhands.identity.registration import NewAccount
 from cloudhands.identity.registration import NewPassword
+from cloudhands.web import __version__
+from cloudhands.web.cache import TTLCache
 from cloudhands.web.catalogue import CatalogueItemView
+from cloudhands.web.conditional import artifacts
+from cloudhands.web.conditional import not_modified
+from cloudhands.web.conditional import touch_validator
+from cloudhands.web.context import UserContext
+from cloudhands.web.database import pooled_sessions
+from cloudhands.web.database import request_session
+from cloudhands.web.database import retries
+from cloudhands.web.database import CatchUp
+from cloudhands.web.database import Connection
+from cloudhands.web.delta import create as create_delta_index
+from cloudhands.web.delta import newer
+from cloudhands.web.delta import since
+from cloudhands.web.delta import DELETED
+from cloudhands.web.events import register as register_broker
+from cloudhands.web.events import stream_limit
+from cloudhands.web.events import EventBroker
+from cloudhands.web.events import EventStream
+from cloudhands.web.feed import available as feed_available
+from cloudhands.web.feed import catch_up as catch_up_feed
+from cloudhands.web.feed import changes as feed_changes
+from cloudhands.web.feed import create as create_feed
+from cloudhands.web.feed import first_page
+from cloudhands.web.feed import recent
+from cloudhands.web.feed import register as register_rings
+from cloudhands.web.feed import Rings
+from cloudhands.web.hateoas import HateoasJSON
 from cloudhands.web.indexer import people
-from cloudhands.web import __version__
+from cloudhands.web.loaders import graph
+from cloudhands.web.loaders import polymorphic
+from cloudhands.web.metrics import metrics_read
+from cloudhands.web.metrics import register as register_metrics
 from cloudhands.web.model import BcryptedPasswordView
+from cloudhands.web.model import DeltaInfo
 from cloudhands.web.model import HostView
 from cloudhands.web.model import LabelView
 from cloudhands.web.model import MembershipView
@@ -91,13 +133,78 @@ from cloudhands.web.model import PeoplePage
 from cloudhands.web.model import PublicKeyView
 from cloudhands.web.model import RegistrationView
 from cloudhands.web.model import StateView
+from cloudhands.web.model import Tombstone
+from cloudhands.web import paging
+from cloudhands.web.passwords import sizes as password_pool_sizes
+from cloudhands.web.passwords import Overloaded
+from cloudhands.web.passwords import PasswordPool
+from cloudhands.web.pipes import PipeWriters
+from cloudhands.web.projection import appliances as latest_appliances
+from cloudhands.web.projection import available as projection_available
+from cloudhands.web.projection import catch_up as catch_up_projection
+from cloudhands.web.projection import create as create_projection
+from cloudhands.web.projection import current as projection_current
+from cloudhands.web.projection import Latest
+from cloudhands.web.propagation import attempt as attempt_password
+from cloudhands.web.propagation import record as record_password
+from cloudhands.web.propagation import PasswordJob
+from cloudhands.web.propagation import Propagator
+from cloudhands.web.tricks import create as create_resource_indexes
+from cloudhands.web.tricks import latest_resource
+from cloudhands.web.workers import listen
+from cloudhands.web.workers import Supervisor
 
 DFLT_PORT = 8080
 DFLT_DB = ":memory:"
 DFLT_IX = "cloudhands.wsh"
+DFLT_THREADS = 4
+DFLT_WORKERS = 1
+DFLT_HASHERS = None
+
+# Batch limits. SQLite permits 999 parameters in one statement.
+BATCH_PARAMS = 500
+MAX_BATCH = 1000
 
+# These are private to each process. See cloudhands.web.workers.
 CRED_TABLE = {}
 
+# Maps an authenticated userid to the primary key of its User
+USER_CACHE = TTLCache(maxlen=1024, ttl=300)
+
+# Seconds between refreshes of a page showing an appliance in each state.
+REFRESH = {
+    "pre_provision": 5,
+    "provisioning": 15,
+    "pre_check": 2,
+    "pre_delete": 2,
+    "pre_start": 2,
+    "pre_stop": 2,
+    "pre_operational": 5,
+    "operational": 60,
+}
+
+# Writers for the token pipes, shared by all threads of the process.
+PIPES = PipeWriters()
+
+# Used when the application has not configured a pool of its own.
+PASSWORDS = PasswordPool(*password_pool_sizes(DFLT_THREADS))
+
+# Threads which follow the database. There is one of each kind for each
+# database in a process, however many apps are made.
+BACKGROUND = {}
+
+
+def background(name, path, factory):
+    """
+    Returns the background worker called `name` for the database at
+    `path`. It is made by `factory` and started when first asked for in
+    this process.
+    """
+    key = (name, path, os.getpid())
+    if key not in BACKGROUND:
+        BACKGROUND[key] = factory().start()
+    return BACKGROUND[key]
+
 
 def cfg_paths(request, cfg=None):
     cfg = cfg or {
@@ -114,9 +221,62 @@ def cfg_paths(request, cfg=None):
 
 
 def registered_connection(request):
+    # A pooled session belongs to this request alone. Otherwise fall back
+    # to the single session of the registered connection.
+    session = getattr(request, "db_session", None)
+    if session is not None:
+        return Connection(session)
+
     r = Registry()
     return r.connect(*next(iter(r.items)))
 
+
+def request_user_context(request):
+    """
+    Returns the UserContext of `request`.
+
+    This function is registered as a reified request method, so the
+    context is created on first use and shared by every call made
+    during the request.
+    """
+    con = registered_connection(request)
+    context = UserContext(con.session, authenticate_user(request)).bind()
+    request.add_finished_callback(context.release)
+    return context
+
+
+def user_context(request):
+    """
+    Returns the UserContext of `request`. Requests made without the
+    request methods of the application, as in tests, keep theirs in
+    the request itself.
+    """
+    try:
+        return request.user_context
+    except AttributeError:
+        return request.__dict__.setdefault(
+            "user_context", request_user_context(request))
+
+
+def password_pool(request):
+    return request.registry.settings.get("passwords", None) or PASSWORDS
+
+
+def password_work(request, fn, *args):
+    """
+    Calls a method of the password pool, turning a refusal into a
+    `503 Service Unavailable` response.
+    """
+    try:
+        return fn(*args)
+    except Overloaded as e:
+        log = logging.getLogger("cloudhands.web.passwords")
+        log.warning("{} for {}".format(e, request.path))
+        raise HTTPServiceUnavailable(
+            "Too many password requests. Please try again shortly.",
+            headers={"Retry-After": str(e.retry)})
+
+
 def authenticate_user(request, refuse:Exception=None):
     userId = authenticated_userid(request)
     if refuse and userId is None:
@@ -124,11 +284,22 @@ def authenticate_user(request, refuse:Exception=None):
 
     con = registered_connection(request)
 
-    # Persona's user ids are email addresses, whereas Pyramid auth uses
-    # user names. We want to test for either.
-    user = (con.session.query(User).filter(User.handle == userId).first() or
+    user = None
+    if userId is not None:
+        try:
+            user = con.session.query(User).get(USER_CACHE[userId])
+        except KeyError:
+            pass
+
+    if user is None:
+        # Persona's user ids are email addresses, whereas Pyramid auth uses
+        # user names. We want to test for either.
+        user = (
+            con.session.query(User).filter(User.handle == userId).first() or
             con.session.query(User).join(Touch).join(
                 EmailAddress).filter(EmailAddress.value == userId).first())
+        if user is not None and userId is not None:
+            USER_CACHE[userId] = user.id
 
     if refuse and not user:
         nf = refuse("User not found for {}".format(userId))
@@ -137,6 +308,48 @@ def authenticate_user(request, refuse:Exception=None):
     return user
 
 
+@event.listens_for(Session, "after_flush")
+def stale_users(session, context):
+    """
+    Notes the cached users who may be affected by new records. They are
+    removed from the cache only once the records are committed.
+    """
+    ids, keys = session.info.setdefault("cloudhands.users", (set(), set()))
+    for obj in session.new:
+        if isinstance(obj, Touch) and isinstance(obj.actor, User):
+            ids.add(obj.actor.id)
+        elif isinstance(obj, EmailAddress):
+            keys.add(obj.value)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_users(session):
+    """
+    Removes cached users affected by committed records. The cache is
+    keyed by both user handle and email address, so every key which
+    refers to an affected user is removed.
+    """
+    ids, keys = session.info.pop("cloudhands.users", ((), ()))
+    for key in keys:
+        USER_CACHE.discard(key)
+    if ids:
+        USER_CACHE.discard_values(ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def keep_users(session):
+    session.info.pop("cloudhands.users", None)
+
+
+def require_membership(session, user, org):
+    mship = session.query(Membership).join(Touch).join(User).filter(
+        User.id == user.id).filter(Membership.organisation == org).first()
+    if mship is None:
+        raise Forbidden("User {} is not a member of {}".format(
+            user.handle, org.name))
+    return mship
+
+
 def create_membership_resources(session, m, rTyp, vals):
     provider = session.query(Provider).first()  # FIXME
     latest = m.changes[-1]
@@ -195,37 +408,121 @@ def top_read(request):
         paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
     page.layout.info.push(PageInfo(refresh=30))
 
+    latest = con.session.query(func.max(Touch.id)).scalar()
+    delta = since(request)
+    if delta is not None:
+        orgs = user_context(request).organisations if user else []
+        acts = top_changes(con.session, [i.id for i in orgs], delta, latest)
+        for act in acts:
+            page.layout.items.push(act)
+        page.layout.info.push(DeltaInfo(
+            since=request.params["since"], latest=latest))
+        return dict(page.termination())
+
+    page.layout.info.push(DeltaInfo(since=None, latest=latest))
+
     if user:
-        mships = con.session.query(Membership).join(Touch).join(User).filter(
-            User.id==user.id).all()
-        reg = con.session.query(Registration).join(Touch).join(User).filter(
-            User.uuid == user.uuid).first()
-        if reg:
-            page.layout.nav.push(reg)
+        context = user_context(request)
+        if context.registration:
+            page.layout.nav.push(context.registration)
+        orgs = context.organisations
     else:
-        mships = []
+        orgs = []
 
-    for org in sorted(
-        {i.organisation for i in mships}, key=operator.attrgetter("name")
-    ):
+    for org in orgs:
         page.layout.nav.push(org)
 
-    for act in con.session.query(Touch).order_by(desc(Touch.at)).limit(5):
+    if orgs and feed_available(con.session):
+        acts = first_page(
+            con.session, request.registry.settings.get("feed", None),
+            [i.id for i in orgs], 5)
+    else:
+        acts = con.session.query(Touch).options(*graph(Touch)).order_by(
+            desc(Touch.at)).limit(5)
+    for act in acts:
         page.layout.items.push(act)
 
     return dict(page.termination())
 
 
+def top_changes(session, org_ids, delta, latest):
+    """
+    Returns all the activity in the organisations `org_ids` since
+    `delta`, up to the Touch with id `latest`, newest first.
+    """
+    if not org_ids or latest is None:
+        return []
+    if feed_available(session):
+        return feed_changes(session, org_ids, delta, latest)
+    owned = or_(
+        Touch.artifact_id.in_(session.query(Appliance.id).filter(
+            Appliance.organisation_id.in_(org_ids))),
+        Touch.artifact_id.in_(session.query(Membership.id).join(
+            Organisation).filter(Organisation.id.in_(org_ids))))
+    return session.query(Touch).options(*graph(Touch)).filter(
+        newer(delta)).filter(Touch.id <= latest).filter(
+        owned).order_by(desc(Touch.id)).all()
+
+
+def feed_read(request):
+    """
+    Lists the activity in the organisations of the user, newest first.
+    """
+    log = logging.getLogger("cloudhands.web.feed_read")
+    con = registered_connection(request)
+    user = con.session.merge(authenticate_user(request, Forbidden))
+    if not feed_available(con.session):
+        raise NotFound("Activity feed is not available")
+
+    size = paging.limit(request)
+    after = paging.after(request, paging.timestamp, int)
+
+    page = Page(
+        session=con.session, user=user,
+        paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
+    page.layout.info.push(PageInfo(title="Activity", refresh=30))
+
+    orgs = user_context(request).organisations
+    for org in orgs:
+        page.layout.nav.push(org)
+
+    # One more than a page is fetched to learn if there is a next page.
+    ids = [i.id for i in orgs]
+    if after is None:
+        rows = first_page(
+            con.session, request.registry.settings.get("feed", None),
+            ids, size + 1)
+    else:
+        rows = recent(con.session, ids, size + 1, after)
+
+    for row in rows[:size]:
+        page.layout.items.push(row)
+
+    if len(rows) > size:
+        row = rows[size - 1]
+        page.layout.nav.push(paging.cursor(
+            request, request.route_path("feed"), row.at, row.touch_id))
+
+    return dict(page.termination())
+
+
 def appliance_read(request):
     log = logging.getLogger("cloudhands.web.appliance_read")
     con = registered_connection(request)
     user = authenticate_user(request)
     appUuid = request.matchdict["app_uuid"]
-    app = con.session.query(Appliance).filter(
+    app = con.session.query(Appliance).options(*graph(Appliance)).filter(
         Appliance.uuid == appUuid).first()
     if not app:
         raise NotFound("Appliance {} not found".format(appUuid))
 
+    mships = [i.id for i in user_context(request).memberships]
+    unchanged = not_modified(request, touch_validator(
+        con.session, artifacts([app.id], mships),
+        authenticated_userid(request), request.headers.get("Accept")))
+    if unchanged is not None:
+        return unchanged
+
     page = Page(
         session=con.session, user=user,
         paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
@@ -235,12 +532,7 @@ def appliance_read(request):
 
     if user is not None:
         user = con.session.merge(user)
-        mships = con.session.query(Membership).join(Touch).join(User).filter(
-            User.id==user.id).all()
-
-        for o in sorted(
-            {i.organisation for i in mships}, key=operator.attrgetter("name")
-        ):
+        for o in user_context(request).organisations:
             page.layout.nav.push(o)
     else:
         page.layout.nav.push(app.organisation)
@@ -386,22 +678,18 @@ def login_update(request):
         raise HTTPInternalServerError(
             "No valid registration found for {}".format(user.handle))
 
-    try:
-        passwords = sorted(
-            ((c.at, r) for c in reg.changes for r in c.resources
-            if isinstance(r, BcryptedPassword)),
-            reverse=True)
-        hash = passwords[0][1].value
-    except (AttributeError, IndexError):
+    password = latest_resource(con.session, reg, BcryptedPassword)
+    if password is None:
         raise HTTPInternalServerError(
             "Registration {} is missing a password".format(reg.uuid))
+    hash = password.value
 
-    if bcrypt.checkpw(data["password"], hash):
+    pool = password_pool(request)
+    if password_work(request, pool.check, data["password"], hash):
         headers = remember(request, user.handle)
         latest = reg.changes[-1]
         if latest.state.name == "pre_user_posixaccount":
-            taken = {i.value for i in con.session.query(PosixUIdNumber).all()}
-            uidN = next_uidnumber(taken=taken)
+            uidN = next_uidnumber(con.session)
             if uidN is None:
                 raise HTTPInternalServerError(
                     "UIdNumber could not be allocated")
@@ -412,35 +700,34 @@ def login_update(request):
 
         if latest.state.name in ("user_posixaccount", "valid"):
             # FIXME: Temporary workaround for race condition (bug #380)
-            try:
-                uids = sorted(
-                    ((c.at, r) for c in reg.changes for r in c.resources
-                    if isinstance(r, PosixUId)),
-                    reverse=True)
-                uid = uids[0][1].value
-                status = change_password(uid, data["password"], timeout=3)
-            except (AttributeError, IndexError):
+            pxUId = latest_resource(con.session, reg, PosixUId)
+            if pxUId is None:
                 raise HTTPInternalServerError(
                     "Registration {} is missing a uid".format(reg.uuid))
-            else:
-                if status is None:
-                    raise HTTPInternalServerError(
-                        "Unable to create password-protected account")
+
+            # One attempt is made here, so that a failure is recorded
+            # before the response. Only the retries are left to the
+            # propagator, which holds the password in memory alone.
+            job = PasswordJob(reg.uuid, user.id, pxUId.value, data["password"])
+            outcome = attempt_password(job, change_password)
+            record_password(con.session, job, outcome)
+            propagator = request.registry.settings.get("propagator", None)
+            if outcome == "timeout":
+                raise HTTPInternalServerError(
+                    "Unable to create password-protected account")
+            elif outcome != "ok" and propagator is not None:
+                if not propagator.submit(job):
+                    log.warning("Password propagation backlog is full")
 
         try:
             config = request.registry.settings["cfg"]
-            pxUId = con.session.query(PosixUId).join(Touch).join(
-                Registration).filter(Registration.uuid == reg.uuid).first()
+            pxUId = latest_resource(con.session, reg, PosixUId)
             providers = con.session.query(Provider).join(Subscription).join(
                 Organisation).join(Membership).join(Touch).join(User).filter(
-                User.id == user.id).all()
+                User.id == user.id).distinct().all()
             for provider in providers:
-                # TODO: pipes will be one per provider
-                path = os.path.expanduser(config["pipe.tokens"]["vcloud"])
                 msg = (reg.uuid, provider.name, pxUId.value, data["password"])
-                pq = SimplePipeQueue.pipequeue(path)
-                pq.put_nowait(msg)
-                pq.close()
+                PIPES.send(PIPES.path(config, provider), msg)
         except Exception as e:
             log.error(e)
 
@@ -464,8 +751,8 @@ def membership_read(request):
     user = authenticate_user(request)  # NB: may be None
 
     m_uuid = request.matchdict["mship_uuid"]
-    mship = con.session.query(Membership).filter(
-        Membership.uuid == m_uuid).first()
+    mship = con.session.query(Membership).options(
+        *graph(Membership)).filter(Membership.uuid == m_uuid).first()
 
     if mship is None:
         raise NotFound("Membership {} not found".format(m_uuid))
@@ -503,11 +790,7 @@ def membership_update(request):
     if not mship:
         raise NotFound()
 
-    prvlg = con.session.query(Membership).join(Organisation).join(
-        Touch).join(User).filter(
-        User.id == user.id).filter(
-        Organisation.id == mship.organisation.id).filter(
-        Membership.role == "admin").first()
+    prvlg = user_context(request).privilege(mship.organisation.name)
     if not prvlg or not prvlg.changes[-1].state.name in ("accepted", "active"):
         raise Forbidden("Admin privilege is required to update membership.")
 
@@ -533,49 +816,77 @@ def organisation_read(request):
     con = registered_connection(request)
     user = con.session.merge(authenticate_user(request, Forbidden))
 
-    page = Page(
-        session=con.session, user=user,
-        paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
-    mships = con.session.query(Membership).join(Touch).join(User).filter(
-        User.id==user.id).all()
-
     oN = request.matchdict["org_name"]
     org = con.session.query(Organisation).filter(
         Organisation.name == oN).first()
     if not org:
         raise NotFound("Organisation not found for {}".format(oN))
 
-    reg = con.session.query(Registration).join(Touch).join(User).filter(
-        User.uuid == user.uuid).first()
-    page.layout.nav.push(reg)
+    delta = since(request)
+    if delta is not None:
+        return organisation_delta(request, con.session, user, org, delta)
+
+    size = paging.limit(request)
+    after = paging.after(request, paging.timestamp, int)
+
+    # Catalogue items have no Touches.
+    catalogue = con.session.query(
+        func.count(CatalogueItem.id), func.max(CatalogueItem.id)).filter(
+        CatalogueItem.organisation == org).one()
+    mships = [i.id for i in user_context(request).memberships]
+    unchanged = not_modified(request, touch_validator(
+        con.session, artifacts(
+            con.session.query(Appliance.id).filter(
+                Appliance.organisation_id == org.id),
+            con.session.query(Membership.id).filter(
+                Membership.organisation == org),
+            mships),
+        authenticated_userid(request), request.headers.get("Accept"),
+        request.params.get("after"), size, *catalogue))
+    if unchanged is not None:
+        return unchanged
 
-    for o in sorted(
-        {i.organisation for i in mships},
-        key=operator.attrgetter("name")
-    ):
+    page = Page(
+        session=con.session, user=user,
+        paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
+    context = user_context(request)
+    page.layout.nav.push(context.registration)
+    for o in context.organisations:
         page.layout.nav.push(o, isSelf=o is org)
 
     refresh = 300
-    seconds = {
-        "pre_provision": 5,
-        "provisioning": 15,
-        "pre_check": 2,
-        "pre_delete": 2,
-        "pre_start": 2,
-        "pre_stop": 2,
-        "pre_operational": 5,
-        "operational": 60,
-    }
-    for t, s, a in sorted((
-        (a.changes[-1].at, a.changes[-1].state.name, a)
-        for a in org.appliances),
-        reverse=True
-    ):
-        refresh = min(refresh, seconds.get(s, 300))
+    # One more than a page is fetched to learn if there is a next page.
+    if projection_available(con.session) and projection_current(con.session):
+        rows = [
+            (a.latest.at, a.id, a.latest.state.name, a)
+            for a in latest_appliances(
+                con.session, org, limit=size + 1, after=after)]
+    else:
+        at = func.max(Touch.at)
+        query = con.session.query(Appliance, at).join(
+            Touch, Touch.artifact_id == Appliance.id).filter(
+            Appliance.organisation == org).group_by(Appliance.id)
+        if after is not None:
+            query = query.having(or_(
+                at < after[0], and_(at == after[0], Appliance.id < after[1])))
+        rows = [
+            (t, a.id, a.changes[-1].state.name, a)
+            for a, t in query.options(*graph(Appliance)).order_by(
+                desc(at), desc(Appliance.id)).limit(size + 1)]
+
+    for t, key, s, a in rows[:size]:
+        refresh = min(refresh, REFRESH.get(s, 300))
         page.layout.items.push(a)
 
- 
+    if len(rows) > size:
+        t, key, s, a = rows[size - 1]
+        page.layout.nav.push(paging.cursor(
+            request, request.route_path("organisation", org_name=oN),
+            t, key))
+
     page.layout.info.push(PageInfo(title=oN, refresh=refresh))
+    page.layout.info.push(DeltaInfo(
+        since=None, latest=con.session.query(func.max(Touch.id)).scalar()))
     mships = con.session.query(Membership).join(Organisation).join(
         Touch).join(State).join(User).filter(
         User.id == user.id).filter(
@@ -586,6 +897,73 @@ def organisation_read(request):
     return dict(page.termination())
 
 
+def organisation_delta(request, session, user, org, delta):
+    """
+    Presents only those appliances of `org` which have changed since
+    `delta`. Deleted appliances appear as tombstones.
+    """
+    page = Page(
+        session=session, user=user,
+        paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
+
+    latest = session.query(func.max(Touch.id)).scalar()
+    changed = session.query(Touch.artifact_id, func.max(Touch.id)).join(
+        Appliance, Touch.artifact_id == Appliance.id).filter(
+        Appliance.organisation_id == org.id).filter(
+        newer(delta)).filter(
+        Touch.id <= (latest or 0)).group_by(Touch.artifact_id).all()
+    order = dict(changed)
+
+    refresh = 300
+    if changed:
+        apps = session.query(Appliance).options(*graph(Appliance)).filter(
+            Appliance.id.in_(list(order))).all()
+        for app in sorted(apps, key=lambda x: order[x.id], reverse=True):
+            state = app.changes[-1].state.name
+            if state in DELETED:
+                page.layout.items.push(Tombstone(uuid=app.uuid, deleted=True))
+            else:
+                refresh = min(refresh, REFRESH.get(state, 300))
+                page.layout.items.push(app)
+
+    page.layout.info.push(PageInfo(title=org.name, refresh=refresh))
+    page.layout.info.push(DeltaInfo(
+        since=request.params["since"], latest=latest))
+    return dict(page.termination())
+
+
+def organisation_events_read(request):
+    log = logging.getLogger("cloudhands.web.organisation_events_read")
+    con = registered_connection(request)
+    user = authenticate_user(request, Forbidden)
+
+    oN = request.matchdict["org_name"]
+    org = con.session.query(Organisation).filter(
+        Organisation.name == oN).first()
+    if not org:
+        raise NotFound("Organisation not found for {}".format(oN))
+
+    broker = request.registry.settings.get("events", None)
+    if broker is None:
+        raise NotFound("Events are not available with this database")
+
+    try:
+        lastId = int(request.headers.get("Last-Event-ID"))
+    except (TypeError, ValueError):
+        lastId = None
+
+    sub = broker.subscribe(oN, lastId)
+    if sub is None:
+        log.warning("Too many event streams. Refused {}".format(user.handle))
+        raise HTTPServiceUnavailable(headers={"Retry-After": "30"})
+
+    rv = Response(
+        app_iter=EventStream(broker, sub),
+        content_type="text/event-stream", charset="utf-8")
+    rv.cache_control = "no-cache"
+    return rv
+
+
 def organisation_catalogue_read(request):
     log = logging.getLogger("cloudhands.web.organisation_catalogue_read")
     con = registered_connection(request)
@@ -594,8 +972,6 @@ def organisation_catalogue_read(request):
     page = Page(
         session=con.session, user=user,
         paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
-    mships = con.session.query(Membership).join(Touch).join(User).filter(
-        User.id==user.id).all()
 
     oN = request.matchdict["org_name"]
     org = con.session.query(Organisation).filter(
@@ -605,17 +981,33 @@ def organisation_catalogue_read(request):
     else:
         page.layout.info.push(PageInfo(title=oN))
 
-    reg = con.session.query(Registration).join(Touch).join(User).filter(
-        User.uuid == user.uuid).first()
-    page.layout.nav.push(reg)
-    for o in sorted(
-        {i.organisation for i in mships}, key=operator.attrgetter("name")
-    ):
+    context = user_context(request)
+    page.layout.nav.push(context.registration)
+    for o in context.organisations:
         page.layout.nav.push(o, isSelf=o is org)
 
-    for i in org.catalogue:
+    size = paging.limit(request)
+    after = paging.after(request, str, int)
+    query = con.session.query(CatalogueItem).filter(
+        CatalogueItem.organisation == org)
+    if after is not None:
+        query = query.filter(or_(
+            CatalogueItem.name > after[0],
+            and_(CatalogueItem.name == after[0],
+                 CatalogueItem.id > after[1])))
+    items = query.order_by(
+        CatalogueItem.name, CatalogueItem.id).limit(size + 1).all()
+
+    for i in items[:size]:
         page.layout.items.push(i)
 
+    if len(items) > size:
+        last = items[size - 1]
+        page.layout.nav.push(paging.cursor(
+            request,
+            request.route_path("organisation_catalogue", org_name=oN),
+            last.name, last.id))
+
     return dict(page.termination())
 
 
@@ -707,6 +1099,187 @@ def organisation_appliances_create(request):
         location=request.route_url("appliance", app_uuid=app.uuid))
 
 
+def organisation_appliances_bulk_create(request):
+    """
+    Creates many appliances from one catalogue item in a single
+    transaction. The JSON body names the catalogue item by `uuid` and
+    gives either a `count` or a list of `labels`. Labelled appliances
+    go on to the pre_provision state, as if each had been configured.
+    """
+    log = logging.getLogger(
+        "cloudhands.web.organisation_appliances_bulk_create")
+    con = registered_connection(request)
+    user = con.session.merge(authenticate_user(request, Forbidden))
+
+    oN = request.matchdict["org_name"]
+    org = con.session.query(Organisation).filter(
+        Organisation.name == oN).first()
+    if not org:
+        raise NotFound("Organisation '{}' not found".format(oN))
+    require_membership(con.session, user, org)
+
+    try:
+        body = dict(request.json_body)
+    except (TypeError, ValueError):
+        raise HTTPBadRequest("Expected a JSON object")
+
+    data = CatalogueItemView(uuid=str(body.get("uuid", "")))
+    if data.invalid:
+        raise HTTPBadRequest(
+            "Bad value in '{}' field".format(data.invalid[0].name))
+
+    description = str(body.get("description", "Workshop appliance"))
+    try:
+        labels = [
+            LabelView(name=str(i), description=description)
+            for i in body.get("labels", [])]
+        count = int(body.get("count", len(labels)))
+    except (TypeError, ValueError):
+        raise HTTPBadRequest("Bad value in 'count' or 'labels' field")
+
+    if labels and count != len(labels):
+        raise HTTPBadRequest("Count does not match labels")
+    if not 0 < count <= MAX_BATCH:
+        raise HTTPBadRequest(
+            "Between 1 and {} appliances at once".format(MAX_BATCH))
+    bad = next((i for i in labels if i.invalid), None)
+    if bad is not None:
+        raise HTTPBadRequest(
+            "Bad value in '{}' field".format(bad.invalid[0].name))
+
+    tmplt = con.session.query(CatalogueItem).filter(
+        CatalogueItem.uuid == data["uuid"]).filter(
+        CatalogueItem.organisation == org).first()
+    if tmplt is None:
+        raise NotFound("Catalogue item {} not found".format(data["uuid"]))
+
+    states = {
+        i.name: i for i in con.session.query(ApplianceState).filter(
+        ApplianceState.name.in_(("configuring", "pre_provision")))}
+    choice = {k: getattr(tmplt, k, None)
+              for k in ("name", "description", "logo", "natrouted")}
+
+    now = datetime.datetime.utcnow()
+    apps = []
+    objs = []
+    for n in range(count):
+        app = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=org,
+            )
+        act = Touch(
+            artifact=app, actor=user, state=states["configuring"], at=now)
+        objs.append(CatalogueChoice(provider=None, touch=act, **choice))
+        if labels:
+            act = Touch(
+                artifact=app, actor=user, state=states["pre_provision"],
+                at=now + datetime.timedelta(microseconds=1))
+            objs.append(Label(
+                name=labels[n]["name"], description=labels[n]["description"],
+                touch=act))
+        apps.append(app.uuid)
+
+    # The rows are joined by relationships and the keys are generated,
+    # which bulk_save_objects would not follow. One flush will do.
+    con.session.add_all(objs)
+    con.session.commit()
+    log.info("{} created {} appliances in {}".format(
+        user.handle, count, oN))
+
+    state = "pre_provision" if labels else "configuring"
+    request.response.status_int = 201
+    return {
+        "appliances": [
+            {"uuid": appUuid, "name": name, "state": state}
+            for appUuid, name in zip(
+                apps, [i["name"] for i in labels] or [None] * count)]
+    }
+
+
+def organisation_appliances_transitions(request):
+    """
+    Applies a batch of appliance state changes in one transaction. The
+    body is a JSON list of objects with `uuid`, `fsm` and `name` keys.
+    """
+    log = logging.getLogger(
+        "cloudhands.web.organisation_appliances_transitions")
+    con = registered_connection(request)
+    user = con.session.merge(authenticate_user(request, Forbidden))
+
+    oN = request.matchdict["org_name"]
+    org = con.session.query(Organisation).filter(
+        Organisation.name == oN).first()
+    if not org:
+        raise NotFound("Organisation '{}' not found".format(oN))
+
+    require_membership(con.session, user, org)
+
+    try:
+        items = request.json_body
+        items = items["transitions"] if isinstance(items, dict) else items
+        items = list(items)
+    except (KeyError, TypeError, ValueError):
+        raise HTTPBadRequest("Expected a list of transitions")
+    if len(items) > MAX_BATCH:
+        raise HTTPBadRequest(
+            "No more than {} transitions at once".format(MAX_BATCH))
+
+    uuidPattern = re.compile("[0-9a-f]{32}$")
+    results = []
+    wanted = []
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({"uuid": None, "status": 400, "detail": "Bad item"})
+            continue
+
+        data = StateView(
+            (k, str(item[k])) for k in ("fsm", "name") if k in item)
+        appUuid = str(item.get("uuid", ""))
+        if data.invalid or not uuidPattern.match(appUuid):
+            results.append(
+                {"uuid": appUuid, "status": 400, "detail": "Bad item"})
+        else:
+            results.append(
+                {"uuid": appUuid, "fsm": data["fsm"], "name": data["name"]})
+            wanted.append(results[-1])
+
+    # States and appliances are each fetched once for the whole batch.
+    states = {
+        (i.fsm, i.name): i for i in con.session.query(State).filter(
+            State.fsm.in_({i["fsm"] for i in wanted})).filter(
+            State.name.in_({i["name"] for i in wanted}))} if wanted else {}
+    uuids = sorted({i["uuid"] for i in wanted})
+    apps = {}
+    for n in range(0, len(uuids), BATCH_PARAMS):
+        apps.update((i.uuid, i) for i in con.session.query(Appliance).filter(
+            Appliance.organisation == org).filter(
+            Appliance.uuid.in_(uuids[n:n + BATCH_PARAMS])))
+
+    now = datetime.datetime.utcnow()
+    acts = []
+    for result in wanted:
+        state = states.get((result["fsm"], result["name"]))
+        app = apps.get(result["uuid"])
+        if app is None:
+            result.update(status=404, detail="Appliance not found")
+        elif state is None or state.fsm != "appliance":
+            result.update(status=400, detail="No such appliance state")
+        else:
+            acts.append((result, Touch(
+                artifact=app, actor=user, state=state, at=now)))
+
+    if acts:
+        con.session.add_all(act for result, act in acts)
+        con.session.commit()
+        for result, act in acts:
+            result.update(status=200, at=act.at)
+    log.info("{} applied {} of {} transitions in {}".format(
+        user.handle, len(acts), len(items), oN))
+
+    return {"transitions": results}
+
+
 def organisation_memberships_create(request):
     log = logging.getLogger("cloudhands.web.organisation_memberships_create")
     cfg = request.registry.settings.get("cfg", None)
@@ -742,6 +1315,77 @@ def organisation_memberships_create(request):
                 cfg["paths.assets"]["html"])))
 
 
+def organisation_memberships_upload(request):
+    """
+    Invites the people listed in an uploaded CSV file. Each row holds a
+    username, surname and email address. The file is sent either as the
+    `file` field of a form or as the body of the request.
+    """
+    log = logging.getLogger("cloudhands.web.organisation_memberships_upload")
+    con = registered_connection(request)
+    admin = con.session.merge(authenticate_user(request, Forbidden))
+
+    oN = request.matchdict["org_name"]
+    org = con.session.query(Organisation).filter(
+        Organisation.name == oN).first()
+    if not org:
+        raise NotFound("Organisation '{}' not found".format(oN))
+
+    upload = request.POST.get("file", None)
+    if hasattr(upload, "file"):
+        data = upload.file.read()
+    else:
+        data = request.body
+    try:
+        text = data.decode("utf-8-sig")
+    except (AttributeError, UnicodeError):
+        raise HTTPBadRequest("Expected a CSV file in UTF-8")
+
+    rows = [i for i in csv.reader(io.StringIO(text)) if any(i)]
+    if rows and [i.strip().lower() for i in rows[0]] == [
+        "username", "surname", "email"
+    ]:
+        rows = rows[1:]
+    if not 0 < len(rows) <= MAX_BATCH:
+        raise HTTPBadRequest(
+            "Between 1 and {} rows at once".format(MAX_BATCH))
+
+    report = []
+    valid = []
+    for n, row in enumerate(rows, start=1):
+        if len(row) != 3:
+            report.append(
+                {"row": n, "status": "invalid", "detail": "Expected 3 fields"})
+            continue
+        data = MembershipView(
+            username=row[0].strip(), surname=row[1].strip(),
+            email=row[2].strip())
+        if data.invalid:
+            report.append({
+                "row": n, "status": "invalid",
+                "detail": "Bad value in '{}' field".format(
+                    data.invalid[0].name)})
+        else:
+            result = {"row": n}
+            report.append(result)
+            valid.append(
+                (result, (data["username"], data["surname"], data["email"])))
+
+    invites = BulkInvitation(
+        admin, org, [row for result, row in valid])(con.session)
+    if invites is None:
+        raise Forbidden("User {} lacks permission.".format(admin.handle))
+
+    for (result, row), invite in zip(valid, invites):
+        result.update(invite)
+    log.info("{} invited {} of {} people to {}".format(
+        admin.handle, sum(1 for i in invites if i["status"] == "invited"),
+        len(rows), oN))
+
+    request.response.status_int = 201
+    return {"memberships": report}
+
+
 def people_read(request):
     log = logging.getLogger("cloudhands.web.people")
     userId = authenticated_userid(request)
@@ -790,8 +1434,8 @@ def registration_passwords(request):
     cfg = request.registry.settings.get("cfg", None)
 
     reg_uuid = request.matchdict["reg_uuid"]
-    reg = con.session.query(Registration).filter(
-        Registration.uuid == reg_uuid).first()
+    reg = con.session.query(Registration).options(
+        *graph(Registration)).filter(Registration.uuid == reg_uuid).first()
     if not reg:
         raise NotFound("Registration {} not found".format(reg_uuid))
 
@@ -817,7 +1461,9 @@ def registration_passwords(request):
         else:
             raise HTTPBadRequest("Bad value in '{}' field".format(bad))
 
-    act = NewPassword(user, data["password"], reg)(con.session)
+    pool = password_pool(request)
+    hash = password_work(request, pool.hash, data["password"])
+    act = NewPassword(user, data["password"], reg, hash=hash)(con.session)
 
     raise HTTPFound(location=request.route_url(
         "login", _query={"username": user.handle}))
@@ -854,6 +1500,18 @@ def registration_keys(request):
         location=request.route_url("registration", reg_uuid=reg.uuid))
 
 
+def registration_resources(session, classes, *criteria):
+    """
+    Returns the resources of the registrations which match `criteria`,
+    newest first. One query fetches them all, with the columns of each
+    of `classes` joined in, and the Touch of each.
+    """
+    rsrc = polymorphic(Resource, classes)
+    return session.query(rsrc).join(rsrc.touch).join(Registration).filter(
+        *criteria).options(contains_eager(rsrc.touch)).order_by(
+        desc(Touch.at), desc(Touch.id)).all()
+
+
 def registration_read(request):
     log = logging.getLogger("cloudhands.web.registration_read")
     con = registered_connection(request)
@@ -863,12 +1521,6 @@ def registration_read(request):
     if not reg:
         raise NotFound("Registration {} not found".format(reg_uuid))
 
-    page = Page(
-        session=con.session,
-        paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
-
-    page.layout.nav.push(reg)
-
     # This page can be visited while unauthenticated but only in the
     # first phase of the onboarding process.
     sName = reg.changes[-1].state.name
@@ -878,14 +1530,25 @@ def registration_read(request):
     else:
         user = con.session.merge(authenticate_user(request, Forbidden))
 
+    mships = [i.id for i in user_context(request).memberships]
+    unchanged = not_modified(request, touch_validator(
+        con.session, artifacts([reg.id], mships),
+        authenticated_userid(request), request.headers.get("Accept")))
+    if unchanged is not None:
+        return unchanged
+
+    page = Page(
+        session=con.session,
+        paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
+
+    page.layout.nav.push(reg)
     page.layout.info.push(PageInfo(title=user.handle))
 
-    mships = con.session.query(Membership).join(Touch).join(User).filter(
-        User.id==user.id).all()
-    for o in sorted(
-        {i.organisation for i in mships},
-        key=operator.attrgetter("name")
-    ):
+    if sName == "pre_registration_person":
+        context = UserContext(con.session, user)
+    else:
+        context = user_context(request)
+    for o in context.organisations:
         page.layout.nav.push(o)
 
     if sName == "pre_user_inetorgperson_dn":
@@ -901,9 +1564,14 @@ def registration_read(request):
         (PublicKey, True)
     )
 
+    groups = defaultdict(list)
+    for r in registration_resources(
+        con.session, [i for i, _ in display], Registration.uuid == reg_uuid
+    ):
+        groups[type(r)].append(r)
+
     for class_, isCreatable in display:
-        rsrcs = con.session.query(class_).join(Touch).join(Registration).filter(
-            Registration.uuid == reg_uuid).order_by(desc(Touch.at)).all()
+        rsrcs = groups[class_]
         if not rsrcs and isCreatable:
             blank = class_()
             blank.uuid = reg_uuid
@@ -921,21 +1589,18 @@ def user_read(request):
     u_uuid = request.matchdict["user_uuid"]
     actor = con.session.query(User).filter(User.uuid == u_uuid).first()
 
-    mships = con.session.query(Membership).join(Touch).join(User).filter(
-        User.id==user.id).all()
-
     page = Page(
         session=con.session, user=user,
         paths=cfg_paths(request, request.registry.settings.get("cfg", None)))
 
-    for o in sorted(
-        {i.organisation for i in mships}, key=operator.attrgetter("name")
-    ):
+    for o in user_context(request).organisations:
         page.layout.nav.push(o)
 
     regs = con.session.query(Registration).join(Touch).join(User).filter(
         User.uuid == u_uuid).all()
-    resources = [r for reg in regs for c in reg.changes for r in c.resources]
+    resources = registration_resources(
+        con.session, "*", Registration.id.in_([i.id for i in regs])
+    ) if regs else []
     for i in resources:
         page.layout.items.push(i)
     #if not any(i for i in resources if isinstance(i, Label)):
@@ -953,6 +1618,30 @@ def wsgi_app(args, cfg):
 
     config = Configurator(settings=attribs)
     config.include("pyramid_chameleon")
+    config.add_request_method(
+        request_user_context, "user_context", reify=True)
+
+    threads = getattr(args, "threads", DFLT_THREADS)
+    sessions = pooled_sessions(args.db, size=threads, config=cfg)
+    if sessions is not None:
+        config.add_settings({"sessions": sessions})
+        config.add_request_method(request_session, "db_session", reify=True)
+        if stream_limit(threads):
+            config.add_settings({"events": register_broker(
+                EventBroker(sessions, streams=stream_limit(threads)))})
+        config.add_settings({"propagator": Propagator(sessions)})
+        config.add_settings({"catch_up": background(
+            "catch_up", args.db,
+            lambda: CatchUp(sessions, [catch_up_projection, catch_up_feed]))})
+        config.add_settings({"reconciler": background(
+            "reconciler", args.db, lambda: Reconciler(sessions))})
+    config.add_settings({"feed": register_rings(Rings())})
+    config.add_settings({"db.retries": retries(cfg)})
+    config.add_settings({"passwords": register_metrics(PasswordPool(
+        *password_pool_sizes(
+            threads, getattr(args, "hashers", DFLT_HASHERS))))})
+    config.add_tween("cloudhands.web.database.busy_retry_tween_factory")
+    config.add_tween("cloudhands.web.metrics.metrics_tween_factory")
 
     if (cfg.has_section("auth.persona")
         and cfg.getboolean("auth.persona", "enable")):
@@ -964,11 +1653,12 @@ def wsgi_app(args, cfg):
         })
         config.include("pyramid_persona")
 
-    hateoas = JSON(indent=4)
+    hateoas = HateoasJSON(indent=4)
     hateoas.add_adapter(datetime.datetime, datetime_adapter)
     hateoas.add_adapter(type(re.compile("")), regex_adapter)
     hateoas.add_adapter(Serializable, record_adapter)
     hateoas.add_adapter(Touch, touch_adapter)
+    hateoas.add_adapter(Latest, touch_adapter)
     config.add_renderer("hateoas", hateoas)
 
     config.add_route(
@@ -993,6 +1683,11 @@ def wsgi_app(args, cfg):
         #renderer="hateoas", accept="application/json", xhr=None)
         renderer=cfg["paths.templates"]["home"])
 
+    config.add_route("feed", "/feed")
+    config.add_view(
+        feed_read, route_name="feed", request_method="GET",
+        renderer="hateoas")
+
     config.add_route("login", "/login")
     config.add_view(
         login_read,
@@ -1041,6 +1736,22 @@ def wsgi_app(args, cfg):
         organisation_appliances_create,
         route_name="organisation_appliances", request_method="POST")
 
+    config.add_route(
+        "organisation_appliances_bulk",
+        "/organisation/{org_name}/appliances/bulk")
+    config.add_view(
+        organisation_appliances_bulk_create,
+        route_name="organisation_appliances_bulk",
+        request_method="POST", renderer="hateoas")
+
+    config.add_route(
+        "organisation_appliances_transitions",
+        "/organisation/{org_name}/appliances/transitions")
+    config.add_view(
+        organisation_appliances_transitions,
+        route_name="organisation_appliances_transitions",
+        request_method="POST", renderer="hateoas")
+
     config.add_route(
         "organisation_memberships", "/organisation/{org_name}/memberships")
     config.add_view(
@@ -1048,6 +1759,20 @@ def wsgi_app(args, cfg):
         route_name="organisation_memberships", request_method="POST",
         renderer="hateoas", accept="application/json", xhr=None)
 
+    config.add_route(
+        "organisation_memberships_bulk",
+        "/organisation/{org_name}/memberships/bulk")
+    config.add_view(
+        organisation_memberships_upload,
+        route_name="organisation_memberships_bulk",
+        request_method="POST", renderer="hateoas")
+
+    config.add_route(
+        "organisation_events", "/organisation/{org_name}/events")
+    config.add_view(
+        organisation_events_read,
+        route_name="organisation_events", request_method="GET")
+
     config.add_route(
         "organisation_catalogue", "/organisation/{org_name}/catalogue")
     config.add_view(
@@ -1098,6 +1823,14 @@ def wsgi_app(args, cfg):
         renderer="json", accept="application/json")
         #renderer="cloudhands.web:templates/creds.pt")
 
+    if (cfg.has_section("metrics")
+        and cfg.getboolean("metrics", "enable", fallback=False)):
+        config.add_settings({"metrics.addresses": cfg.get(
+            "metrics", "addresses", fallback="").split()})
+        config.add_route("metrics", "/metrics")
+        config.add_view(
+            metrics_read, route_name="metrics", request_method="GET")
+
     config.add_route("user", "/user/{user_uuid}")
     config.add_view(
         user_read, route_name="user", request_method="GET",
@@ -1136,15 +1869,37 @@ def configure(args):
         format="%(asctime)s %(levelname)-7s %(name)s|%(message)s")
     cfgN, cfg = next(iter(settings.items()))
     r = Registry()
-    session = r.connect(sqlite3, args.db).session
+    session = bootstrap(r.connect(sqlite3, args.db).session, cfg)
     initialise(session)
+    create_projection(session)
+    create_allocator(session)
+    create_delta_index(session)
+    create_resource_indexes(session)
+    create_feed(session)
     return cfg, session
 
 
 def main(args):
+    log = logging.getLogger("cloudhands.web.main")
     cfg, session = configure(args)
+    if args.workers > 1 and args.db != DFLT_DB:
+        # Workers must not inherit the parent's database connections.
+        session.close()
+        session.get_bind().dispose()
+        sock = listen(platform.node(), args.port)
+        supervisor = Supervisor(
+            functools.partial(wsgi_app, args, cfg), sock,
+            workers=args.workers, threads=args.threads, url_scheme="http")
+        log.info("Starting {} workers on port {}".format(
+            args.workers, args.port))
+        return supervisor.run()
+    elif args.workers > 1:
+        log.warning("An in-memory database needs a single process.")
+
     app = wsgi_app(args, cfg)
-    serve(app, host=platform.node(), port=args.port, url_scheme="http")
+    serve(
+        app, host=platform.node(), port=args.port, threads=args.threads,
+        url_scheme="http")
     return 1
 
 
@@ -1161,6 +1916,17 @@ def parser(description=__doc__):
     rv.add_argument(
         "--port", type=int, default=DFLT_PORT,
         help="Set the port number [{}]".format(DFLT_PORT))
+    rv.add_argument(
+        "--threads", type=int, default=DFLT_THREADS,
+        help="Set the number of server threads [{}]".format(DFLT_THREADS))
+    rv.add_argument(
+        "--workers", type=int, default=DFLT_WORKERS,
+        help="Set the number of server processes [{}]".format(DFLT_WORKERS))
+    rv.add_argument(
+        "--hashers", type=int, default=DFLT_HASHERS,
+        help=(
+            "Set the number of password hashing threads. It is kept below"
+            " the number of server threads [1 per 4 threads, at most 2]"))
     rv.add_argument(
         "--db", default=DFLT_DB,
         help="Set the path to the database [{}]".format(DFLT_DB))
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from bisect import bisect_left
+from collections import Counter
+from collections import defaultdict
+import logging
+import threading
+import time
+import weakref
+
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.response import Response
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+__doc__ = """
+Request instrumentation for the web server.
+
+A Pyramid tween records, for every route, the request latency, the
+number of SQL statements and the time spent in them, and the size of
+the response. The figures are published in Prometheus text format by
+the :py:func:`metrics_read` view.
+
+The view is served only when the `metrics` section of the
+configuration enables it. It may also be restricted to a list of
+client addresses::
+
+    [metrics]
+    enable = true
+    addresses = 127.0.0.1 ::1
+
+For testing, a :py:class:`StatementLog` records the text of each
+statement so that repeated statements (the signature of N+1 loading)
+can be reported.
+"""
+
+DFLT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+
+class StatementCount:
+    """
+    Accumulates the SQL statements executed by one thread.
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, params, context, many):
+    conn.info.setdefault("cloudhands.query_start", []).append(
+        time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, params, context, many):
+    start = conn.info["cloudhands.query_start"].pop()
+    count = getattr(_local, "count", None)
+    if count is not None:
+        count.statements += 1
+        count.seconds += time.perf_counter() - start
+
+    log = getattr(_local, "log", None)
+    if log is not None:
+        log.record(statement)
+
+
+@event.listens_for(Engine, "handle_error")
+def handle_error(context):
+    # A failed statement never reaches after_cursor_execute.
+    conn = context.connection
+    stack = conn.info.get("cloudhands.query_start") if conn else None
+    if stack:
+        stack.pop()
+
+
+class StatementLog:
+    """
+    Records the SQL statements executed by this thread while the
+    context is active::
+
+        with StatementLog() as log:
+            organisation_read(request)
+        print(len(log), log.repeated())
+
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.parent = None
+
+    def __enter__(self):
+        self.parent = getattr(_local, "log", None)
+        _local.log = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.log = self.parent
+        return False
+
+    def __len__(self):
+        return len(self.statements)
+
+    def record(self, statement):
+        # Bound parameters are not part of the statement text, so
+        # identical text means identical shape.
+        self.statements.append(" ".join(statement.split()))
+        if self.parent is not None:
+            self.parent.record(statement)
+
+    def repeated(self, threshold=2):
+        """
+        Returns a list of (statement, count) pairs for the statements
+        which were issued at least `threshold` times, most frequent first.
+        """
+        return [
+            (k, n) for k, n in Counter(self.statements).most_common()
+            if n >= threshold]
+
+    def report(self, threshold=2):
+        return "\n".join(
+            "{:>4} x {}".format(n, k) for k, n in self.repeated(threshold))
+
+
+class Histogram:
+
+    def __init__(self, buckets=DFLT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Yields (upper bound, count) pairs for each bucket, ending with
+        the `+Inf` bucket.
+        """
+        total = 0
+        for le, n in zip(self.buckets + ("+Inf",), self.counts):
+            total += n
+            yield le, total
+
+
+class RouteStats:
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.response_bytes = 0
+
+
+class RouteMetrics:
+    """
+    Collects per-route statistics from all server threads.
+    """
+
+    prefix = "cloudhands"
+
+    def __init__(self):
+        self.routes = defaultdict(RouteStats)
+        self.lock = threading.Lock()
+
+    def observe(self, route, seconds, count, size):
+        with self.lock:
+            stats = self.routes[route]
+            stats.latency.observe(seconds)
+            stats.statements += count.statements
+            stats.sql_seconds += count.seconds
+            stats.response_bytes += size
+
+    def sent(self, route, size):
+        with self.lock:
+            self.routes[route].response_bytes += size
+
+    def reset(self):
+        with self.lock:
+            self.routes.clear()
+
+    def exposition(self):
+        """
+        Yields lines of Prometheus text format.
+        """
+        with self.lock:
+            routes = sorted(self.routes.items())
+
+            name = "{}_request_seconds".format(self.prefix)
+            yield "# HELP {} Request latency by route.".format(name)
+            yield "# TYPE {} histogram".format(name)
+            for route, stats in routes:
+                for le, n in stats.latency.cumulative():
+                    yield '{}_bucket{{route="{}",le="{}"}} {}'.format(
+                        name, route, le, n)
+                yield '{}_sum{{route="{}"}} {}'.format(
+                    name, route, stats.latency.sum)
+                yield '{}_count{{route="{}"}} {}'.format(
+                    name, route, stats.latency.count)
+
+            for suffix, attr, descr in (
+                ("sql_statements_total", "statements",
+                    "SQL statements executed by route."),
+                ("sql_seconds_total", "sql_seconds",
+                    "Time spent in SQL statements by route."),
+                ("response_bytes_total", "response_bytes",
+                    "Size of response bodies by route."),
+            ):
+                name = "{}_{}".format(self.prefix, suffix)
+                yield "# HELP {} {}".format(name, descr)
+                yield "# TYPE {} counter".format(name)
+                for route, stats in routes:
+                    yield '{}{{route="{}"}} {}'.format(
+                        name, route, getattr(stats, attr))
+
+
+METRICS = RouteMetrics()
+
+_collectors = weakref.WeakValueDictionary()
+
+
+def register(collector):
+    """
+    Adds the figures of `collector` to those published. It must have
+    an `exposition` method like that of RouteMetrics, and a `prefix`
+    for the names of its figures. It replaces any collector registered
+    before with the same prefix, so each figure is published once.
+    """
+    _collectors[collector.prefix] = collector
+    return collector
+
+
+class Counted:
+    """
+    Wraps the body of a streamed response, and adds the number of bytes
+    sent to the figures of `route` when the server closes it.
+    """
+
+    def __init__(self, app_iter, route, metrics=METRICS):
+        self.app_iter = app_iter
+        self.route = route
+        self.metrics = metrics
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self.metrics.sent(self.route, self.size)
+
+
+def metrics_tween_factory(handler, registry):
+    """
+    Times each request and counts the SQL statements it makes.
+    """
+    log = logging.getLogger("cloudhands.web.metrics")
+
+    def metrics_tween(request):
+        count = _local.count = StatementCount()
+        start = time.perf_counter()
+        response = None
+        try:
+            response = handler(request)
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            _local.count = None
+            route = getattr(
+                getattr(request, "matched_route", None), "name", "notfound")
+            size = getattr(response, "content_length", None)
+            if size is None:
+                size = 0
+                if getattr(response, "app_iter", None) is not None:
+                    response.app_iter = Counted(response.app_iter, route)
+            METRICS.observe(route, elapsed, count, size)
+            log.debug("{} {:.3f}s {} statements".format(
+                route, elapsed, count.statements))
+
+    return metrics_tween
+
+
+def metrics_read(request):
+    addresses = request.registry.settings.get("metrics.addresses", None)
+    if addresses and request.remote_addr not in addresses:
+        raise HTTPForbidden("Metrics are not published to this address.")
+    lines = list(METRICS.exposition())
+    for collector in list(_collectors.values()):
+        lines.extend(collector.exposition())
+    body = "\n".join(lines) + "\n"
+    return Response(
+        body=body.encode("utf-8"),
+        content_type="text/plain; version=0.0.4", charset="utf-8")
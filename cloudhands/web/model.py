@@ -40,6 +40,8 @@ from cloudhands.common.schema import User
 from cloudhands.common.types import NamedDict
 
 import cloudhands.web
+from cloudhands.web.context import privilege
+from cloudhands.web.feed import Entry
 from cloudhands.web.hateoas import Action
 from cloudhands.web.hateoas import Contextual
 from cloudhands.web.hateoas import PageBase
@@ -47,6 +49,8 @@ from cloudhands.web.hateoas import Parameter
 from cloudhands.web.hateoas import Region
 from cloudhands.web.hateoas import Validating
 from cloudhands.web.indexer import Person
+from cloudhands.web.paging import Cursor
+from cloudhands.web.projection import ApplianceSummary
 
 
 class VersionInfo(NamedDict):
@@ -68,6 +72,27 @@ class PathInfo(NamedDict):
     pass
 
 
+class DeltaInfo(NamedDict):
+
+    @property
+    def public(self):
+        return ["since", "latest"]
+
+
+class Tombstone(NamedDict):
+
+    @property
+    def public(self):
+        return ["uuid", "deleted"]
+
+
+class PageCursor(NamedDict):
+
+    @property
+    def public(self):
+        return []
+
+
 class ResourceInfo(OrderedDict, NamedDict):
 
     @property
@@ -82,6 +107,13 @@ class EventInfo(NamedDict):
         return ["at", "user", "event", "resources"]
 
 
+class ActivityInfo(NamedDict):
+
+    @property
+    def public(self):
+        return ["at", "user", "event", "state", "organisation"]
+
+
 class FlashInfo(NamedDict):
 
     @property
@@ -353,11 +385,7 @@ class OrganisationView(Contextual, NamedDict):
     """
 
     def configure(self, session, user):
-        prvlg = session.query(Membership).join(Organisation).join(
-            Touch).join(User).filter(
-            User.id == user.id).filter(
-            Organisation.name == self["data"]["name"]).filter(
-            Membership.role == "admin").first()
+        prvlg = privilege(session, user, self["data"]["name"])
         if not prvlg or prvlg.changes[-1].state.name in (
             "created", "invited", "expired", "withdrawn"
         ):
@@ -518,7 +546,6 @@ class NavRegion(Region):
     @present.register(Registration)
     def present_registration(artifact):
         latest = artifact.changes[-1] if artifact.changes else None 
-        resources = [r for i in artifact.changes for r in i.resources]
         hndl = latest.actor.handle if (
             latest and isinstance(latest.actor, User)) else ""
         item = {
@@ -535,6 +562,19 @@ class NavRegion(Region):
         ]
         return RegistrationView(item)
 
+    @present.register(Cursor)
+    def present_cursor(obj):
+        path = obj.path.replace("{", "{{").replace("}", "}}")
+        item = {"after": obj.token, "limit": obj.limit, "_type": "cursor"}
+        if obj.limit is None:
+            query = "?after={}"
+        else:
+            query = "?limit={}&after={{}}".format(obj.limit)
+        item["_links"] = [
+            Action("Next", "next", path + query, obj.token,
+            "get", [], "Next")]
+        return PageCursor(item)
+
 
 class ItemRegion(Region):
 
@@ -559,6 +599,18 @@ class ItemRegion(Region):
         }
         return ApplianceView(item)
 
+    @present.register(ApplianceSummary)
+    def present_appliance_summary(obj):
+        item = {
+            "uuid": obj.uuid,
+            "name": obj.label,
+            "organisation": obj.organisation,
+            "nodes": obj.nodes,
+            "ips": obj.ips,
+            "latest": obj.latest,
+        }
+        return ApplianceView(item)
+
     @present.register(BcryptedPassword)
     def present_bcryptedpassword(obj):
         now = datetime.datetime.utcnow()
@@ -673,6 +725,14 @@ class ItemRegion(Region):
     def present_pathinfo(obj):
         return obj.name("paths")
 
+    @present.register(DeltaInfo)
+    def present_deltainfo(obj):
+        return obj.name("delta")
+
+    @present.register(Tombstone)
+    def present_tombstone(obj):
+        return obj.name(obj["uuid"])
+
     @present.register(Person)
     def present_person(obj):
         item = {k: getattr(obj, k) for k in ("designator", "description")}
@@ -702,6 +762,23 @@ class ItemRegion(Region):
             "get", [], "View")]
         return EventInfo(item)
 
+    @present.register(Entry)
+    def present_entry(obj):
+        item = {
+            "at": obj.at,
+            "event": obj.typ,
+            "state": obj.state,
+            "organisation": obj.organisation,
+            "user": obj.actor,
+            "uuid": obj.uuid,
+        }
+        item["_links"] = []
+        if obj.actor_uuid is not None:
+            item["_links"].append(
+                Action(obj.typ, "collection", "/user/{}", obj.actor_uuid,
+                "get", [], "View"))
+        return ActivityInfo(item)
+
     @present.register(VersionInfo)
     def present_pathinfo(obj):
         return obj.name("versions")
@@ -766,7 +843,6 @@ class OptionRegion(Region):
     @present.register(Registration)
     def present_registration(artifact):
         latest = artifact.changes[-1] if artifact.changes else None 
-        resources = [r for i in artifact.changes for r in i.resources]
         hndl = latest.actor.handle if (
             latest and isinstance(latest.actor, User)) else ""
         item = {
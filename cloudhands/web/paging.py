@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import base64
+from collections import namedtuple
+import datetime
+import json
+
+from pyramid.httpexceptions import HTTPBadRequest
+
+__doc__ = """
+Keyset pagination for long lists.
+
+A page of results ends with a cursor. The cursor holds the sort key of
+the last item shown, so the next page is found by a query which starts
+just beyond it. Unlike an offset, this costs the same however deep the
+client reads, and does not skip or repeat items when new ones arrive.
+
+Cursors are opaque to clients. They travel in the `after` parameter of
+the query string, alongside an optional `limit`.
+"""
+
+DFLT_LIMIT = 50
+MAX_LIMIT = 200
+
+Cursor = namedtuple("Cursor", ["path", "token", "limit"])
+
+
+def timestamp(value):
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError("Bad timestamp {}".format(value))
+
+
+def encode(*values):
+    """
+    Returns a cursor token for a sort key.
+    """
+    data = json.dumps([
+        i.isoformat() if isinstance(i, datetime.datetime) else i
+        for i in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def decode(token, *types):
+    """
+    Returns the sort key held by a cursor token. Each value is
+    converted by the corresponding callable in `types`.
+    """
+    values = json.loads(
+        base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+    if len(values) != len(types):
+        raise ValueError("Bad cursor")
+    return tuple(fn(i) for fn, i in zip(types, values))
+
+
+def limit(request):
+    """
+    Returns the page size requested, within the permitted range.
+    """
+    try:
+        rv = int(request.params.get("limit", DFLT_LIMIT))
+    except ValueError:
+        raise HTTPBadRequest("Bad limit")
+    return max(1, min(rv, MAX_LIMIT))
+
+
+def cursor(request, path, *values):
+    """
+    Returns a Cursor to the page which follows the item with the sort
+    key `values`. A page size chosen by the client is kept for the
+    next page.
+    """
+    size = limit(request) if "limit" in request.params else None
+    return Cursor(path, encode(*values), size)
+
+
+def after(request, *types):
+    """
+    Returns the sort key of the cursor in `request`, or `None` for the
+    first page.
+    """
+    token = request.params.get("after", None)
+    if not token:
+        return None
+    try:
+        return decode(token, *types)
+    except (TypeError, ValueError, UnicodeError):
+        raise HTTPBadRequest("Bad cursor")
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import concurrent.futures
+import threading
+import time
+
+import bcrypt
+
+__doc__ = """
+A bounded pool for password hashing.
+
+Hashing or checking a bcrypt password at cost 12 takes a CPU for a
+sizeable fraction of a second. Done inline, a burst of logins occupies
+every server thread and page views wait behind them.
+
+A :py:class:`PasswordPool` runs that work on a few threads of its own.
+It admits only so many jobs at once, counting those running and those
+waiting. Beyond that it raises :py:class:`Overloaded` at once, so the
+server thread is free to answer `503 Service Unavailable` and get on
+with cheaper requests.
+
+The caller of an admitted job holds its server thread until the result
+arrives. :py:func:`sizes` therefore admits only a share of the server
+threads, so that the rest are left for pages.
+"""
+
+DFLT_WORKERS = 2
+DFLT_QUEUE = 8
+DFLT_ROUNDS = 12
+DFLT_TIMEOUT = 10.0
+DFLT_RETRY = 5
+DFLT_SHARE = 4
+
+
+def sizes(threads, workers=None, share=DFLT_SHARE):
+    """
+    Returns the number of workers and the queue length of a pool for a
+    server with `threads` threads.
+
+    By default the pool admits one job for every `share` server threads,
+    and at least one. No more than :py:data:`DFLT_WORKERS` of them run
+    at once. A given number of `workers` is used as it stands, but
+    always leaves one server thread free for pages. The pool then
+    admits at least that many jobs.
+    """
+    capacity = max(1, threads // share)
+    if workers is None:
+        workers = min(DFLT_WORKERS, capacity)
+    workers = max(1, min(workers, threads - 1))
+    return workers, max(capacity, workers) - workers
+
+
+class Overloaded(Exception):
+    """
+    Raised when the pool is full or a job did not finish in time.
+
+    :param int retry: Seconds after which the client may try again.
+    """
+
+    def __init__(self, msg, retry=DFLT_RETRY):
+        super().__init__(msg)
+        self.retry = retry
+
+
+class PasswordPool:
+    """
+    Runs password hashing on a fixed number of threads.
+
+    :param int workers: The number of hashing threads.
+    :param int queue: The number of jobs which may wait for a thread.
+    :param float timeout: Seconds a caller will wait for its result.
+    """
+
+    prefix = "cloudhands_password"
+
+    def __init__(
+        self, workers=DFLT_WORKERS, queue=DFLT_QUEUE, timeout=DFLT_TIMEOUT,
+        rounds=DFLT_ROUNDS
+    ):
+        self.workers = workers
+        self.queue = queue
+        self.timeout = timeout
+        self.rounds = rounds
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.seconds = 0.0
+
+    @property
+    def capacity(self):
+        return self.workers + self.queue
+
+    def _job(self, fn, args):
+        with self.lock:
+            self.running += 1
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.running -= 1
+                self.admitted -= 1
+                self.completed += 1
+                self.seconds += elapsed
+            self.slots.release()
+
+    def submit(self, fn, *args):
+        """
+        Schedules `fn(*args)` on the pool.
+
+        :returns: A Future.
+        :raises: Overloaded if the pool is full.
+        """
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise Overloaded("Password pool is full")
+        with self.lock:
+            self.admitted += 1
+        try:
+            return self.executor.submit(self._job, fn, args)
+        except RuntimeError:
+            with self.lock:
+                self.admitted -= 1
+            self.slots.release()
+            raise Overloaded("Password pool is shut down")
+
+    def run(self, fn, *args):
+        """
+        Calls `fn(*args)` on the pool and waits for the result.
+
+        :raises: Overloaded if the pool is full or the result does not
+                 arrive within `timeout` seconds.
+        """
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            # A job which has started keeps its slot until it finishes.
+            if future.cancel():
+                with self.lock:
+                    self.admitted -= 1
+                self.slots.release()
+            raise Overloaded("Password job timed out")
+
+    def check(self, password, hash):
+        return self.run(bcrypt.checkpw, password, hash)
+
+    def hash(self, password):
+        return self.run(self._hash, password, self.rounds)
+
+    @staticmethod
+    def _hash(password, rounds):
+        return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def exposition(self):
+        """
+        Yields lines of Prometheus text format.
+        """
+        with self.lock:
+            figures = (
+                ("workers", "gauge", "Threads for password hashing.",
+                    self.workers),
+                ("capacity", "gauge", "Password jobs admitted at once.",
+                    self.capacity),
+                ("running", "gauge", "Password jobs running.",
+                    self.running),
+                ("queued", "gauge", "Password jobs waiting for a thread.",
+                    self.admitted - self.running),
+                ("completed_total", "counter", "Password jobs completed.",
+                    self.completed),
+                ("rejected_total", "counter",
+                    "Password jobs refused because the pool was full.",
+                    self.rejected),
+                ("seconds_total", "counter", "Time spent on password jobs.",
+                    self.seconds),
+            )
+        for suffix, typ, descr, value in figures:
+            name = "{}_{}".format(self.prefix, suffix)
+            yield "# HELP {} {}".format(name, descr)
+            yield "# TYPE {} {}".format(name, typ)
+            yield "{} {}".format(name, value)
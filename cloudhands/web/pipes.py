@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import logging
+import os.path
+import threading
+
+from cloudhands.common.pipes import SimplePipeQueue
+
+__doc__ = """
+Long-lived writers for the token pipes of each provider.
+
+After a login the portal hands the user's credentials to the agent of
+every provider the user is subscribed to. Each provider has a named
+pipe, given in the `pipe.tokens` section of the configuration under the
+provider's name. Providers without an entry share the `vcloud` pipe.
+
+A :py:class:`PipeWriters` keeps one writer open for each pipe, so that
+a login costs a write per provider rather than an open, a write and a
+close. Writes never block. A kept writer which fails, eg: because its
+reader has restarted, is closed and the message is sent again with a
+new one. A message is dropped only if the new writer fails too.
+"""
+
+DFLT_PIPE = "vcloud"
+
+
+class PipeWriters:
+    """
+    A process-wide pool of pipe writers.
+
+    :param opener: A callable which opens a writer on a path.
+    :param bool persistent: If `False`, every writer is closed after
+                            its message is sent, as it was before this
+                            pool existed.
+    """
+
+    def __init__(self, opener=SimplePipeQueue.pipequeue, persistent=True):
+        self.opener = opener
+        self.persistent = persistent
+        self.writers = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.writers)
+
+    @staticmethod
+    def path(config, provider):
+        """
+        Returns the path of the token pipe for `provider`.
+        """
+        section = config["pipe.tokens"]
+        key = provider.name if provider.name in section else DFLT_PIPE
+        return os.path.expanduser(section[key])
+
+    def send(self, path, msg):
+        """
+        Writes `msg` to the pipe at `path` without blocking.
+
+        :returns: `True` if the message was written.
+        """
+        log = logging.getLogger("cloudhands.web.pipes")
+        with self.lock:
+            lock = self.locks.setdefault(path, threading.Lock())
+        with lock:
+            writer = self.writers.pop(path, None)
+            if writer is not None:
+                try:
+                    writer.put_nowait(msg)
+                except Exception as e:
+                    # The reader may have restarted since it was opened.
+                    log.info("Pipe {} reopened: {}".format(path, e))
+                    self.discard(writer)
+                    writer = None
+
+            if writer is None:
+                try:
+                    writer = self.opener(path)
+                    writer.put_nowait(msg)
+                except Exception as e:
+                    log.warning(
+                        "Pipe {} dropped a message: {}".format(path, e))
+                    self.discard(writer)
+                    return False
+
+            if self.persistent:
+                self.writers[path] = writer
+            else:
+                self.discard(writer)
+            return True
+
+    @staticmethod
+    def discard(writer):
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.lock:
+            paths = list(self.writers)
+        for path in paths:
+            with self.locks[path]:
+                self.discard(self.writers.pop(path, None))
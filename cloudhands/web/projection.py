@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import namedtuple
+import logging
+import weakref
+
+from sqlalchemy import and_
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import Index
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import or_
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import desc
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import subqueryload
+
+from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import Label
+from cloudhands.common.schema import NATRouting
+from cloudhands.common.schema import Node
+from cloudhands.common.schema import Resource
+from cloudhands.common.schema import Touch
+
+from cloudhands.identity.database import create_indexes
+from cloudhands.identity.database import has_table
+
+__doc__ = """
+A projection of the latest state of every artifact.
+
+The history of an artifact is its list of Touches. Pages which show
+many artifacts need only the most recent state of each, along with a
+summary of some resources. This module keeps one row per artifact in
+the `artifact_latest` table with that information. The table is updated
+in the same transaction as each flush which adds a Touch or Resource,
+so it is consistent with the history written by this process.
+
+The table belongs to this package and has its own metadata.
+:py:func:`create` makes it and fills it from the existing history.
+While the table is missing, :py:func:`available` is `False` and pages
+fall back to reading the history.
+
+Other processes, eg: the identity and burst controllers, add Touches
+without this module to project them. The greatest Touch id in the
+projection is its high water mark. While a newer Touch exists,
+:py:func:`current` is `False` and pages fall back to the history
+again. :py:func:`catch_up` folds the newer Touches in. The web server
+runs it periodically, and :py:func:`create` runs it at start up.
+
+Resources removed by bulk deletes are not seen by the session, so
+they may linger in the summary until :py:func:`rebuild` is run.
+"""
+
+DFLT_BATCH = 1000
+DFLT_CHUNK = 500  # SQLite allows 999 parameters in a statement
+
+metadata = MetaData()
+
+latest = Table(
+    "artifact_latest", metadata,
+    Column("artifact_id", Integer, primary_key=True, autoincrement=False),
+    Column("uuid", String(32), nullable=False),
+    Column("typ", String(32), nullable=False),
+    Column("organisation_id", Integer, nullable=True),
+    Column("organisation", String(64), nullable=True),
+    Column("touch_id", Integer, nullable=True),
+    Column("fsm", String(32), nullable=True),
+    Column("state", String(32), nullable=True),
+    Column("at", DateTime, nullable=True),
+    Column("label", String(128), nullable=True),
+    Column("nodes", String, nullable=False, default=""),
+    Column("nat", String, nullable=False, default=""),
+    Column("ips", String, nullable=False, default=""),
+    Index("ix_artifact_latest_org_typ_at", "organisation_id", "typ", "at"),
+    Index("ix_artifact_latest_touch", "touch_id"),
+)
+
+StateName = namedtuple("StateName", ["fsm", "name"])
+
+ApplianceSummary = namedtuple(
+    "ApplianceSummary",
+    ["uuid", "organisation", "label", "nodes", "ips", "latest", "id"])
+
+_present = weakref.WeakKeyDictionary()
+
+
+class Latest:
+    """
+    The most recent change to an artifact. It has the `state` and `at`
+    attributes of a Touch so that templates may treat it as one.
+    """
+
+    def __init__(self, fsm, state, at):
+        self.state = StateName(fsm, state)
+        self.at = at
+
+
+def split(value):
+    return [i for i in (value or "").split(", ") if i]
+
+
+def fold_touch(row, touch):
+    if row.get("touch_id") is None or touch.id >= row["touch_id"]:
+        row.update(
+            touch_id=touch.id, fsm=touch.state.fsm,
+            state=touch.state.name, at=touch.at)
+    return row
+
+
+def fold_resource(row, resource):
+    for typ, key, attr in (
+        (Node, "nodes", "name"),
+        (NATRouting, "nat", "ip_ext"),
+        (IPAddress, "ips", "value"),
+    ):
+        if isinstance(resource, typ):
+            row[key] = ", ".join(
+                split(row.get(key)) + [getattr(resource, attr)])
+    if isinstance(resource, Label):
+        row["label"] = resource.name
+    return row
+
+
+def blank(artifact):
+    org = getattr(artifact, "organisation", None)
+    return {
+        "artifact_id": artifact.id,
+        "uuid": artifact.uuid,
+        "typ": type(artifact).__name__.lower(),
+        "organisation_id": getattr(org, "id", None),
+        "organisation": getattr(org, "name", None),
+        "touch_id": None,
+        "nodes": "",
+        "nat": "",
+        "ips": "",
+    }
+
+
+def available(session):
+    """
+    Returns `True` if the projection table exists in the database
+    behind `session`.
+    """
+    return has_table(session, latest, _present)
+
+
+def high_water(connection):
+    """
+    Returns the id of the newest Touch in the projection, or zero.
+    """
+    return connection.execute(
+        select([func.max(latest.c.touch_id)])).scalar() or 0
+
+
+def behind(connection, before=None):
+    """
+    Returns `True` if there is a Touch newer than the high water mark,
+    not counting those with ids from `before` on. This is one statement
+    on two indexes.
+    """
+    touch = Touch.__table__
+    newest = select([func.max(touch.c.id)])
+    if before is not None:
+        newest = newest.where(touch.c.id < before)
+    mark = select([func.coalesce(func.max(latest.c.touch_id), 0)])
+    return bool(connection.execute(
+        select([newest.as_scalar() > mark.as_scalar()])).scalar())
+
+
+def current(session):
+    """
+    Returns `True` if the projection holds every Touch in the database.
+    """
+    return not behind(session.connection())
+
+
+def store(connection, rows, chunk=DFLT_CHUNK):
+    """
+    Merges the partial `rows` into the projection. Each row is a dict
+    as made by :py:func:`blank` and updated by the fold functions.
+    """
+    if not rows:
+        return
+    keys = list(rows)
+    held = {}
+    for n in range(0, len(keys), chunk):
+        held.update(
+            (r["artifact_id"], dict(r.items())) for r in connection.execute(
+                select([latest]).where(
+                    latest.c.artifact_id.in_(keys[n:n + chunk]))))
+    for key, row in rows.items():
+        if key in held:
+            old = held[key]
+            if old["touch_id"] is not None and (
+                row["touch_id"] is None or old["touch_id"] > row["touch_id"]
+            ):
+                row.update(
+                    (k, old[k]) for k in ("touch_id", "fsm", "state", "at"))
+            for k in ("nodes", "nat", "ips"):
+                row[k] = ", ".join(split(old[k]) + split(row[k]))
+            row["label"] = row.get("label") or old["label"]
+            connection.execute(latest.update().where(
+                latest.c.artifact_id == key).values(**row))
+        else:
+            connection.execute(latest.insert().values(**row))
+
+
+@event.listens_for(Session, "after_flush")
+def project(session, context):
+    touches = [i for i in session.new if isinstance(i, Touch)]
+    resources = [i for i in session.new if isinstance(i, Resource)]
+    if not (touches or resources) or not available(session):
+        return
+
+    connection = session.connection()
+    if touches:
+        if behind(connection, min(i.id for i in touches)):
+            # Leave these to catch_up, which folds in the missing ones
+            # first. Projecting these now would raise the high water
+            # mark over the gap.
+            return
+        mark = max(i.id for i in touches)
+    else:
+        mark = high_water(connection)
+
+    rows = {}
+    for touch in touches:
+        artifact = touch.artifact
+        row = rows.setdefault(artifact.id, blank(artifact))
+        fold_touch(row, touch)
+    for resource in resources:
+        touch = resource.touch
+        if touch is None or touch.id > mark:
+            continue
+        artifact = touch.artifact
+        row = rows.setdefault(artifact.id, blank(artifact))
+        fold_resource(row, resource)
+    store(connection, rows)
+
+
+def fold_history(session, rows, lo=0, batch=DFLT_BATCH):
+    """
+    Folds into `rows` every Touch with an id greater than `lo`, and
+    the Resources of each.
+    """
+    while True:
+        touches = session.query(Touch).options(
+            joinedload(Touch.artifact), joinedload(Touch.state),
+            subqueryload(Touch.resources)).filter(
+            Touch.id > lo).order_by(Touch.id).limit(batch).all()
+        if not touches:
+            break
+        for touch in touches:
+            row = rows.setdefault(touch.artifact.id, blank(touch.artifact))
+            fold_touch(row, touch)
+            for resource in touch.resources:
+                fold_resource(row, resource)
+        lo = touches[-1].id
+        session.expunge_all()
+    return rows
+
+
+def rebuild(session, batch=DFLT_BATCH):
+    """
+    Refills the projection from the history of every artifact.
+    """
+    log = logging.getLogger("cloudhands.web.projection.rebuild")
+    connection = session.connection()
+    connection.execute(latest.delete())
+    rows = fold_history(session, {}, batch=batch)
+    for row in rows.values():
+        connection.execute(latest.insert().values(**row))
+    session.commit()
+    log.info("Projected {} artifacts".format(len(rows)))
+    return len(rows)
+
+
+def catch_up(session, batch=DFLT_BATCH):
+    """
+    Folds into the projection the Touches which are newer than its
+    high water mark, and commits.
+
+    :returns: The number of artifacts updated.
+    """
+    log = logging.getLogger("cloudhands.web.projection.catch_up")
+    if not available(session):
+        return 0
+    connection = session.connection()
+    rows = fold_history(session, {}, lo=high_water(connection), batch=batch)
+    store(connection, rows)
+    session.commit()
+    if rows:
+        log.info("Caught up with {} artifacts".format(len(rows)))
+    return len(rows)
+
+
+def create(session):
+    """
+    Creates the projection table if need be. Fills it if empty,
+    otherwise catches up with the Touches made since it was last used.
+
+    :param object session:  A SQLALchemy database session.
+    :returns: The session.
+    """
+    connection = session.connection()
+    metadata.create_all(connection)
+    _present[session.get_bind()] = True
+    create_indexes(session, latest.indexes)
+    if connection.execute(select([latest.c.artifact_id]).limit(1)).first():
+        catch_up(session)
+    else:
+        rebuild(session)
+    return session
+
+
+def appliances(session, org, limit=None, after=None):
+    """
+    Returns the ApplianceSummary of appliances in `org`, most
+    recently changed first. This is one query on an index, whatever
+    the length of their histories.
+
+    :param int limit: The greatest number of appliances to return.
+    :param tuple after: The (timestamp, id) of the last appliance on
+                        the previous page.
+    """
+    query = select([latest]).where(
+        latest.c.organisation_id == org.id).where(
+        latest.c.typ == "appliance")
+    if after is not None:
+        at, key = after
+        query = query.where(or_(
+            latest.c.at < at,
+            and_(latest.c.at == at, latest.c.artifact_id < key)))
+    query = query.order_by(desc(latest.c.at), desc(latest.c.artifact_id))
+    if limit is not None:
+        query = query.limit(limit)
+
+    return [
+        ApplianceSummary(
+            r["uuid"], r["organisation"], r["label"], split(r["nodes"]),
+            ", ".join(split(r["nat"]) + split(r["ips"])),
+            Latest(r["fsm"], r["state"], r["at"]), r["artifact_id"])
+        for r in session.connection().execute(query)]
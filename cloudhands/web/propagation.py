@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import namedtuple
+import datetime
+import logging
+import queue
+import threading
+import time
+
+from cloudhands.common.schema import Label
+from cloudhands.common.schema import Registration
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+
+from cloudhands.identity.ldap_account import change_password
+
+__doc__ = """
+Propagation of passwords to LDAP after login.
+
+Setting a password in LDAP runs `ldappasswd`, which may take seconds.
+`login_update` makes one attempt, bounded by `timeout`. If it times
+out, the login fails as it always has. If `ldappasswd` fails otherwise,
+the login goes ahead and a :py:class:`PasswordJob` is handed to a
+:py:class:`Propagator`, which retries it on a thread of its own.
+
+Every outcome which differs from the one last recorded is recorded on
+the registration as a Touch which carries a `Label` named `ldappasswd`.
+Its description is `ok` or the reason for failure. So the history grows
+only when propagation starts to fail or recovers, not at every login.
+
+The password itself is never stored, so jobs are not durable. A failed
+attempt is recorded before the login responds, though, so a job lost
+when the process stops leaves its failure in the history. The job is
+made again at the next login.
+"""
+
+DFLT_ATTEMPTS = 3
+DFLT_BACKLOG = 256
+DFLT_DELAY = 2.0
+DFLT_TIMEOUT = 3
+
+LABEL = "ldappasswd"
+
+PasswordJob = namedtuple(
+    "PasswordJob", ["reg_uuid", "user_id", "uid", "password"])
+
+
+def attempt(job, change=change_password, timeout=DFLT_TIMEOUT):
+    """
+    Runs `ldappasswd` once for `job`.
+
+    :returns: `ok` or a description of the failure.
+    """
+    status = change(job.uid, job.password, timeout=timeout)
+    if status is None:
+        return "timeout"
+    elif status:
+        return "exit status {}".format(status)
+    else:
+        return "ok"
+
+
+def recorded(session, reg):
+    """
+    Returns the last outcome recorded for `reg`, or `None`.
+    """
+    row = session.query(Label.description).join(Touch).filter(
+        Touch.artifact_id == reg.id).filter(
+        Label.name == LABEL).order_by(Touch.id.desc()).first()
+    return row[0] if row else None
+
+
+def record(session, job, outcome):
+    """
+    Adds a Touch to the registration of `job` with a Label describing
+    `outcome`, unless that is the outcome last recorded. A first
+    success is not recorded either. The registration keeps its latest
+    state.
+
+    :param object session:  A SQLALchemy database session.
+    :returns: The Touch, or `None` if nothing was recorded.
+    """
+    reg = session.query(Registration).filter(
+        Registration.uuid == job.reg_uuid).first()
+    user = session.query(User).get(job.user_id)
+    if reg is None or user is None:
+        return None
+
+    outcome = outcome[:64]
+    if outcome == (recorded(session, reg) or "ok"):
+        return None
+
+    latest = session.query(Touch).filter(
+        Touch.artifact_id == reg.id).order_by(Touch.id.desc()).first()
+    now = datetime.datetime.utcnow()
+    act = Touch(artifact=reg, actor=user, state=latest.state, at=now)
+    session.add(Label(name=LABEL, description=outcome, touch=act))
+    session.commit()
+    return act
+
+
+def propagate(
+    session, job, change=change_password, attempts=DFLT_ATTEMPTS,
+    delay=DFLT_DELAY
+):
+    """
+    Sets the LDAP password for `job`, retrying on failure, and records
+    the outcome if it has changed.
+
+    :returns: The Touch which records the outcome, or `None`.
+    """
+    log = logging.getLogger("cloudhands.web.propagation")
+    for n in range(attempts):
+        if n:
+            time.sleep(delay * n)
+        outcome = attempt(job, change)
+        if outcome == "ok":
+            break
+        log.warning("ldappasswd for {} failed: {}".format(job.uid, outcome))
+    else:
+        log.error("Password for {} not propagated after {} attempts".format(
+            job.uid, attempts))
+    return record(session, job, outcome)
+
+
+class Propagator:
+    """
+    Carries out PasswordJobs on a background thread.
+
+    :param sessions: A SQLAlchemy session factory.
+    :param int backlog: The number of jobs which may wait.
+    """
+
+    def __init__(
+        self, sessions, change=change_password, attempts=DFLT_ATTEMPTS,
+        delay=DFLT_DELAY, backlog=DFLT_BACKLOG
+    ):
+        self.sessions = sessions
+        self.change = change
+        self.attempts = attempts
+        self.delay = delay
+        self.jobs = queue.Queue(maxsize=backlog)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="cloudhands.web.propagation",
+                    daemon=True)
+                self.thread.start()
+
+    def submit(self, job):
+        """
+        Queues `job`.
+
+        :returns: `True` if the job was accepted, `False` if the backlog
+                  is full.
+        """
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            return False
+        self.start()
+        return True
+
+    def run(self):
+        log = logging.getLogger("cloudhands.web.propagation.run")
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            session = self.sessions()
+            try:
+                propagate(
+                    session, job, self.change, self.attempts, self.delay)
+            except Exception as e:
+                log.error(e)
+                session.rollback()
+            finally:
+                session.close()
+                self.jobs.task_done()
+
+    def stop(self):
+        self.jobs.put(None)
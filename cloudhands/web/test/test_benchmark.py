@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import unittest
+
+from cloudhands.web.benchmark import parser
+from cloudhands.web.benchmark import percentile
+from cloudhands.web.benchmark import summary
+
+
+class PercentileTests(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertIsNone(percentile([], 50))
+
+    def test_nearest_rank(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(95, percentile(values, 95))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(100, percentile(values, 100))
+
+    def test_summary(self):
+        rv = summary([0.1, 0.2, 0.3, 0.4])
+        self.assertEqual(4, rv["requests"])
+        self.assertEqual(0.2, rv["p50"])
+        self.assertEqual(0.4, rv["p99"])
+        self.assertAlmostEqual(4.0, rv["rps"])
+
+
+class ParserTests(unittest.TestCase):
+
+    def test_default_scenario(self):
+        self.assertEqual("threads", parser().parse_args([]).scenario)
+
+    def test_empty_volume_refused(self):
+        for opt in ("--orgs", "--users"):
+            with self.subTest(opt=opt):
+                self.assertRaises(
+                    SystemExit, parser().parse_args, [opt, "0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import unittest
+
+from cloudhands.web.cache import TTLCache
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTests(unittest.TestCase):
+
+    def test_missing_key(self):
+        cache = TTLCache()
+        self.assertRaises(KeyError, cache.__getitem__, "nobody")
+        self.assertIsNone(cache.get("nobody"))
+        self.assertEqual(2, cache.misses)
+
+    def test_store_and_retrieve(self):
+        cache = TTLCache()
+        cache["somebody"] = 1
+        self.assertIn("somebody", cache)
+        self.assertEqual(1, cache["somebody"])
+        self.assertEqual(1, cache.hits)
+
+    def test_entries_expire(self):
+        clock = Clock()
+        cache = TTLCache(ttl=10, clock=clock)
+        cache["somebody"] = 1
+        clock.now = 10
+        self.assertEqual(1, cache["somebody"])
+        clock.now = 11
+        self.assertNotIn("somebody", cache)
+        self.assertEqual(0, len(cache))
+
+    def test_least_recently_used_evicted(self):
+        cache = TTLCache(maxlen=2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache["a"]
+        cache["c"] = 3
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+
+    def test_discard(self):
+        cache = TTLCache()
+        cache["somebody"] = 1
+        cache.discard("somebody")
+        cache.discard("nobody")
+        self.assertNotIn("somebody", cache)
+
+    def test_discard_values(self):
+        cache = TTLCache()
+        cache["somebody"] = 1
+        cache["somebody@somewhere.org"] = 1
+        cache["other"] = 2
+        cache.discard_values({1})
+        self.assertEqual(1, len(cache))
+        self.assertIn("other", cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import argparse
+import datetime
+import logging
+import multiprocessing
+import os.path
+import sqlite3
+import tempfile
+import types
+import unittest
+import unittest.mock
+import uuid
+
+from pyramid.request import Request
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+import cloudhands.common
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Membership
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Registration
+from cloudhands.common.schema import State
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+from cloudhands.common.states import ApplianceState
+from cloudhands.common.states import MembershipState
+from cloudhands.common.states import RegistrationState
+
+from cloudhands.identity.database import bootstrap
+from cloudhands.web.database import busy
+from cloudhands.web.database import busy_retry_tween_factory
+from cloudhands.web.database import pooled_sessions
+from cloudhands.web.database import request_session
+from cloudhands.web.database import retrying
+from cloudhands.web.hateoas import Streamed
+from cloudhands.web.main import configure
+from cloudhands.web.main import registered_connection
+from cloudhands.web.main import wsgi_app
+
+
+def touch_registration(path, number):
+    """
+    Acts as a separate process (eg: cloud-identity) which writes
+    to the database.
+    """
+    session = bootstrap(pooled_sessions(path, size=1)())
+    reg = session.query(Registration).one()
+    user = session.query(User).one()
+    state = reg.changes[-1].state
+    for n in range(number):
+        now = datetime.datetime.utcnow()
+        session.add(Touch(artifact=reg, actor=user, state=state, at=now))
+        session.commit()
+    session.close()
+
+
+class PooledSessionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.td.name, "test.sl3")
+        initialise(Registry().connect(sqlite3, self.path).session)
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, self.path)
+        self.td.cleanup()
+
+    @staticmethod
+    def make_request(sessions):
+        request = unittest.mock.Mock(exception=None)
+        request.registry.settings = {"sessions": sessions}
+        return request
+
+    def test_memory_database_is_not_pooled(self):
+        self.assertIsNone(pooled_sessions(":memory:"))
+
+    def test_file_database_is_pooled(self):
+        sessions = pooled_sessions(self.path, size=3)
+        session = sessions()
+        self.assertIsInstance(session.get_bind().pool, QueuePool)
+        self.assertTrue(session.query(State).count())
+        session.close()
+
+    def test_each_request_has_its_own_session(self):
+        sessions = pooled_sessions(self.path)
+        a = request_session(PooledSessionTests.make_request(sessions))
+        b = request_session(PooledSessionTests.make_request(sessions))
+        self.assertIsNot(a, b)
+
+    def test_session_released_when_request_finished(self):
+        sessions = pooled_sessions(self.path, size=1)
+        pool = sessions.kw["bind"].pool
+        request = PooledSessionTests.make_request(sessions)
+        session = request_session(request)
+        session.query(State).count()
+        self.assertEqual(1, pool.checkedout())
+
+        callback = request.add_finished_callback.call_args[0][0]
+        callback(request)
+        self.assertEqual(0, pool.checkedout())
+
+    def test_session_kept_for_streamed_body(self):
+        sessions = pooled_sessions(self.path, size=1)
+        pool = sessions.kw["bind"].pool
+        request = PooledSessionTests.make_request(sessions)
+        session = request_session(request)
+        session.query(State).count()
+        request.response = types.SimpleNamespace(app_iter=Streamed([b"{}"]))
+
+        callback = request.add_finished_callback.call_args[0][0]
+        callback(request)
+        self.assertEqual(1, pool.checkedout())
+        request.response.app_iter.close()
+        self.assertEqual(0, pool.checkedout())
+
+    def test_registered_connection_prefers_request_session(self):
+        sessions = pooled_sessions(self.path)
+        request = PooledSessionTests.make_request(sessions)
+        request.db_session = request_session(request)
+        self.assertIs(
+            request.db_session, registered_connection(request).session)
+
+
+class StreamedRouteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.args = argparse.Namespace(
+            db=os.path.join(self.td.name, "test.sl3"),
+            log_level=logging.WARNING, threads=2, workers=1, port=8080)
+        self.cfg, session = configure(self.args)
+        user = User(handle="TestUser", uuid=uuid.uuid4().hex)
+        org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        active = session.query(MembershipState).filter(
+            MembershipState.name == "active").one()
+        configuring = session.query(ApplianceState).filter(
+            ApplianceState.name == "configuring").one()
+        now = datetime.datetime.utcnow()
+        session.add(Touch(
+            artifact=Membership(
+                uuid=uuid.uuid4().hex, model=cloudhands.common.__version__,
+                organisation=org, role="user"),
+            actor=user, state=active, at=now))
+        for n in range(80):
+            session.add(Touch(
+                artifact=Appliance(
+                    uuid=uuid.uuid4().hex,
+                    model=cloudhands.common.__version__, organisation=org),
+                actor=user, state=configuring, at=now))
+        session.commit()
+        session.close()
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, self.args.db)
+        self.td.cleanup()
+
+    def test_session_open_while_body_is_sent(self):
+        with unittest.mock.patch(
+            "cloudhands.web.main.authenticated_userid",
+            return_value="TestUser"
+        ):
+            app = wsgi_app(self.args, self.cfg)
+            pool = app.registry.settings["sessions"].kw["bind"].pool
+            environ = Request.blank("/feed?limit=100").environ
+            start_response = unittest.mock.Mock()
+            body = app(environ, start_response)
+
+        self.assertTrue(start_response.call_args[0][0].startswith("200"))
+        chunks = iter(body)
+        self.assertTrue(next(chunks))
+        self.assertEqual(1, pool.checkedout())
+        b"".join(chunks)
+        body.close()
+        self.assertEqual(0, pool.checkedout())
+
+
+class RetryTests(unittest.TestCase):
+
+    def test_busy_detection(self):
+        locked = OperationalError("COMMIT", {}, "database is locked")
+        other = OperationalError("SELECT", {}, "no such table: x")
+        self.assertTrue(busy(locked))
+        self.assertFalse(busy(other))
+
+    def test_retrying_until_unlocked(self):
+        locked = OperationalError("COMMIT", {}, "database is locked")
+        outcomes = [locked, locked, "done"]
+        undo = unittest.mock.Mock()
+
+        def attempt():
+            rv = outcomes.pop(0)
+            if isinstance(rv, Exception):
+                raise rv
+            return rv
+
+        self.assertEqual(
+            "done", retrying(attempt, attempts=3, interval=0, undo=undo))
+        self.assertEqual(2, undo.call_count)
+
+    def test_retrying_gives_up(self):
+        locked = OperationalError("COMMIT", {}, "database is locked")
+
+        def attempt():
+            raise locked
+
+        self.assertRaises(
+            OperationalError, retrying, attempt, attempts=2, interval=0)
+
+
+class BusyRetryTweenTests(unittest.TestCase):
+
+    @staticmethod
+    def make_tween(outcomes):
+        locked = OperationalError("COMMIT", {}, "database is locked")
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            rv = outcomes.pop(0)
+            if rv is None:
+                raise locked
+            return rv
+
+        registry = unittest.mock.Mock(settings={"db.retries": 3})
+        return busy_retry_tween_factory(handler, registry), calls
+
+    def test_get_is_retried(self):
+        tween, calls = BusyRetryTweenTests.make_tween([None, "done"])
+        request = unittest.mock.Mock(method="GET")
+        with unittest.mock.patch("cloudhands.web.database.time.sleep"):
+            self.assertEqual("done", tween(request))
+        self.assertEqual(2, len(calls))
+
+    def test_post_is_not_retried(self):
+        tween, calls = BusyRetryTweenTests.make_tween([None, "done"])
+        request = unittest.mock.Mock(method="POST")
+        self.assertRaises(OperationalError, tween, request)
+        self.assertEqual(1, len(calls))
+
+    def test_get_is_not_retried_after_commit(self):
+        tween, calls = BusyRetryTweenTests.make_tween([None, "done"])
+        request = unittest.mock.Mock(method="GET")
+        request.db_session = unittest.mock.Mock(info={"committed": True})
+        self.assertRaises(OperationalError, tween, request)
+        self.assertEqual(1, len(calls))
+        self.assertFalse(request.db_session.rollback.called)
+
+    def test_request_session_records_commit(self):
+        session = Registry().connect(sqlite3, ":memory:").session
+        try:
+            request = unittest.mock.Mock()
+            request.registry.settings = {"sessions": lambda: session}
+            rv = request_session(request)
+            self.assertNotIn("committed", rv.info)
+            rv.commit()
+            self.assertTrue(rv.info["committed"])
+        finally:
+            Registry().disconnect(sqlite3, ":memory:")
+
+
+class ConcurrentAccessTests(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.td.name, "test.sl3")
+        session = bootstrap(Registry().connect(sqlite3, self.path).session)
+        initialise(session)
+        state = session.query(RegistrationState).filter(
+            RegistrationState.name == "pre_registration_person").one()
+        reg = Registration(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__)
+        user = User(handle="TestUser", uuid=uuid.uuid4().hex)
+        now = datetime.datetime.utcnow()
+        session.add(Touch(artifact=reg, actor=user, state=state, at=now))
+        session.commit()
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, self.path)
+        self.td.cleanup()
+
+    def test_journal_mode_is_wal(self):
+        session = pooled_sessions(self.path)()
+        mode = session.execute("PRAGMA journal_mode").scalar()
+        self.assertEqual("wal", mode.lower())
+        session.close()
+
+    def test_web_and_identity_processes_share_database(self):
+        writers, number = 3, 50
+        ctx = multiprocessing.get_context("spawn")
+        procs = [
+            ctx.Process(target=touch_registration, args=(self.path, number))
+            for i in range(writers)]
+        for p in procs:
+            p.start()
+
+        # Meanwhile the web server reads and writes through its own pool.
+        sessions = pooled_sessions(self.path, size=2)
+        for n in range(number):
+            session = sessions()
+            reg = session.query(Registration).one()
+            self.assertTrue(reg.changes)
+            now = datetime.datetime.utcnow()
+            session.add(Touch(
+                artifact=reg, actor=reg.changes[0].actor,
+                state=reg.changes[0].state, at=now))
+            session.commit()
+            session.close()
+
+        for p in procs:
+            p.join(timeout=60)
+            self.assertEqual(0, p.exitcode)
+
+        session = sessions()
+        self.assertEqual(
+            1 + number + writers * number, session.query(Touch).count())
+        session.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
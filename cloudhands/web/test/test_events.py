@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import datetime
+import sqlite3
+import unittest
+import uuid
+
+import cloudhands.common
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+from cloudhands.common.states import ApplianceState
+
+from cloudhands.web.events import EventBroker
+from cloudhands.web.events import EventStream
+from cloudhands.web.events import stream_limit
+
+
+class EventBrokerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        initialise(self.session)
+        self.org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        self.user = User(handle="TestUser", uuid=uuid.uuid4().hex)
+        self.session.add_all((self.org, self.user))
+        self.session.commit()
+        self.broker = EventBroker(lambda: self.session, streams=2)
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, ":memory:")
+
+    def touch_appliance(self, name="configuring"):
+        state = self.session.query(ApplianceState).filter(
+            ApplianceState.name == name).one()
+        app = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=self.org)
+        act = Touch(
+            artifact=app, actor=self.user, state=state,
+            at=datetime.datetime.utcnow())
+        self.session.add(act)
+        self.session.commit()
+        return act
+
+    def test_first_poll_sees_nothing_old(self):
+        self.touch_appliance()
+        self.assertEqual([], self.broker.poll(self.session))
+        self.assertEqual([], self.broker.poll(self.session))
+
+    def test_poll_sees_new_appliance_touches(self):
+        self.broker.poll(self.session)
+        act = self.touch_appliance("pre_provision")
+        changes = self.broker.poll(self.session)
+        self.assertEqual(1, len(changes))
+        self.assertEqual(act.id, changes[0].id)
+        self.assertEqual("pre_provision", changes[0].state)
+        self.assertEqual("TestOrg", changes[0].organisation)
+
+    def test_subscribers_receive_their_organisation_only(self):
+        self.broker.poll(self.session)
+        mine = self.broker.subscribe("TestOrg")
+        other = self.broker.subscribe("OtherOrg")
+        self.touch_appliance()
+        self.broker.publish(self.broker.poll(self.session))
+        self.assertEqual(1, mine.queue.qsize())
+        self.assertTrue(other.queue.empty())
+
+    def test_subscribers_are_limited(self):
+        self.assertIsNotNone(self.broker.subscribe("TestOrg"))
+        sub = self.broker.subscribe("TestOrg")
+        self.assertIsNone(self.broker.subscribe("TestOrg"))
+        self.broker.unsubscribe(sub)
+        self.assertIsNotNone(self.broker.subscribe("TestOrg"))
+
+    def test_streams_leave_threads_for_pages(self):
+        self.assertEqual(0, stream_limit(1))
+        self.assertEqual(2, stream_limit(4))
+        self.assertLessEqual(stream_limit(1000), 1000 // 2)
+
+    def test_reconnection_replays_missed_events(self):
+        self.broker.poll(self.session)
+        self.touch_appliance()
+        self.touch_appliance()
+        first, second = self.broker.poll(self.session)
+        self.broker.publish((first, second))
+        sub = self.broker.subscribe("TestOrg", lastId=first.id)
+        self.assertEqual(second, sub.queue.get_nowait())
+        self.assertTrue(sub.queue.empty())
+
+    def test_stream_frames_events(self):
+        self.broker.poll(self.session)
+        sub = self.broker.subscribe("TestOrg")
+        act = self.touch_appliance()
+        self.broker.publish(self.broker.poll(self.session))
+        stream = EventStream(self.broker, sub, heartbeat=0.01, lifetime=0.1)
+        frames = list(stream)
+        self.assertTrue(frames[0].startswith(b"retry:"))
+        self.assertIn("id: {}\n".format(act.id).encode("utf-8"), frames[1])
+        self.assertIn(b"event: touch\n", frames[1])
+        stream.close()
+        self.assertEqual(0, len(self.broker))
+
+
+if __name__ == "__main__":
+    unittest.main()
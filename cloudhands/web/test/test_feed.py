@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import datetime
+import sqlite3
+import unittest
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import cloudhands.common
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+from cloudhands.common.states import ApplianceState
+
+from cloudhands.web.delta import Since
+from cloudhands.web.feed import catch_up
+from cloudhands.web.feed import changes
+from cloudhands.web.feed import create
+from cloudhands.web.feed import first_page
+from cloudhands.web.feed import record
+from cloudhands.web.feed import recent
+from cloudhands.web.feed import register
+from cloudhands.web.feed import Rings
+from cloudhands.web.metrics import StatementLog
+
+
+class FeedTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        initialise(self.session)
+        self.orgs = [
+            Organisation(uuid=uuid.uuid4().hex, name="TestOrg{}".format(n))
+            for n in range(2)]
+        self.user = User(handle="TestUser", uuid=uuid.uuid4().hex)
+        self.session.add_all(self.orgs + [self.user])
+        self.session.commit()
+        self.start = datetime.datetime.utcnow()
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, ":memory:")
+
+    def touch_appliance(self, org, n):
+        state = self.session.query(ApplianceState).filter(
+            ApplianceState.name == "configuring").one()
+        app = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=org)
+        act = Touch(
+            artifact=app, actor=self.user, state=state,
+            at=self.start + datetime.timedelta(seconds=n))
+        self.session.add(act)
+        self.session.commit()
+        return act
+
+    def touch_elsewhere(self, org, n):
+        """
+        Adds a Touch as another process would, unseen by the session.
+        """
+        event.remove(Session, "after_flush", record)
+        try:
+            return self.touch_appliance(org, n)
+        finally:
+            event.listen(Session, "after_flush", record)
+
+    def test_create_fills_from_history(self):
+        acts = [self.touch_appliance(self.orgs[n % 2], n) for n in range(4)]
+        create(self.session)
+        rv = recent(self.session, [self.orgs[0].id], 10)
+        self.assertEqual([acts[2].id, acts[0].id], [i.touch_id for i in rv])
+        self.assertEqual("appliance", rv[0].typ)
+        self.assertEqual("TestOrg0", rv[0].organisation)
+        self.assertEqual("TestUser", rv[0].actor)
+
+    def test_feed_is_paged(self):
+        create(self.session)
+        acts = [self.touch_appliance(self.orgs[n % 2], n) for n in range(5)]
+        ids = [i.id for i in self.orgs]
+        first = recent(self.session, ids, 3)
+        self.assertEqual(
+            [i.id for i in reversed(acts[2:])], [i.touch_id for i in first])
+        rest = recent(
+            self.session, ids, 3, (first[-1].at, first[-1].touch_id))
+        self.assertEqual(
+            [i.id for i in reversed(acts[:2])], [i.touch_id for i in rest])
+
+    def test_changes_are_not_capped(self):
+        create(self.session)
+        acts = [self.touch_appliance(self.orgs[n % 2], n) for n in range(8)]
+        ids = [self.orgs[0].id]
+        rv = changes(self.session, ids, Since(acts[0].id, None), acts[-1].id)
+        self.assertEqual(
+            [i.id for i in reversed(acts[2::2])], [i.touch_id for i in rv])
+        rv = changes(self.session, ids, Since(None, acts[1].at), acts[5].id)
+        self.assertEqual(
+            [acts[4].id, acts[2].id], [i.touch_id for i in rv])
+
+    def test_first_page_from_rings(self):
+        create(self.session)
+        rings = register(Rings(size=4))
+        ids = [i.id for i in self.orgs]
+        acts = [self.touch_appliance(self.orgs[n % 2], n) for n in range(3)]
+        self.assertEqual(
+            [i.touch_id for i in recent(self.session, ids, 3)],
+            [i.touch_id for i in first_page(self.session, rings, ids, 3)])
+
+        act = self.touch_appliance(self.orgs[1], 10)
+        with StatementLog() as log:
+            rv = first_page(self.session, rings, ids, 3)
+        self.assertEqual(0, len(log))
+        self.assertEqual(
+            [act.id, acts[2].id, acts[1].id], [i.touch_id for i in rv])
+
+    def test_touches_from_elsewhere_are_caught_up(self):
+        create(self.session)
+        ids = [i.id for i in self.orgs]
+        mine = self.touch_appliance(self.orgs[0], 0)
+        other = self.touch_elsewhere(self.orgs[1], 1)
+        self.assertEqual(
+            [mine.id], [i.touch_id for i in recent(self.session, ids, 3)])
+
+        self.assertEqual(1, catch_up(self.session))
+        self.assertEqual(
+            [other.id, mine.id],
+            [i.touch_id for i in recent(self.session, ids, 3)])
+        self.assertEqual(0, catch_up(self.session))
+
+    def test_create_catches_up(self):
+        create(self.session)
+        act = self.touch_elsewhere(self.orgs[0], 0)
+        create(self.session)
+        self.assertEqual(
+            [act.id],
+            [i.touch_id for i in recent(self.session, [self.orgs[0].id], 3)])
+
+    def test_catch_up_primes_rings_again(self):
+        create(self.session)
+        rings = register(Rings(size=4))
+        ids = [i.id for i in self.orgs]
+        acts = [self.touch_appliance(self.orgs[n % 2], n) for n in range(2)]
+        first_page(self.session, rings, ids, 3)
+
+        act = self.touch_elsewhere(self.orgs[0], 10)
+        rv = first_page(self.session, rings, ids, 3)
+        self.assertNotIn(act.id, [i.touch_id for i in rv])
+
+        catch_up(self.session)
+        self.assertEqual([self.orgs[0].id], rings.missing(ids))
+        rv = first_page(self.session, rings, ids, 3)
+        self.assertEqual(
+            [act.id, acts[1].id, acts[0].id], [i.touch_id for i in rv])
+
+    def test_rings_decline_large_pages(self):
+        rings = Rings(size=4)
+        rings.prime(1, [])
+        self.assertIsNone(rings.page([1], 5))
+        self.assertIsNone(rings.page([1, 2], 3))
+        self.assertEqual([], rings.page([1], 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,12 +15,16 @@ except ImportError:
 from chameleon import PageTemplate
 import pkg_resources
 
+from pyramid import testing
+
 from cloudhands.common.types import NamedDict
 
 from cloudhands.web.hateoas import Action
+from cloudhands.web.hateoas import HateoasJSON
 from cloudhands.web.hateoas import PageBase
 from cloudhands.web.hateoas import Parameter
 from cloudhands.web.hateoas import Region
+from cloudhands.web.hateoas import Streamed
 
 """
 info
@@ -266,3 +270,54 @@ class TestOptionListTemplate(unittest.TestCase):
         rv = option_macro(**data)
         #print(rv)
         #print(json.dumps(data, cls=TypesEncoder))
+
+
+class TestHateoasJSON(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.data = {
+            "items": {"{:03}".format(n): {"uuid": n} for n in range(8)}}
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_indent_by_default(self):
+        request = testing.DummyRequest(headers={"Accept": "application/json"})
+        render = HateoasJSON(indent=4)(None)
+        rv = render(self.data, {"request": request})
+        self.assertIn("\n    ", rv)
+        self.assertEqual(self.data, json.loads(rv))
+
+    def test_compact_by_negotiation(self):
+        request = testing.DummyRequest(
+            headers={"Accept": "text/html, application/json; indent=0"})
+        render = HateoasJSON(indent=4)(None)
+        rv = render(self.data, {"request": request})
+        self.assertNotIn(" ", rv)
+        self.assertEqual(self.data, json.loads(rv))
+
+    def test_large_payload_in_chunks(self):
+        request = testing.DummyRequest(
+            headers={"Accept": "application/json; indent=0"})
+        render = HateoasJSON(threshold=4, chunk=16)(None)
+        rv = render(self.data, {"request": request})
+        self.assertIsNone(rv)
+        body = request.response.app_iter
+        self.assertIsInstance(body, Streamed)
+        chunks = list(body)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(
+            self.data, json.loads(b"".join(chunks).decode("utf-8")))
+        self.assertEqual(
+            "application/json", request.response.content_type)
+
+    def test_streamed_body_calls_back_on_close(self):
+        closed = []
+        body = Streamed(i.encode("ascii") for i in "abc")
+        body.on_close(lambda: closed.append(True))
+        self.assertEqual(b"a", next(iter(body)))
+        body.close()
+        self.assertEqual([True], closed)
+        body.close()
+        self.assertEqual([True], closed)
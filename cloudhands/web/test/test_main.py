@@ -2,12 +2,14 @@
 # encoding: UTF-8
 
 from collections import namedtuple
+import contextlib
 import datetime
 import operator
 import re
 import sqlite3
 import tempfile
 import textwrap
+import threading
 import unittest
 import unittest.mock
 import uuid
@@ -21,6 +23,10 @@ from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.httpexceptions import HTTPFound
 from pyramid.httpexceptions import HTTPInternalServerError
 from pyramid.httpexceptions import HTTPNotFound
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.httpexceptions import HTTPServiceUnavailable
+
+from sqlalchemy import func
 
 import cloudhands.common
 from cloudhands.common.connectors import initialise
@@ -43,10 +49,12 @@ from cloudhands.common.schema import State
 from cloudhands.common.schema import Touch
 from cloudhands.common.schema import User
 
+from cloudhands.common.states import ApplianceState
 from cloudhands.common.states import MembershipState
 from cloudhands.common.states import RegistrationState
 
 import cloudhands.web
+from cloudhands.web.context import privilege
 from cloudhands.web.indexer import create as create_index
 from cloudhands.web.indexer import indexer
 from cloudhands.web.indexer import ldap_types
@@ -57,16 +65,51 @@ from cloudhands.web.main import login_read
 from cloudhands.web.main import login_update
 from cloudhands.web.main import membership_read
 from cloudhands.web.main import membership_update
+from cloudhands.web.main import organisation_appliances_bulk_create
 from cloudhands.web.main import organisation_appliances_create
+from cloudhands.web.main import organisation_appliances_transitions
 from cloudhands.web.main import organisation_catalogue_read
+from cloudhands.web.main import organisation_delta
 from cloudhands.web.main import organisation_memberships_create
+from cloudhands.web.main import organisation_memberships_upload
 from cloudhands.web.main import organisation_read
 from cloudhands.web.main import parser
 from cloudhands.web.main import people_read
 from cloudhands.web.main import RegistrationForbidden
 from cloudhands.web.main import registration_passwords
 from cloudhands.web.main import registration_keys
+from cloudhands.web.main import registration_read
 from cloudhands.web.main import top_read
+from cloudhands.web.main import user_context
+from cloudhands.web.main import user_read
+from cloudhands.web.metrics import StatementLog
+from cloudhands.web.passwords import PasswordPool
+
+# The most SQL statements each view may issue for the small data sets
+# used in these tests. A view which loads records one at a time will
+# exceed its budget as soon as it meets a larger fixture.
+QUERY_BUDGET = {
+    "appliance_modify": 24,
+    "appliance_read": 30,
+    "authenticate_user": 2,
+    "login_update": 40,
+    "membership_read": 30,
+    "membership_update": 60,
+    "organisation_appliances_bulk_create": 20,
+    "organisation_appliances_create": 24,
+    "organisation_appliances_transitions": 20,
+    "organisation_catalogue_read": 30,
+    "organisation_delta": 6,
+    "organisation_memberships_create": 60,
+    "organisation_memberships_upload": 120,
+    "organisation_read": 40,
+    "people_read": 12,
+    "registration_keys": 20,
+    "registration_passwords": 20,
+    "registration_read": 40,
+    "top_read": 20,
+    "user_read": 20,
+}
 
 @unittest.skip("Not doing it yet")
 class ACLTests(unittest.TestCase):
@@ -95,6 +138,7 @@ class ServerTests(unittest.TestCase):
     def setUp(self):
         self.session = Registry().connect(sqlite3, ":memory:").session
         initialise(self.session)
+        cloudhands.web.main.USER_CACHE.clear()
         self.assets = {
             "paths.assets": dict(
                 css = "cloudhands.web:static/css",
@@ -117,6 +161,50 @@ class ServerTests(unittest.TestCase):
     def tearDown(self):
         Registry().disconnect(sqlite3, ":memory:")
 
+    @contextlib.contextmanager
+    def query_budget(self, view):
+        """
+        Fails the test if the code in this context issues more statements
+        than are budgeted for `view`. The failure message lists every
+        statement which was repeated.
+        """
+        limit = QUERY_BUDGET[view.__name__]
+        with StatementLog() as log:
+            yield log
+        self.assertLessEqual(
+            len(log), limit,
+            "{} issued {} statements (budget {}). Repeated:\n{}".format(
+                view.__name__, len(log), limit, log.report()))
+
+    def assert_scales(self, view, make_request, grow, n=5):
+        """
+        Fails the test if the number of statements `view` issues grows
+        when `grow(n)` adds `n` more records, or if any statement is
+        issued `n` or more times. A fresh request is made by
+        `make_request` for every call. Each measurement follows a call
+        which warms the caches, so that only the view's loading is
+        compared.
+        """
+        def measure():
+            view(make_request())
+            with StatementLog() as log:
+                view(make_request())
+            return log
+
+        before = measure()
+        grow(n)
+        after = measure()
+        self.assertEqual(
+            len(before), len(after),
+            "{} issued {} statements, then {} with {} more records."
+            " Repeated:\n{}".format(
+                view.__name__, len(before), len(after), n,
+                after.report()))
+        self.assertFalse(
+            after.repeated(n),
+            "{} repeated statements per record:\n{}".format(
+                view.__name__, after.report(n)))
+
     @staticmethod
     def make_test_user(session):
         just_registered = session.query(RegistrationState).filter(
@@ -193,9 +281,11 @@ class VersionInfoTests(ServerTests):
         self.assertTrue(rv.version)
 
     def test_version_json(self):
+        with self.query_budget(top_read):
+            page = top_read(self.request)
         self.assertEqual(
             cloudhands.web.__version__,
-            top_read(self.request)["info"]["versions"]["cloudhands.web"])
+            page["info"]["versions"]["cloudhands.web"])
         self.assertEqual(
             cloudhands.common.__version__,
             top_read(self.request)["info"]["versions"]["cloudhands.common"])
@@ -250,8 +340,9 @@ class AppliancePageTests(ServerTests):
         self.assertIn(ci, org.catalogue)
         request = testing.DummyRequest(post={"uuid": ci.uuid})
         request.matchdict.update({"org_name": org.name})
-        self.assertRaises(
-            HTTPFound, organisation_appliances_create, request)
+        with self.query_budget(organisation_appliances_create):
+            self.assertRaises(
+                HTTPFound, organisation_appliances_create, request)
         self.assertEqual(1, self.session.query(Appliance).count())
 
     def test_organisation_appliances_create_then_view_appliance(self):
@@ -260,19 +351,118 @@ class AppliancePageTests(ServerTests):
         app = self.session.query(Appliance).one()
         request = testing.DummyRequest()
         request.matchdict.update({"app_uuid": app.uuid})
-        page = appliance_read(request)
+        with self.query_budget(appliance_read):
+            page = appliance_read(request)
         items = list(page["items"].values())
         catalogueChoice = items[0]["_links"][0]
         self.assertEqual("collection", catalogueChoice.rel)
         blankLabel = items[1]
         self.assertIn("uuid", blankLabel)
 
+    def test_organisation_appliances_bulk_create_by_count(self):
+        org = self.session.query(Organisation).one()
+        ci = self.session.query(CatalogueItem).first()
+        request = testing.DummyRequest(json_body={"uuid": ci.uuid, "count": 5})
+        request.matchdict.update({"org_name": org.name})
+        with self.query_budget(organisation_appliances_bulk_create):
+            rv = organisation_appliances_bulk_create(request)
+        self.assertEqual(201, request.response.status_int)
+        self.assertEqual(5, len(rv["appliances"]))
+        self.assertEqual(5, self.session.query(Appliance).count())
+        self.assertEqual(0, self.session.query(Label).count())
+
+    def test_organisation_appliances_bulk_create_with_labels(self):
+        org = self.session.query(Organisation).one()
+        ci = self.session.query(CatalogueItem).first()
+        names = ["workshop-{:02}".format(n) for n in range(3)]
+        request = testing.DummyRequest(
+            json_body={"uuid": ci.uuid, "labels": names})
+        request.matchdict.update({"org_name": org.name})
+        with self.query_budget(organisation_appliances_bulk_create):
+            rv = organisation_appliances_bulk_create(request)
+        self.assertEqual(names, [i["name"] for i in rv["appliances"]])
+        self.assertEqual(3, self.session.query(Label).count())
+        for app in self.session.query(Appliance).all():
+            self.assertEqual("pre_provision", app.changes[-1].state.name)
+
+    def test_organisation_appliances_bulk_create_validates_labels(self):
+        org = self.session.query(Organisation).one()
+        ci = self.session.query(CatalogueItem).first()
+        request = testing.DummyRequest(
+            json_body={"uuid": ci.uuid, "labels": ["ok-name", "No blanks"]})
+        request.matchdict.update({"org_name": org.name})
+        self.assertRaises(
+            HTTPBadRequest, organisation_appliances_bulk_create, request)
+        self.assertEqual(0, self.session.query(Appliance).count())
+
+    def test_organisation_appliances_transitions(self):
+        self.test_organisation_appliances_create()
+        app = self.session.query(Appliance).one()
+        request = testing.DummyRequest(json_body=[
+            {"uuid": app.uuid, "fsm": "appliance", "name": "pre_provision"},
+            {"uuid": uuid.uuid4().hex, "fsm": "appliance", "name": "pre_stop"},
+            {"uuid": app.uuid, "fsm": "appliance", "name": "no_such_state"},
+            {"uuid": "bad uuid", "fsm": "appliance", "name": "pre_stop"},
+        ])
+        request.matchdict.update({"org_name": app.organisation.name})
+        with self.query_budget(organisation_appliances_transitions):
+            rv = organisation_appliances_transitions(request)
+        self.assertEqual(
+            [200, 404, 400, 400], [i["status"] for i in rv["transitions"]])
+        self.session.expire(app)
+        self.assertEqual("pre_provision", app.changes[-1].state.name)
+
+    def test_organisation_appliances_transitions_rejects_nonmember(self):
+        self.test_organisation_appliances_create()
+        app = self.session.query(Appliance).one()
+        self.session.add(Organisation(uuid=uuid.uuid4().hex, name="OtherOrg"))
+        self.session.commit()
+        request = testing.DummyRequest(json_body=[
+            {"uuid": app.uuid, "fsm": "appliance", "name": "pre_provision"}])
+        request.matchdict.update({"org_name": "OtherOrg"})
+        self.assertRaises(
+            Forbidden, organisation_appliances_transitions, request)
+
     def test_appliance_read_with_missing_uuid(self):
         request = testing.DummyRequest()
         request.matchdict.update({"app_uuid": uuid.uuid4().hex})
         self.assertRaises(
             HTTPNotFound, appliance_read, request)
 
+    def test_appliance_read_not_modified(self):
+        self.test_organisation_appliances_create()
+        app = self.session.query(Appliance).one()
+        request = testing.DummyRequest()
+        request.matchdict.update({"app_uuid": app.uuid})
+        appliance_read(request)
+        etag = request.response.headers["ETag"]
+
+        request = testing.DummyRequest(headers={"If-None-Match": etag})
+        request.matchdict.update({"app_uuid": app.uuid})
+        rv = appliance_read(request)
+        self.assertIsInstance(rv, HTTPNotModified)
+        self.assertEqual(etag, rv.headers["ETag"])
+
+    def test_appliance_read_modified_by_new_touch(self):
+        self.test_organisation_appliances_create()
+        app = self.session.query(Appliance).one()
+        request = testing.DummyRequest()
+        request.matchdict.update({"app_uuid": app.uuid})
+        appliance_read(request)
+        etag = request.response.headers["ETag"]
+
+        act = app.changes[-1]
+        self.session.add(Touch(
+            artifact=app, actor=act.actor, state=act.state,
+            at=datetime.datetime.utcnow()))
+        self.session.commit()
+
+        request = testing.DummyRequest(headers={"If-None-Match": etag})
+        request.matchdict.update({"app_uuid": app.uuid})
+        page = appliance_read(request)
+        self.assertIsInstance(page, dict)
+        self.assertNotEqual(etag, request.response.headers["ETag"])
+
     def test_appliance_modify_validates_label(self):
         self.test_organisation_appliances_create()
         self.assertEqual(1, self.session.query(Appliance).count())
@@ -292,8 +482,9 @@ class AppliancePageTests(ServerTests):
         request = testing.DummyRequest(
             post={"name": "Test_name", "description": "Test description"})
         request.matchdict.update({"app_uuid": app.uuid})
-        self.assertRaises(
-            HTTPFound, appliance_modify, request)
+        with self.query_budget(appliance_modify):
+            self.assertRaises(
+                HTTPFound, appliance_modify, request)
         app = self.session.query(Appliance).one()
         self.assertEqual(1, self.session.query(Label).count())
 
@@ -324,8 +515,183 @@ class AppliancePageTests(ServerTests):
         self.assertEqual(1, self.session.query(Label).count())
         request = testing.DummyRequest()
         request.matchdict.update({"org_name": app.organisation.name})
+        with self.query_budget(organisation_read):
+            page = organisation_read(request)
+        self.assertEqual(1, len(page["items"]))
+
+    def test_organisation_delta_since_touch(self):
+        self.test_organisation_appliances_create()
+        app = self.session.query(Appliance).one()
+        request = testing.DummyRequest()
+        request.matchdict.update({"org_name": app.organisation.name})
+        latest = organisation_read(request)["info"]["delta"]["latest"]
+        self.assertIsNotNone(latest)
+
+        request = testing.DummyRequest(params={"since": str(latest)})
+        request.matchdict.update({"org_name": app.organisation.name})
+        with self.query_budget(organisation_delta):
+            page = organisation_read(request)
+        self.assertFalse(page["items"])
+        self.assertEqual(latest, page["info"]["delta"]["latest"])
+
+        request = testing.DummyRequest(
+            post={"name": "Test_name", "description": "Test description"})
+        request.matchdict.update({"app_uuid": app.uuid})
+        self.assertRaises(HTTPFound, appliance_modify, request)
+
+        request = testing.DummyRequest(params={"since": str(latest)})
+        request.matchdict.update({"org_name": app.organisation.name})
+        page = organisation_read(request)
+        self.assertEqual(1, len(page["items"]))
+        self.assertGreater(page["info"]["delta"]["latest"], latest)
+
+    def test_organisation_delta_since_timestamp(self):
+        self.test_organisation_appliances_create()
+        app = self.session.query(Appliance).one()
+        then = app.changes[-1].at
+        for when, n in ((then - datetime.timedelta(seconds=1), 1), (then, 0)):
+            request = testing.DummyRequest(
+                params={"since": when.isoformat()})
+            request.matchdict.update({"org_name": app.organisation.name})
+            page = organisation_read(request)
+            self.assertEqual(n, len(page["items"]))
+            self.assertEqual(
+                self.session.query(func.max(Touch.id)).scalar(),
+                page["info"]["delta"]["latest"])
+
+    def test_organisation_delta_reports_tombstones(self):
+        self.test_organisation_appliances_create()
+        app = self.session.query(Appliance).one()
+        latest = app.changes[-1].id
+        deleted = self.session.query(ApplianceState).filter(
+            ApplianceState.name == "deleted").one()
+        self.session.add(Touch(
+            artifact=app, actor=app.changes[-1].actor, state=deleted,
+            at=datetime.datetime.utcnow()))
+        self.session.commit()
+
+        request = testing.DummyRequest(params={"since": str(latest)})
+        request.matchdict.update({"org_name": app.organisation.name})
         page = organisation_read(request)
         self.assertEqual(1, len(page["items"]))
+        item = page["items"][app.uuid]
+        self.assertEqual(app.uuid, item["uuid"])
+        self.assertTrue(item["deleted"])
+        self.assertEqual(app.changes[-1].id, page["info"]["delta"]["latest"])
+
+    def test_top_read_delta_lists_changes_in_own_organisations(self):
+        self.add_appliances(1)
+        latest = top_read(testing.DummyRequest())["info"]["delta"]["latest"]
+        self.assertIsNotNone(latest)
+
+        request = testing.DummyRequest(params={"since": str(latest)})
+        with self.query_budget(top_read):
+            page = top_read(request)
+        self.assertFalse(page["items"])
+        self.assertEqual(latest, page["info"]["delta"]["latest"])
+
+        app = self.session.query(Appliance).one()
+        other = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=Organisation(uuid=uuid.uuid4().hex, name="OtherOrg"))
+        self.session.add(Touch(
+            artifact=other, actor=app.changes[-1].actor,
+            state=app.changes[-1].state, at=datetime.datetime.utcnow()))
+        self.session.commit()
+        self.add_appliances(6)
+        mine = self.session.query(Touch).join(
+            Appliance, Touch.artifact_id == Appliance.id).filter(
+            Appliance.organisation_id == app.organisation.id).filter(
+            Touch.id > latest).count()
+        self.assertGreater(mine, 5)
+
+        page = top_read(testing.DummyRequest(params={"since": str(latest)}))
+        self.assertEqual(mine, len(page["items"]))
+        self.assertEqual(
+            self.session.query(func.max(Touch.id)).scalar(),
+            page["info"]["delta"]["latest"])
+
+    def test_top_read_delta_since_timestamp_reports_latest(self):
+        self.add_appliances(1)
+        then = self.session.query(func.max(Touch.at)).scalar()
+        page = top_read(
+            testing.DummyRequest(params={"since": then.isoformat()}))
+        self.assertFalse(page["items"])
+        self.assertEqual(
+            self.session.query(func.max(Touch.id)).scalar(),
+            page["info"]["delta"]["latest"])
+
+    def test_organisation_delta_rejects_bad_since(self):
+        org = self.session.query(Organisation).one()
+        request = testing.DummyRequest(params={"since": "yesterday"})
+        request.matchdict.update({"org_name": org.name})
+        self.assertRaises(HTTPBadRequest, organisation_read, request)
+
+    def add_appliances(self, n):
+        org = self.session.query(Organisation).one()
+        ci = self.session.query(CatalogueItem).first()
+        request = testing.DummyRequest(json_body={"uuid": ci.uuid, "count": n})
+        request.matchdict.update({"org_name": org.name})
+        organisation_appliances_bulk_create(request)
+
+    def test_organisation_read_scales_with_appliances(self):
+        org = self.session.query(Organisation).one()
+        self.add_appliances(1)
+
+        def make_request():
+            request = testing.DummyRequest()
+            request.matchdict.update({"org_name": org.name})
+            return request
+
+        self.assert_scales(
+            organisation_read, make_request, self.add_appliances)
+
+    def test_organisation_read_pages_appliances(self):
+        org = self.session.query(Organisation).one()
+        self.add_appliances(5)
+
+        seen = []
+        params = {"limit": "2"}
+        while True:
+            request = testing.DummyRequest(params=params)
+            request.matchdict.update({"org_name": org.name})
+            page = organisation_read(request)
+            items = list(page["items"].values())
+            self.assertLessEqual(len(items), 2)
+            seen.extend(i["uuid"] for i in items)
+            cursors = [
+                i for i in page["nav"].values()
+                if i.get("_type") == "cursor"]
+            if not cursors:
+                break
+            link = cursors[0]["_links"][0]
+            self.assertIn("limit=2", link.typ.format(link.ref))
+            params = {"limit": "2", "after": cursors[0]["after"]}
+
+        self.assertEqual(5, len(seen))
+        self.assertEqual(
+            {i.uuid for i in self.session.query(Appliance).all()}, set(seen))
+
+    def test_appliance_read_scales_with_touches(self):
+        self.add_appliances(1)
+        app = self.session.query(Appliance).one()
+        user = self.session.query(User).one()
+
+        def make_request():
+            request = testing.DummyRequest()
+            request.matchdict.update({"app_uuid": app.uuid})
+            return request
+
+        def grow(n):
+            state = app.changes[-1].state
+            for i in range(n):
+                self.session.add(Touch(
+                    artifact=app, actor=user, state=state,
+                    at=datetime.datetime.utcnow()))
+            self.session.commit()
+
+        self.assert_scales(appliance_read, make_request, grow)
 
 
 class CataloguePageTests(ServerTests):
@@ -334,6 +700,69 @@ class CataloguePageTests(ServerTests):
         super().setUp()
         self.config.add_route(
             "catalogue", "/organisation/{org_name}/catalogue")
+        self.config.add_route(
+            "organisation_catalogue", "/organisation/{org_name}/catalogue")
+
+    def test_catalogue_view_scales_with_items(self):
+        act = ServerTests.make_test_user_role_user(self.session)
+        org = act.artifact.organisation
+
+        def make_request():
+            request = testing.DummyRequest()
+            request.matchdict.update({"org_name": org.name})
+            return request
+
+        def grow(n):
+            self.session.add_all(
+                CatalogueItem(
+                    uuid=uuid.uuid4().hex,
+                    name="vm_{}".format(uuid.uuid4().hex[:8]),
+                    description="Headless VM",
+                    note="<p>Headless VM</p>",
+                    logo="headless",
+                    natrouted=False,
+                    organisation=org
+                ) for i in range(n))
+            self.session.commit()
+
+        grow(1)
+        self.assert_scales(organisation_catalogue_read, make_request, grow)
+
+    def test_catalogue_view_is_paged(self):
+        act = ServerTests.make_test_user_role_user(self.session)
+        org = act.artifact.organisation
+        self.session.add_all(
+            CatalogueItem(
+                uuid=uuid.uuid4().hex,
+                name="vm_{:02}".format(n),
+                description="Headless VM",
+                note="<p>Headless VM</p>",
+                logo="headless",
+                natrouted=False,
+                organisation=org
+            ) for n in range(5))
+        self.session.commit()
+
+        seen = []
+        after = None
+        while True:
+            params = {"limit": "2"}
+            if after:
+                params["after"] = after
+            request = testing.DummyRequest(params=params)
+            request.matchdict.update({"org_name": org.name})
+            page = organisation_catalogue_read(request)
+            items = list(page["items"].values())
+            self.assertLessEqual(len(items), 2)
+            seen.extend(i["name"] for i in items)
+            cursors = [
+                i for i in page["nav"].values()
+                if i.get("_type") == "cursor"]
+            if not cursors:
+                break
+            after = cursors[0]["after"]
+
+        self.assertEqual(["vm_{:02}".format(n) for n in range(5)], seen)
 
     def test_no_options_seen_in_catalogue_view(self):
         act = ServerTests.make_test_user_role_user(self.session)
@@ -370,7 +799,8 @@ class CataloguePageTests(ServerTests):
         self.session.commit()
         request = testing.DummyRequest()
         request.matchdict.update({"org_name": org.name})
-        page = organisation_catalogue_read(request)
+        with self.query_budget(organisation_catalogue_read):
+            page = organisation_catalogue_read(request)
         self.assertFalse(list(page["options"].values()))
         items = list(page["items"].values())
         self.assertEqual(2, len(items))
@@ -392,7 +822,27 @@ class LoginAndOutTests(ServerTests):
         act = ServerTests.make_test_user_role_user(self.session)
         request = testing.DummyRequest(
             post={"username": "TestUser", "password": "TestPa$$w0rd"})
-        self.assertRaises(HTTPFound, login_update, request)
+        with self.query_budget(login_update):
+            self.assertRaises(HTTPFound, login_update, request)
+
+    def test_login_with_full_password_pool_is_unavailable(self):
+        act = ServerTests.make_test_user_role_user(self.session)
+        pool = PasswordPool(workers=1, queue=0)
+        release = threading.Event()
+        pool.submit(release.wait, 5)
+        try:
+            request = testing.DummyRequest(
+                post={"username": "TestUser", "password": "TestPa$$w0rd"})
+            request.registry.settings = {"passwords": pool}
+            try:
+                login_update(request)
+            except HTTPServiceUnavailable as e:
+                self.assertIn("Retry-After", e.headers)
+            else:
+                self.fail("Expected HTTPServiceUnavailable")
+        finally:
+            release.set()
+            pool.shutdown()
 
     def test_registration_lifecycle_pre_registration_inet_orgperson_cn(self):
         act = ServerTests.make_test_user_role_user(self.session)
@@ -434,8 +884,9 @@ class LoginAndOutTests(ServerTests):
         noPasswordChange = unittest.mock.patch(
             "cloudhands.web.main.change_password",
             autospec=True, return_value = 0)
-        with noUidNumber, noPasswordChange:
+        with noUidNumber, noPasswordChange as change:
             self.assertRaises(HTTPFound, login_update, request)
+        self.assertEqual(1, change.call_count)
 
         self.assertEqual(1, self.session.query(User).count())
         self.assertEqual(1, self.session.query(Registration).count())
@@ -447,6 +898,66 @@ class LoginAndOutTests(ServerTests):
         self.assertEqual(
             "user_posixaccount",
             reg.changes[-1].state.name)
+        # Success is recorded only after a failure.
+        self.assertEqual(
+            0, self.session.query(Label).filter(
+            Label.name == "ldappasswd").count())
+
+    def make_valid_registration(self):
+        act = ServerTests.make_test_user_role_user(self.session)
+        user = act.actor
+        prvdr = self.session.query(Provider).one()
+        reg = self.session.query(Registration).one()
+        state = self.session.query(State).filter(
+            State.name == "valid").one()
+        act = Touch(
+            artifact=reg, actor=user, state=state,
+            at=datetime.datetime.utcnow())
+        self.session.add(
+            PosixUId(value="testuser", touch=act, provider=prvdr))
+        self.session.commit()
+        return reg
+
+    def test_login_queues_password_propagation(self):
+        reg = self.make_valid_registration()
+        user = reg.changes[0].actor
+        propagator = unittest.mock.Mock()
+        request = testing.DummyRequest(
+            post={"username": user.handle, "password": "TestPa$$w0rd"})
+        request.registry.settings = {"propagator": propagator}
+        passwordChange = unittest.mock.patch(
+            "cloudhands.web.main.change_password",
+            autospec=True, return_value=1)
+        with passwordChange as change:
+            self.assertRaises(HTTPFound, login_update, request)
+        self.assertEqual(1, change.call_count)
+        job = propagator.submit.call_args[0][0]
+        self.assertEqual(
+            (reg.uuid, "testuser", "TestPa$$w0rd"),
+            (job.reg_uuid, job.uid, job.password))
+        self.assertEqual(
+            ["exit status 1"],
+            [i for (i,) in self.session.query(Label.description).filter(
+                Label.name == "ldappasswd")])
+
+    def test_login_fails_when_password_times_out(self):
+        reg = self.make_valid_registration()
+        user = reg.changes[0].actor
+        propagator = unittest.mock.Mock()
+        request = testing.DummyRequest(
+            post={"username": user.handle, "password": "TestPa$$w0rd"})
+        request.registry.settings = {"propagator": propagator}
+        passwordChange = unittest.mock.patch(
+            "cloudhands.web.main.change_password",
+            autospec=True, return_value=None)
+        with passwordChange:
+            self.assertRaises(
+                HTTPInternalServerError, login_update, request)
+        self.assertFalse(propagator.submit.called)
+        self.assertEqual(
+            ["timeout"],
+            [i for (i,) in self.session.query(Label.description).filter(
+                Label.name == "ldappasswd")])
 
 
 class MembershipPageTests(ServerTests):
@@ -460,7 +971,9 @@ class MembershipPageTests(ServerTests):
 
     def test_authenticate_nonuser_raises_not_found(self):
         request = testing.DummyRequest()
-        self.assertRaises(NotFound, authenticate_user, request, NotFound)
+        with self.query_budget(authenticate_user):
+            self.assertRaises(
+                NotFound, authenticate_user, request, NotFound)
 
     def test_authenticate_nonuser_attaches_userid(self):
         request = testing.DummyRequest()
@@ -470,6 +983,88 @@ class MembershipPageTests(ServerTests):
             self.assertEqual(
                 cloudhands.web.main.authenticated_userid(), e.userId)
 
+    def test_authenticate_user_is_cached(self):
+        act = ServerTests.make_test_user(self.session)
+        request = testing.DummyRequest()
+        user = authenticate_user(request)
+        self.assertEqual(act.actor.id, user.id)
+        self.assertEqual(
+            user.id,
+            cloudhands.web.main.USER_CACHE[
+                cloudhands.web.main.authenticated_userid()])
+        self.assertIs(user, authenticate_user(request))
+
+    def test_new_touch_invalidates_cached_user(self):
+        act = ServerTests.make_test_user(self.session)
+        request = testing.DummyRequest()
+        user = authenticate_user(request)
+        key = cloudhands.web.main.authenticated_userid()
+        self.assertIn(key, cloudhands.web.main.USER_CACHE)
+
+        reg = act.artifact
+        ea = EmailAddress(
+            value=key,
+            touch=Touch(
+                artifact=reg, actor=user, state=act.state,
+                at=datetime.datetime.utcnow()))
+        self.session.add(ea)
+        self.session.commit()
+        self.assertNotIn(key, cloudhands.web.main.USER_CACHE)
+
+    def test_new_touch_invalidates_every_key_of_user(self):
+        act = ServerTests.make_test_user(self.session)
+        user = act.actor
+        cache = cloudhands.web.main.USER_CACHE
+        cache[user.handle] = user.id
+        cache["testuser@unittest.python"] = user.id
+        self.session.add(Touch(
+            artifact=act.artifact, actor=user, state=act.state,
+            at=datetime.datetime.utcnow()))
+        self.session.flush()
+        self.assertIn(user.handle, cache)
+        self.session.commit()
+        self.assertNotIn(user.handle, cache)
+        self.assertNotIn("testuser@unittest.python", cache)
+
+    def test_rolled_back_touch_keeps_cached_user(self):
+        act = ServerTests.make_test_user(self.session)
+        user = act.actor
+        cache = cloudhands.web.main.USER_CACHE
+        cache[user.handle] = user.id
+        self.session.add(Touch(
+            artifact=act.artifact, actor=user, state=act.state,
+            at=datetime.datetime.utcnow()))
+        self.session.flush()
+        self.session.rollback()
+        self.assertIn(user.handle, cache)
+
+    def test_user_context_is_memoised(self):
+        act = ServerTests.make_test_user_role_admin(self.session)
+        org = act.artifact.organisation
+        request = testing.DummyRequest()
+        context = user_context(request)
+        self.assertIs(context, user_context(request))
+        self.assertEqual([org], context.organisations)
+        self.assertIs(act.artifact, context.privilege(org.name))
+        self.assertTrue(context.registration)
+        with StatementLog() as log:
+            user_context(request).organisations
+            user_context(request).registration
+            prvlg = privilege(self.session, context.user, org.name)
+        self.assertEqual(0, len(log))
+        self.assertIs(act.artifact, prvlg)
+
+    def test_user_context_is_released_on_commit(self):
+        act = ServerTests.make_test_user_role_admin(self.session)
+        org = act.artifact.organisation
+        context = user_context(testing.DummyRequest())
+        self.assertIn("cloudhands.user_context", self.session.info)
+        self.session.commit()
+        self.assertNotIn("cloudhands.user_context", self.session.info)
+        self.assertEqual(
+            act.artifact.id,
+            privilege(self.session, context.user, org.name).id)
+
     def test_guest_membership_read_activates_membership(self):
 
         def newuser_email(request=None):
@@ -492,7 +1087,9 @@ class MembershipPageTests(ServerTests):
             "email": newuser_email()})
         request.registry.settings = {"cfg": self.assets}
         request.matchdict.update({"org_name": org.name})
-        self.assertRaises(HTTPFound, organisation_memberships_create, request)
+        with self.query_budget(organisation_memberships_create):
+            self.assertRaises(
+                HTTPFound, organisation_memberships_create, request)
         self.assertEqual(2, self.session.query(User).count())
         self.assertEqual(2, self.session.query(Registration).count())
         self.assertEqual(2, self.session.query(Membership).count())
@@ -516,7 +1113,8 @@ class MembershipPageTests(ServerTests):
             request = testing.DummyRequest()
             request.matchdict.update({"mship_uuid": mship.uuid})
 
-            self.assertRaises(HTTPFound, membership_read, request)
+            with self.query_budget(membership_read):
+                self.assertRaises(HTTPFound, membership_read, request)
 
             # Check new user added
             self.assertEqual("accepted", mship.changes[-1].state.name)
@@ -553,8 +1151,9 @@ class MembershipPageTests(ServerTests):
             request = testing.DummyRequest(post={"designator": dn})
             request.matchdict.update({"mship_uuid": mship.uuid})
             # NB: admin is updating his own membership here
-            self.assertRaises(
-                HTTPFound, membership_update, request)
+            with self.query_budget(membership_update):
+                self.assertRaises(
+                    HTTPFound, membership_update, request)
 
             n = self.session.query(
                 Resource).join(Touch).join(Membership).filter(
@@ -600,6 +1199,74 @@ class OrganisationPageTests(ServerTests):
             "/organisation/{}/memberships".format(org.name),
             invite.typ.format(invite.ref))
 
+    def test_organisation_read_modified_by_other_admin(self):
+        act = ServerTests.make_test_user_role_admin(self.session)
+        org = act.artifact.organisation
+        request = testing.DummyRequest()
+        request.matchdict.update({"org_name": org.name})
+        organisation_read(request)
+        etag = request.response.headers["ETag"]
+        self.assertEqual("Accept", request.response.headers["Vary"])
+
+        other = User(handle="OtherAdmin", uuid=uuid.uuid4().hex)
+        mship = Membership(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=org,
+            role="user")
+        self.session.add(Touch(
+            artifact=mship, actor=other, state=act.state,
+            at=datetime.datetime.utcnow()))
+        self.session.commit()
+
+        request = testing.DummyRequest(headers={"If-None-Match": etag})
+        request.matchdict.update({"org_name": org.name})
+        page = organisation_read(request)
+        self.assertIsInstance(page, dict)
+        self.assertNotEqual(etag, request.response.headers["ETag"])
+
+    def test_organisation_read_not_modified_by_other_organisation(self):
+        act = ServerTests.make_test_user_role_admin(self.session)
+        org = act.artifact.organisation
+        request = testing.DummyRequest()
+        request.matchdict.update({"org_name": org.name})
+        organisation_read(request)
+        etag = request.response.headers["ETag"]
+
+        other = User(handle="OtherAdmin", uuid=uuid.uuid4().hex)
+        mship = Membership(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=Organisation(uuid=uuid.uuid4().hex, name="OtherOrg"),
+            role="admin")
+        self.session.add(Touch(
+            artifact=mship, actor=other, state=act.state,
+            at=datetime.datetime.utcnow()))
+        self.session.commit()
+
+        request = testing.DummyRequest(headers={"If-None-Match": etag})
+        request.matchdict.update({"org_name": org.name})
+        self.assertIsInstance(organisation_read(request), HTTPNotModified)
+
+    def test_organisation_read_not_modified_varies_by_accept(self):
+        act = ServerTests.make_test_user_role_admin(self.session)
+        org = act.artifact.organisation
+        request = testing.DummyRequest()
+        request.matchdict.update({"org_name": org.name})
+        organisation_read(request)
+        etag = request.response.headers["ETag"]
+
+        request = testing.DummyRequest(headers={"If-None-Match": etag})
+        request.matchdict.update({"org_name": org.name})
+        rv = organisation_read(request)
+        self.assertIsInstance(rv, HTTPNotModified)
+        self.assertEqual("Accept", rv.headers["Vary"])
+
+        request = testing.DummyRequest(headers={
+            "If-None-Match": etag, "Accept": "application/json"})
+        request.matchdict.update({"org_name": org.name})
+        self.assertIsInstance(organisation_read(request), dict)
+
     def test_user_memberships_post_returns_forbidden(self):
         act = ServerTests.make_test_user_role_user(self.session)
         org = act.artifact.organisation
@@ -624,6 +1291,50 @@ class OrganisationPageTests(ServerTests):
         request.matchdict.update({"org_name": org.name})
         self.assertRaises(HTTPFound, organisation_memberships_create, request)
 
+    def test_user_memberships_upload_returns_forbidden(self):
+        act = ServerTests.make_test_user_role_user(self.session)
+        org = act.artifact.organisation
+        request = testing.DummyRequest(
+            body=b"someonew,New,someone@somewhere.net\n")
+        request.matchdict.update({"org_name": org.name})
+        self.assertRaises(Forbidden, organisation_memberships_upload, request)
+
+    def test_memberships_upload_authenticates_first(self):
+        request = testing.DummyRequest(body=b"\xff\xfe")
+        request.matchdict.update({"org_name": "TestOrg"})
+        self.assertRaises(Forbidden, organisation_memberships_upload, request)
+
+    def test_admin_memberships_upload_reports_each_row(self):
+        act = ServerTests.make_test_user_role_admin(self.session)
+        org = act.artifact.organisation
+        nUsers = self.session.query(User).count()
+        rows = ["username,surname,email"] + [
+            "someone{:02},New,someone{:02}@somewhere.net".format(n, n)
+            for n in range(4)] + [
+            "someone00,Again,again@somewhere.net",
+            "x,New,short@somewhere.net",
+            "toomany,fields,in,row"]
+        request = testing.DummyRequest(
+            body="\n".join(rows).encode("utf-8"))
+        request.matchdict.update({"org_name": org.name})
+        with self.query_budget(organisation_memberships_upload):
+            rv = organisation_memberships_upload(request)
+
+        self.assertEqual(201, request.response.status_int)
+        report = rv["memberships"]
+        self.assertEqual(7, len(report))
+        self.assertEqual(list(range(1, 8)), [i["row"] for i in report])
+        self.assertEqual(
+            ["invited"] * 4 + ["member", "invalid", "invalid"],
+            [i["status"] for i in report])
+        self.assertEqual(nUsers + 4, self.session.query(User).count())
+        self.assertEqual(
+            4, self.session.query(Membership).filter(
+            Membership.organisation == org).filter(
+            Membership.role == "user").count())
+        self.assertTrue(self.session.query(EmailAddress).filter(
+            EmailAddress.value == "someone03@somewhere.net").first())
+
 
 class PeoplePageTests(ServerTests):
 
@@ -669,7 +1380,8 @@ class PeoplePageTests(ServerTests):
         self.assertEqual(0, len(page["items"]))
 
         request = testing.DummyRequest({"description": "User"})
-        page = people_read(request)
+        with self.query_budget(people_read):
+            page = people_read(request)
         self.assertEqual(10, len(page["items"]))
 
 class RegistrationPageTests(ServerTests):
@@ -694,7 +1406,8 @@ class RegistrationPageTests(ServerTests):
         request = testing.DummyRequest(
             {"username": user.handle, "password": "th!swillb3myPa55w0rd"})
         request.matchdict.update({"reg_uuid": reg.uuid})
-        self.assertRaises(HTTPFound, registration_passwords, request)
+        with self.query_budget(registration_passwords):
+            self.assertRaises(HTTPFound, registration_passwords, request)
 
     def test_registration_passwords_bad_value(self):
         user = User(handle="TestUser", uuid=uuid.uuid4().hex)
@@ -756,8 +1469,52 @@ class RegistrationPageTests(ServerTests):
             snow.badc.rl.ac.uk""").replace("\n", "")
         request = testing.DummyRequest({"value": val})
         request.matchdict.update({"reg_uuid": reg.uuid})
-        self.assertRaises(HTTPFound, registration_keys, request)
+        with self.query_budget(registration_keys):
+            self.assertRaises(HTTPFound, registration_keys, request)
         self.assertEqual(1, self.session.query(PublicKey).count())
 
+    def test_registration_read_lists_resources(self):
+        act = ServerTests.make_test_user_role_user(self.session)
+        reg = self.session.query(Registration).one()
+        request = testing.DummyRequest()
+        request.matchdict.update({"reg_uuid": reg.uuid})
+        with self.query_budget(registration_read):
+            page = registration_read(request)
+        items = list(page["items"].values())
+        self.assertTrue(any("email" in i for i in items))
+        self.assertEqual(1, len(page["options"]))
+
+    def test_registration_read_scales_with_resources(self):
+        act = ServerTests.make_test_user_role_user(self.session)
+        reg = self.session.query(Registration).one()
+        request = testing.DummyRequest()
+        request.matchdict.update({"reg_uuid": reg.uuid})
+
+        def statements():
+            with self.query_budget(registration_read) as log:
+                registration_read(request)
+            return len(log)
+
+        before = statements()
+        state = reg.changes[-1].state
+        for n in range(5):
+            touch = Touch(
+                artifact=reg, actor=act.actor, state=state,
+                at=datetime.datetime.utcnow())
+            self.session.add(PublicKey(
+                touch=touch, value="ssh-rsa AAAA{} test".format(n)))
+        self.session.commit()
+        self.assertEqual(before, statements())
+
+    def test_user_read_lists_resources(self):
+        act = ServerTests.make_test_user_role_user(self.session)
+        request = testing.DummyRequest()
+        request.matchdict.update({"user_uuid": act.actor.uuid})
+        with self.query_budget(user_read):
+            page = user_read(request)
+        items = list(page["items"].values())
+        self.assertEqual(2, len(items))
+        self.assertTrue(any("email" in i for i in items))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import unittest
+import unittest.mock
+
+from pyramid import testing
+
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.response import Response
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from cloudhands.web.metrics import Counted
+from cloudhands.web.metrics import Histogram
+from cloudhands.web.metrics import METRICS
+from cloudhands.web.metrics import metrics_read
+from cloudhands.web.metrics import metrics_tween_factory
+from cloudhands.web.metrics import register
+from cloudhands.web.metrics import StatementLog
+from cloudhands.web.passwords import PasswordPool
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_observations_are_bucketed(self):
+        h = Histogram(buckets=(0.1, 1.0))
+        for v in (0.05, 0.1, 0.5, 2.0):
+            h.observe(v)
+        self.assertEqual(
+            [(0.1, 2), (1.0, 3), ("+Inf", 4)], list(h.cumulative()))
+        self.assertEqual(4, h.count)
+        self.assertAlmostEqual(2.65, h.sum)
+
+
+class MetricsTweenTests(unittest.TestCase):
+
+    def setUp(self):
+        METRICS.reset()
+        self.engine = create_engine("sqlite://")
+
+    def tearDown(self):
+        METRICS.reset()
+
+    def handler(self, request):
+        with self.engine.connect() as con:
+            con.execute("select 1").fetchall()
+            con.execute("select 2").fetchall()
+        return unittest.mock.Mock(content_length=42)
+
+    def test_route_statistics_recorded(self):
+        tween = metrics_tween_factory(self.handler, None)
+        request = testing.DummyRequest()
+        request.matched_route = unittest.mock.Mock()
+        request.matched_route.name = "top"
+        tween(request)
+        tween(request)
+
+        stats = METRICS.routes["top"]
+        self.assertEqual(2, stats.latency.count)
+        self.assertEqual(4, stats.statements)
+        self.assertEqual(84, stats.response_bytes)
+
+    def test_statements_outside_requests_ignored(self):
+        self.handler(None)
+        self.assertFalse(METRICS.routes)
+
+    def test_prometheus_exposition(self):
+        tween = metrics_tween_factory(self.handler, None)
+        request = testing.DummyRequest()
+        request.matched_route = unittest.mock.Mock()
+        request.matched_route.name = "organisation"
+        tween(request)
+
+        rsp = metrics_read(testing.DummyRequest())
+        self.assertTrue(rsp.content_type.startswith("text/plain"))
+        lines = rsp.text.splitlines()
+        self.assertIn("# TYPE cloudhands_request_seconds histogram", lines)
+        self.assertIn(
+            'cloudhands_request_seconds_bucket'
+            '{route="organisation",le="+Inf"} 1', lines)
+        self.assertIn(
+            'cloudhands_sql_statements_total{route="organisation"} 2', lines)
+        self.assertIn(
+            'cloudhands_response_bytes_total{route="organisation"} 42', lines)
+
+    def test_failed_statement_releases_timer(self):
+        with self.engine.connect() as con:
+            self.assertRaises(
+                OperationalError, con.execute, "select * from nowhere")
+            self.assertFalse(con.info.get("cloudhands.query_start"))
+
+    def test_streamed_response_size_counted(self):
+
+        def handler(request):
+            return Response(app_iter=iter([b"abc", b"defg"]))
+
+        tween = metrics_tween_factory(handler, None)
+        request = testing.DummyRequest()
+        request.matched_route = unittest.mock.Mock()
+        request.matched_route.name = "stream"
+        response = tween(request)
+        self.assertIsInstance(response.app_iter, Counted)
+        self.assertEqual(b"abcdefg", b"".join(response.app_iter))
+        response.app_iter.close()
+        self.assertEqual(7, METRICS.routes["stream"].response_bytes)
+
+    def test_collectors_published_once(self):
+        first = PasswordPool(workers=1, queue=0)
+        second = PasswordPool(workers=1, queue=2)
+        try:
+            register(first)
+            register(second)
+            lines = metrics_read(testing.DummyRequest()).text.splitlines()
+        finally:
+            first.shutdown()
+            second.shutdown()
+        self.assertEqual(
+            1, lines.count("# TYPE cloudhands_password_capacity gauge"))
+        self.assertIn("cloudhands_password_capacity 3", lines)
+
+    def test_metrics_restricted_by_address(self):
+        request = testing.DummyRequest(remote_addr="10.0.0.1")
+        request.registry.settings = {"metrics.addresses": ["127.0.0.1"]}
+        self.assertRaises(HTTPForbidden, metrics_read, request)
+        request = testing.DummyRequest(remote_addr="127.0.0.1")
+        request.registry.settings = {"metrics.addresses": ["127.0.0.1"]}
+        self.assertEqual(200, metrics_read(request).status_code)
+
+
+class StatementLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+
+    def test_statements_are_logged(self):
+        with StatementLog() as log:
+            with self.engine.connect() as con:
+                con.execute("select 1").fetchall()
+        self.assertEqual(["select 1"], log.statements)
+
+    def test_repeated_shapes_reported(self):
+        with StatementLog() as log:
+            with self.engine.connect() as con:
+                con.execute("select 1").fetchall()
+                for i in range(3):
+                    con.execute("select ?", (i,)).fetchall()
+        self.assertEqual([("select ?", 3)], log.repeated())
+        self.assertIn("3 x select ?", log.report())
+
+    def test_nested_logs(self):
+        with StatementLog() as outer:
+            with StatementLog() as inner:
+                with self.engine.connect() as con:
+                    con.execute("select 1").fetchall()
+        self.assertEqual(1, len(inner))
+        self.assertEqual(1, len(outer))
+
+
+if __name__ == "__main__":
+    unittest.main()
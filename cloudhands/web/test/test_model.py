@@ -29,6 +29,7 @@ from cloudhands.common.states import HostState
 
 from cloudhands.common.types import NamedDict
 
+from cloudhands.web.feed import Entry
 from cloudhands.web.indexer import create as create_index
 from cloudhands.web.indexer import indexer
 from cloudhands.web.indexer import people
@@ -126,6 +127,18 @@ class TestGenericRegion(unittest.TestCase):
         self.assertIsInstance(rv, MutableMapping)
         self.assertIsInstance(rv.name, Callable)
 
+    def test_entry_without_actor_has_no_user_link(self):
+        region = ItemRegion().name("test region")
+        now = datetime.datetime.utcnow()
+        rv = region.push(Entry(
+            1, 1, "TestOrg", now, "appliance", uuid.uuid4().hex,
+            "configuring", "TestUser", uuid.uuid4().hex))
+        self.assertEqual(1, len(rv["_links"]))
+        rv = region.push(Entry(
+            2, 1, "TestOrg", now, "appliance", uuid.uuid4().hex,
+            "configuring", None, None))
+        self.assertEqual([], rv["_links"])
+
 
 class TestGenericPage(unittest.TestCase):
 
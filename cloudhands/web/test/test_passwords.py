@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import threading
+import unittest
+
+import bcrypt
+
+from cloudhands.web.passwords import Overloaded
+from cloudhands.web.passwords import PasswordPool
+from cloudhands.web.passwords import sizes
+
+
+class PasswordPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = PasswordPool(workers=1, queue=1, timeout=5, rounds=4)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.shutdown()
+
+    def block(self):
+        started = threading.Event()
+
+        def job():
+            started.set()
+            self.release.wait(5)
+
+        future = self.pool.submit(job)
+        return future, started
+
+    def test_hash_and_check(self):
+        hash = self.pool.hash("TestPa$$w0rd")
+        self.assertTrue(self.pool.check("TestPa$$w0rd", hash))
+        self.assertFalse(self.pool.check("WrongPa$$w0rd", hash))
+        self.assertEqual(hash, bcrypt.hashpw("TestPa$$w0rd", hash))
+
+    def test_full_pool_refuses_work(self):
+        running, started = self.block()
+        self.assertTrue(started.wait(5))
+        queued, _ = self.block()
+        self.assertRaises(Overloaded, self.pool.submit, lambda: None)
+        self.assertEqual(1, self.pool.rejected)
+
+        self.release.set()
+        running.result(5)
+        queued.result(5)
+        self.assertIsNone(self.pool.run(lambda: None))
+        self.assertEqual(3, self.pool.completed)
+        self.assertEqual(0, self.pool.admitted)
+
+    def test_timeout_is_overloaded(self):
+        self.pool.timeout = 0.05
+        running, started = self.block()
+        self.assertTrue(started.wait(5))
+        self.assertRaises(Overloaded, self.pool.run, lambda: None)
+
+        # The cancelled job gave up its slot.
+        self.assertEqual(1, self.pool.admitted)
+        queued, _ = self.block()
+        self.release.set()
+        queued.result(5)
+
+    def test_exposition_has_gauges(self):
+        running, started = self.block()
+        self.assertTrue(started.wait(5))
+        figures = dict(
+            i.split() for i in self.pool.exposition()
+            if not i.startswith("#"))
+        self.assertEqual("1", figures["cloudhands_password_running"])
+        self.assertEqual("0", figures["cloudhands_password_queued"])
+        self.assertEqual("2", figures["cloudhands_password_capacity"])
+
+
+class SizeTests(unittest.TestCase):
+
+    def test_pool_leaves_threads_for_pages(self):
+        for threads in (1, 2, 4, 8, 16, 64):
+            workers, queue = sizes(threads)
+            self.assertGreaterEqual(workers, 1)
+            self.assertLessEqual(workers, 2)
+            self.assertLessEqual(workers + queue, max(1, threads // 4))
+
+    def test_default_server(self):
+        self.assertEqual((1, 0), sizes(4))
+        self.assertEqual((2, 2), sizes(16))
+
+    def test_workers_given(self):
+        self.assertEqual((2, 0), sizes(4, workers=2))
+        self.assertEqual((2, 2), sizes(16, workers=2))
+        self.assertEqual((3, 0), sizes(4, workers=8))
+        self.assertEqual((1, 0), sizes(1, workers=2))
+
+
+if __name__ == "__main__":
+    unittest.main()
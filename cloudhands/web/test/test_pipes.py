@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+from collections import namedtuple
+import queue
+import unittest
+import unittest.mock
+
+from cloudhands.web.pipes import PipeWriters
+
+Provider = namedtuple("Provider", ["name"])
+
+
+class FakeWriter:
+
+    def __init__(self, path, maxsize=2):
+        self.path = path
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.closed = False
+
+    def put_nowait(self, msg):
+        self.queue.put_nowait(msg)
+
+    def close(self):
+        self.closed = True
+
+
+class PipeWritersTests(unittest.TestCase):
+
+    def setUp(self):
+        self.opened = []
+        self.pipes = PipeWriters(opener=self.open)
+
+    def open(self, path):
+        writer = FakeWriter(path)
+        self.opened.append(writer)
+        return writer
+
+    def test_path_per_provider(self):
+        config = {"pipe.tokens": {
+            "vcloud": "/tmp/vcloud.fifo", "cloud.example.org": "/tmp/ex.fifo"}}
+        self.assertEqual(
+            "/tmp/ex.fifo",
+            self.pipes.path(config, Provider("cloud.example.org")))
+        self.assertEqual(
+            "/tmp/vcloud.fifo",
+            self.pipes.path(config, Provider("other.example.org")))
+
+    def test_writer_is_kept_open(self):
+        self.assertTrue(self.pipes.send("/tmp/a", "one"))
+        self.assertTrue(self.pipes.send("/tmp/a", "two"))
+        self.assertTrue(self.pipes.send("/tmp/b", "three"))
+        self.assertEqual(["/tmp/a", "/tmp/b"], [i.path for i in self.opened])
+        self.assertEqual(2, len(self.pipes))
+        self.pipes.close()
+        self.assertTrue(all(i.closed for i in self.opened))
+        self.assertEqual(0, len(self.pipes))
+
+    def test_failed_writer_is_reopened(self):
+        self.pipes.send("/tmp/a", "one")
+        self.pipes.send("/tmp/a", "two")
+        self.assertTrue(self.pipes.send("/tmp/a", "three"))
+        self.assertTrue(self.opened[0].closed)
+        self.assertEqual(2, len(self.opened))
+        self.assertEqual("three", self.opened[1].queue.get_nowait())
+        self.assertEqual(1, len(self.pipes))
+
+    def test_message_dropped_when_reopen_fails(self):
+        self.pipes.send("/tmp/a", "one")
+        self.pipes.send("/tmp/a", "two")
+        self.pipes.opener = unittest.mock.Mock(side_effect=OSError("gone"))
+        self.assertFalse(self.pipes.send("/tmp/a", "three"))
+        self.assertTrue(self.opened[0].closed)
+        self.assertEqual(0, len(self.pipes))
+
+    def test_transient_writers(self):
+        self.pipes.persistent = False
+        self.pipes.send("/tmp/a", "one")
+        self.pipes.send("/tmp/a", "two")
+        self.assertEqual(2, len(self.opened))
+        self.assertTrue(all(i.closed for i in self.opened))
+
+
+if __name__ == "__main__":
+    unittest.main()
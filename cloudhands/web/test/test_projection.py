@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import datetime
+import sqlite3
+import unittest
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import cloudhands.common
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import Appliance
+from cloudhands.common.schema import IPAddress
+from cloudhands.common.schema import Label
+from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+from cloudhands.common.states import ApplianceState
+
+from cloudhands.web.projection import appliances
+from cloudhands.web.projection import available
+from cloudhands.web.projection import blank
+from cloudhands.web.projection import catch_up
+from cloudhands.web.projection import create
+from cloudhands.web.projection import current
+from cloudhands.web.projection import latest
+from cloudhands.web.projection import project
+from cloudhands.web.projection import rebuild
+from cloudhands.web.projection import store
+
+
+class ProjectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        initialise(self.session)
+        self.org = Organisation(uuid=uuid.uuid4().hex, name="TestOrg")
+        self.user = User(handle="TestUser", uuid=uuid.uuid4().hex)
+        self.session.add_all((self.org, self.user))
+        self.session.commit()
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, ":memory:")
+
+    def touch(self, app, name, at=None):
+        state = self.session.query(ApplianceState).filter(
+            ApplianceState.name == name).one()
+        return Touch(
+            artifact=app, actor=self.user, state=state,
+            at=at or datetime.datetime.utcnow())
+
+    def make_appliance(self):
+        app = Appliance(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__,
+            organisation=self.org)
+        act = self.touch(app, "configuring")
+        self.session.add(Label(
+            name="test_appliance", description="Testing", touch=act))
+        self.session.commit()
+        return app
+
+    def test_table_is_optional(self):
+        self.assertFalse(available(self.session))
+        self.make_appliance()
+
+    def test_new_appliance_is_projected(self):
+        create(self.session)
+        app = self.make_appliance()
+        rv = appliances(self.session, self.org)
+        self.assertEqual(1, len(rv))
+        self.assertEqual(app.uuid, rv[0].uuid)
+        self.assertEqual("test_appliance", rv[0].label)
+        self.assertEqual("configuring", rv[0].latest.state.name)
+        self.assertEqual("TestOrg", rv[0].organisation)
+
+    def test_later_touches_update_projection(self):
+        create(self.session)
+        app = self.make_appliance()
+        act = self.touch(app, "pre_provision")
+        self.session.add(IPAddress(value="192.168.1.4", touch=act))
+        self.session.commit()
+        self.session.add(self.touch(app, "provisioning"))
+        self.session.commit()
+
+        rv = appliances(self.session, self.org)
+        self.assertEqual(1, len(rv))
+        self.assertEqual("provisioning", rv[0].latest.state.name)
+        self.assertEqual("test_appliance", rv[0].label)
+        self.assertEqual("192.168.1.4", rv[0].ips)
+
+    def test_rebuild_matches_incremental(self):
+        create(self.session)
+        for n in range(3):
+            app = self.make_appliance()
+            self.session.add(self.touch(app, "pre_provision"))
+            self.session.commit()
+        incremental = [
+            (i.uuid, i.label, i.latest.state.name)
+            for i in appliances(self.session, self.org)]
+
+        self.assertEqual(3, rebuild(self.session))
+        self.assertEqual(incremental, [
+            (i.uuid, i.label, i.latest.state.name)
+            for i in appliances(self.session, self.org)])
+
+    def test_create_fills_from_history(self):
+        self.make_appliance()
+        create(self.session)
+        self.assertEqual(1, len(appliances(self.session, self.org)))
+
+    def touch_elsewhere(self, app, name):
+        """
+        Adds a Touch as another process would, unseen by the session.
+        """
+        event.remove(Session, "after_flush", project)
+        try:
+            self.session.add(self.touch(app, name))
+            self.session.commit()
+        finally:
+            event.listen(Session, "after_flush", project)
+
+    def test_touches_from_elsewhere_are_caught_up(self):
+        create(self.session)
+        app = self.make_appliance()
+        self.assertTrue(current(self.session))
+        self.touch_elsewhere(app, "pre_provision")
+        self.assertFalse(current(self.session))
+
+        self.assertEqual(1, catch_up(self.session))
+        self.assertTrue(current(self.session))
+        rv = appliances(self.session, self.org)
+        self.assertEqual("pre_provision", rv[0].latest.state.name)
+        self.assertEqual("test_appliance", rv[0].label)
+
+    def test_projection_waits_for_catch_up(self):
+        create(self.session)
+        app = self.make_appliance()
+        self.touch_elsewhere(app, "pre_provision")
+        act = self.touch(app, "provisioning")
+        self.session.add(IPAddress(value="192.168.1.4", touch=act))
+        self.session.commit()
+        self.assertFalse(current(self.session))
+
+        catch_up(self.session)
+        self.assertTrue(current(self.session))
+        rv = appliances(self.session, self.org)
+        self.assertEqual("provisioning", rv[0].latest.state.name)
+        self.assertEqual("192.168.1.4", rv[0].ips)
+
+    def test_create_catches_up(self):
+        create(self.session)
+        app = self.make_appliance()
+        self.touch_elsewhere(app, "pre_provision")
+        create(self.session)
+        self.assertTrue(current(self.session))
+
+    def test_store_in_chunks(self):
+        create(self.session)
+        apps = [self.make_appliance() for n in range(5)]
+        rows = {i.id: dict(blank(i), label="renamed") for i in apps}
+        connection = self.session.connection()
+        store(connection, rows, chunk=2)
+        self.session.commit()
+        self.assertEqual(
+            {"renamed"},
+            {i.label for i in appliances(self.session, self.org)})
+        self.assertEqual(
+            5, len(self.session.connection().execute(
+                latest.select()).fetchall()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import datetime
+import sqlite3
+import unittest
+import uuid
+
+import cloudhands.common
+from cloudhands.common.connectors import initialise
+from cloudhands.common.connectors import Registry
+from cloudhands.common.schema import Label
+from cloudhands.common.schema import Registration
+from cloudhands.common.schema import Touch
+from cloudhands.common.schema import User
+from cloudhands.common.states import RegistrationState
+
+from cloudhands.web.propagation import PasswordJob
+from cloudhands.web.propagation import propagate
+from cloudhands.web.propagation import Propagator
+
+
+class PropagationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        initialise(self.session)
+        valid = self.session.query(RegistrationState).filter(
+            RegistrationState.name == "valid").one()
+        self.user = User(handle="TestUser", uuid=uuid.uuid4().hex)
+        self.reg = Registration(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__)
+        self.session.add(Touch(
+            artifact=self.reg, actor=self.user, state=valid,
+            at=datetime.datetime.utcnow()))
+        self.session.commit()
+        self.job = PasswordJob(
+            self.reg.uuid, self.user.id, "testuser", "TestPa$$w0rd")
+        self.calls = []
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, ":memory:")
+
+    def change(self, *statuses):
+        statuses = list(statuses)
+
+        def change_password(cn, pwd, timeout=None):
+            self.calls.append((cn, pwd))
+            return statuses.pop(0)
+
+        return change_password
+
+    def labels(self):
+        return [
+            i.description for i in self.session.query(Label).join(
+                Touch).order_by(Touch.id)]
+
+    def test_first_success_is_not_recorded(self):
+        nTouches = self.session.query(Touch).count()
+        act = propagate(self.session, self.job, change=self.change(0))
+        self.assertEqual([("testuser", "TestPa$$w0rd")], self.calls)
+        self.assertIsNone(act)
+        self.assertEqual([], self.labels())
+        self.assertEqual(nTouches, self.session.query(Touch).count())
+
+    def test_failure_is_retried_then_recorded(self):
+        act = propagate(
+            self.session, self.job, change=self.change(None, 1, None),
+            delay=0)
+        self.assertEqual(3, len(self.calls))
+        self.assertIs(self.reg, act.artifact)
+        self.assertEqual(["timeout"], self.labels())
+        self.assertEqual("valid", self.reg.changes[-1].state.name)
+
+    def test_only_changes_are_recorded(self):
+        change = self.change(1, 1, 0, 0, 1)
+        for n in range(5):
+            propagate(self.session, self.job, change=change, attempts=1)
+        self.assertEqual(5, len(self.calls))
+        self.assertEqual(
+            ["exit status 1", "ok", "exit status 1"], self.labels())
+
+    def test_propagator_runs_in_background(self):
+        propagator = Propagator(
+            lambda: self.session, change=self.change(2, 2, 2, 0), delay=0)
+        self.assertTrue(propagator.submit(self.job))
+        self.assertTrue(propagator.submit(self.job))
+        propagator.jobs.join()
+        propagator.stop()
+        self.assertEqual(4, len(self.calls))
+        self.assertEqual(["exit status 2", "ok"], self.labels())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,22 +6,34 @@ import sqlite3
 import unittest
 import uuid
 
+from sqlalchemy import inspect
+
 from cloudhands.common.connectors import initialise
 from cloudhands.common.connectors import Registry
 
 import cloudhands.common.schema
+from cloudhands.common.schema import BcryptedPassword
+from cloudhands.common.schema import EmailAddress
 from cloudhands.common.schema import Host
 from cloudhands.common.schema import IPAddress
 from cloudhands.common.schema import Organisation
+from cloudhands.common.schema import PosixUId
 from cloudhands.common.schema import Provider
+from cloudhands.common.schema import Registration
 from cloudhands.common.schema import State
 from cloudhands.common.schema import Touch
 from cloudhands.common.schema import User
 
 from cloudhands.common.states import HostState
 from cloudhands.common.states import MembershipState
+from cloudhands.common.states import RegistrationState
 
+from cloudhands.web.metrics import StatementLog
 from cloudhands.web.tricks import allocate_ip
+from cloudhands.web.tricks import create
+from cloudhands.web.tricks import ix_resource_touch
+from cloudhands.web.tricks import ix_touch_artifact_at
+from cloudhands.web.tricks import latest_resource
 
 
 class TestResourceManagement(unittest.TestCase):
@@ -92,3 +104,56 @@ class TestResourceManagement(unittest.TestCase):
         self.assertNotIn(
             ip, [r for c in hosts[0].changes for r in c.resources])
         self.assertIn(ip, [r for c in hosts[1].changes for r in c.resources])
+
+
+class LatestResourceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Registry().connect(sqlite3, ":memory:").session
+        self.session.add_all(
+            State(fsm=RegistrationState.table, name=v)
+            for v in RegistrationState.values)
+        self.session.commit()
+        state = self.session.query(RegistrationState).first()
+        self.user = User(handle="TestUser", uuid=uuid.uuid4().hex)
+        self.reg = Registration(
+            uuid=uuid.uuid4().hex,
+            model=cloudhands.common.__version__)
+        then = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        self.touches = [
+            Touch(
+                artifact=self.reg, actor=self.user, state=state,
+                at=then + datetime.timedelta(seconds=n))
+            for n in range(200)]
+        self.session.add_all(
+            BcryptedPassword(touch=t, value="hash{}".format(n))
+            for n, t in enumerate(self.touches))
+        self.session.add(EmailAddress(
+            touch=self.touches[10], value="someone@somewhere.org"))
+        self.session.commit()
+
+    def tearDown(self):
+        Registry().disconnect(sqlite3, ":memory:")
+
+    def test_latest_of_many(self):
+        self.session.expire_all()
+        with StatementLog() as log:
+            rv = latest_resource(self.session, self.reg, BcryptedPassword)
+        self.assertEqual("hash199", rv.value)
+        self.assertEqual(1, len(log))
+
+    def test_single_resource(self):
+        rv = latest_resource(self.session, self.reg, EmailAddress)
+        self.assertEqual("someone@somewhere.org", rv.value)
+        self.assertIs(self.touches[10], rv.touch)
+
+    def test_missing_resource(self):
+        self.assertIsNone(latest_resource(self.session, self.reg, PosixUId))
+
+    def test_create_indexes(self):
+        create(self.session)
+        create(self.session)
+        for index in (ix_touch_artifact_at, ix_resource_touch):
+            self.assertIn(index.name, {
+                i["name"] for i in inspect(
+                    self.session.connection()).get_indexes(index.table.name)})
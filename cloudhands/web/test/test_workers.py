@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import http.client
+import multiprocessing
+import os
+import signal
+import time
+import unittest
+import unittest.mock
+
+from cloudhands.web.workers import listen
+from cloudhands.web.workers import Supervisor
+
+
+def hello(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(os.getpid()).encode("ascii")]
+
+
+def fetch(port, attempts=50):
+    for n in range(attempts):
+        try:
+            con = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            con.request("GET", "/")
+            rsp = con.getresponse()
+            return rsp.status, int(rsp.read())
+        except (ConnectionError, OSError):
+            time.sleep(0.1)
+    raise AssertionError("No response on port {}".format(port))
+
+
+class SupervisorStepTests(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = Supervisor(None, None, workers=2, threads=1)
+        patches = [
+            unittest.mock.patch.object(self.supervisor, name)
+            for name in ("spawn", "stop", "reap")]
+        self.spawn, self.stop, self.reap = [i.start() for i in patches]
+        for i in patches:
+            self.addCleanup(i.stop)
+        self.reap.return_value = []
+
+    def test_handlers_only_set_a_flag(self):
+        self.supervisor.request_recycle(signal.SIGHUP, None)
+        self.assertEqual("recycle", self.supervisor.pending)
+        self.spawn.assert_not_called()
+
+    def test_shutdown_is_not_overridden(self):
+        self.supervisor.request_shutdown(signal.SIGTERM, None)
+        self.supervisor.request_recycle(signal.SIGHUP, None)
+        self.assertEqual("shutdown", self.supervisor.pending)
+
+    def test_step_recycles(self):
+        self.supervisor.pids = {101: (0, 0.0)}
+        self.supervisor.request_recycle()
+        self.supervisor.step()
+        self.assertEqual(1, self.supervisor.generation)
+        self.assertEqual(2, self.spawn.call_count)
+        self.stop.assert_called_once_with([101])
+        self.assertIsNone(self.supervisor.pending)
+
+    def test_step_replaces_dead_worker(self):
+        self.reap.return_value = [(101, 0, 60.0), (102, -1, 60.0)]
+        self.supervisor.step()
+        self.assertEqual(1, self.spawn.call_count)
+
+    def test_step_shuts_down(self):
+        self.supervisor.running = True
+        self.supervisor.pids = {101: (0, 0.0)}
+        self.supervisor.request_shutdown()
+        self.supervisor.step()
+        self.assertFalse(self.supervisor.running)
+        self.stop.assert_called_once_with([101])
+        self.spawn.assert_not_called()
+
+
+class SupervisorProcessTests(unittest.TestCase):
+
+    def test_recycle_and_shutdown(self):
+        sock = listen("127.0.0.1", 0)
+        port = sock.getsockname()[1]
+        supervisor = Supervisor(lambda: hello, sock, workers=1, threads=1)
+        parent = multiprocessing.Process(target=supervisor.run)
+        parent.start()
+        sock.close()
+        try:
+            status, first = fetch(port)
+            self.assertEqual(200, status)
+
+            os.kill(parent.pid, signal.SIGHUP)
+            deadline = time.monotonic() + 10
+            second = first
+            while second == first and time.monotonic() < deadline:
+                time.sleep(0.2)
+                status, second = fetch(port)
+            self.assertNotEqual(first, second)
+        finally:
+            os.kill(parent.pid, signal.SIGTERM)
+            parent.join(timeout=60)
+        self.assertEqual(0, parent.exitcode)
+
+
+if __name__ == "__main__":
+    unittest.main()
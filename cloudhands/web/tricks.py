@@ -17,8 +17,17 @@ from cloudhands.common.schema import User
 
 from cloudhands.common.states import MembershipState
 
+from cloudhands.identity.database import create_indexes
+from cloudhands.identity.database import ix_resource_touch
+from cloudhands.identity.database import ix_touch_artifact_at
+from cloudhands.identity.database import latest_resource
+
 __doc__ = """
 Common functions for interacting with the schema.
+
+:py:func:`latest_resource` and the indexes which back it are shared with
+the identity processes, so they live in
+:py:mod:`cloudhands.identity.database`.
 """
 
 
@@ -33,3 +42,16 @@ def allocate_ip(session, host, provider, ipAddr):
     session.add(ip)
     session.commit()
     return ip
+
+
+def create(session):
+    """
+    Creates the indexes for :py:func:`latest_resource` if they are
+    missing.
+
+    :param object session:  A SQLALchemy database session.
+    :returns: The session.
+    """
+    create_indexes(session, (ix_touch_artifact_at, ix_resource_touch))
+    session.commit()
+    return session
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+import logging
+import os
+import signal
+import socket
+import time
+
+from waitress.server import create_server
+
+__doc__ = """
+A pre-forking supervisor for the web server.
+
+The parent process binds the listening socket and forks a number of
+workers. Each worker builds its own WSGI application and serves the
+shared socket with a pool of waitress threads. The kernel hands each new
+connection to whichever worker accepts it first.
+
+The parent restarts any worker which dies. Signals are handled as
+follows:
+
+SIGHUP
+    Worker recycle. A new set of workers is forked, then the old ones
+    are asked to finish their current requests and exit. This releases
+    whatever the old workers held, eg: memory, caches and database
+    connections. The new workers are forked from the parent, so they
+    run the code and configuration which the parent loaded when it
+    started. Neither is read again. To deploy new code or settings,
+    stop the parent and start it again.
+SIGTERM, SIGINT
+    Graceful shutdown of all workers, then the parent.
+
+The signal handlers only note what was asked for. The parent's main
+loop acts on it, so workers are never forked from inside a handler.
+These signals are blocked while a worker is forked, and the worker
+resets them before unblocking, so it never runs the parent's handlers.
+
+Per-process state
+~~~~~~~~~~~~~~~~~
+
+Every worker is a separate Python process. Nothing held in memory is
+shared between them.
+
+`CRED_TABLE`
+    MAC credentials are remembered only by the worker which issued
+    them. The credentials are derived from the configured master secret,
+    so any worker can verify them. A repeat request to another worker
+    simply derives them again.
+`USER_CACHE`
+    Each worker keeps its own cache of user ids. A change flushed by one
+    worker evicts entries from that worker's cache only. Other workers
+    may use a stale entry until it expires.
+`METRICS`
+    The `/metrics` view reports the requests seen by the worker which
+    answers it. A single scrape covers one worker only.
+Activity rings
+    Each worker holds the recent activity of each organisation in
+    memory. The commits of other workers reach them at the next round
+    of catch up, so the front page of a worker may lag by that long.
+Database sessions
+    Each worker creates its own connection pool after the fork, sized by
+    `--threads`. SQLite in WAL mode lets the workers read concurrently.
+    Writes are serialised by the database lock, with the busy timeout
+    and request retry from :py:mod:`cloudhands.web.database`.
+
+A database held in memory cannot be shared between processes, so worker
+mode needs a database file.
+"""
+
+DFLT_BACKLOG = 1024
+DFLT_GRACE = 30
+DFLT_RESPAWN_INTERVAL = 1.0
+DFLT_POLL = 0.1
+
+SIGNALS = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
+
+
+def listen(host, port, backlog=DFLT_BACKLOG):
+    """
+    Returns a TCP socket bound to `host` and `port` and ready to accept
+    connections. The socket is inherited by forked workers.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve_worker(app_factory, sock, threads, grace=DFLT_GRACE, **kwargs):
+    """
+    Serves a WSGI app on `sock` until the process receives SIGTERM.
+    This runs in a forked worker process.
+
+    :param app_factory: A callable which returns the WSGI app.
+    """
+    log = logging.getLogger("cloudhands.web.workers.serve_worker")
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    app = app_factory()
+    server = create_server(app, _sock=sock, threads=threads, **kwargs)
+    log.info("Worker {} serving with {} threads".format(os.getpid(), threads))
+    try:
+        server.run()
+    except SystemExit:
+        pass
+    finally:
+        # Stop accepting, then let the threads finish what they hold.
+        server.close()
+        server.task_dispatcher.shutdown(cancel_pending=False, timeout=grace)
+        log.info("Worker {} stopped".format(os.getpid()))
+    return 0
+
+
+class Supervisor:
+    """
+    Keeps `workers` child processes serving `sock`.
+
+    :param app_factory: A callable which returns the WSGI app. It is
+                        called in each worker after the fork.
+    :param sock:        A listening socket.
+    :param int workers: The number of worker processes.
+    :param int threads: The number of threads in each worker.
+    """
+
+    def __init__(
+        self, app_factory, sock, workers, threads,
+        grace=DFLT_GRACE, **kwargs
+    ):
+        self.app_factory = app_factory
+        self.sock = sock
+        self.workers = workers
+        self.threads = threads
+        self.grace = grace
+        self.kwargs = kwargs
+        self.pids = {}
+        self.generation = 0
+        self.running = False
+        self.pending = None
+
+    def spawn(self):
+        signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                for signum in SIGNALS:
+                    signal.signal(signum, signal.SIG_DFL)
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+
+        if pid == 0:
+            rv = 1
+            try:
+                rv = serve_worker(
+                    self.app_factory, self.sock, self.threads,
+                    grace=self.grace, **self.kwargs)
+            except Exception as e:
+                logging.getLogger("cloudhands.web.workers").error(e)
+            finally:
+                os._exit(rv)
+
+        self.pids[pid] = (self.generation, time.monotonic())
+        return pid
+
+    def stop(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.pids.pop(pid, None)
+
+    def reap(self, block=True):
+        """
+        Collects exited workers. Returns a list of (pid, generation,
+        lifetime) for each.
+        """
+        rv = []
+        flags = 0 if block else os.WNOHANG
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, flags)
+            except ChildProcessError:
+                self.pids.clear()
+                break
+            except InterruptedError:
+                break
+            if pid == 0:
+                break
+            generation, start = self.pids.pop(pid, (None, None))
+            if generation is not None:
+                rv.append((pid, generation, time.monotonic() - start))
+            flags = os.WNOHANG
+        return rv
+
+    def recycle(self):
+        log = logging.getLogger("cloudhands.web.workers.recycle")
+        old = list(self.pids)
+        self.generation += 1
+        log.info("Starting generation {}".format(self.generation))
+        for n in range(self.workers):
+            self.spawn()
+        self.stop(old)
+
+    def request_recycle(self, signum=None, frame=None):
+        if self.pending != "shutdown":
+            self.pending = "recycle"
+
+    def request_shutdown(self, signum=None, frame=None):
+        self.pending = "shutdown"
+
+    def step(self):
+        """
+        Acts on any signal received, then collects and replaces
+        workers which have died.
+        """
+        log = logging.getLogger("cloudhands.web.workers.run")
+        pending, self.pending = self.pending, None
+        if pending == "shutdown":
+            self.running = False
+            self.stop(list(self.pids))
+            return
+        elif pending == "recycle":
+            self.recycle()
+
+        for pid, generation, lifetime in self.reap(block=False):
+            if generation != self.generation:
+                continue
+            log.warning("Worker {} exited after {:.1f}s".format(
+                pid, lifetime))
+            if lifetime < DFLT_RESPAWN_INTERVAL:
+                # Don't spin if workers fail on start up.
+                time.sleep(DFLT_RESPAWN_INTERVAL)
+            self.spawn()
+
+    def run(self):
+        log = logging.getLogger("cloudhands.web.workers.run")
+        self.running = True
+        signal.signal(signal.SIGHUP, self.request_recycle)
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGINT, self.request_shutdown)
+
+        for n in range(self.workers):
+            self.spawn()
+
+        while self.running:
+            self.step()
+            if self.running:
+                time.sleep(DFLT_POLL)
+
+        log.info("Stopping {} workers".format(len(self.pids)))
+        deadline = time.monotonic() + self.grace
+        while self.pids and time.monotonic() < deadline:
+            self.reap(block=False)
+            time.sleep(0.1)
+        for pid in list(self.pids):
+            log.warning("Killing worker {}".format(pid))
+            os.kill(pid, signal.SIGKILL)
+        self.reap()
+        self.sock.close()
+        return 0
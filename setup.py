@@ -66,6 +66,7 @@ setup(
     entry_points={
         "console_scripts": [
             "cloud-webserve = cloudhands.web.main:run",
+            "cloud-benchmark = cloudhands.web.benchmark:run",
             "cloud-demoserve = cloudhands.web.demo:run",
             "cloud-index = cloudhands.web.indexer:run",
             "cloud-identity = cloudhands.identity.main:run",